@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+'''
+Benchmarks of the hawcast workflow on a synthetic campaign.
+
+    python benchmarks/bench.py                # run and compare to the baseline
+    python benchmarks/bench.py --save         # run and store a new baseline
+    python benchmarks/bench.py -k stat_       # run a subset of the benchmarks
+
+Each benchmark reports the best wall time of --repeat runs, the throughput
+in files/s and MB/s, and the peak Python memory of a separate traced run.
+The run fails (exit status 1) if a benchmark is slower, or uses more memory,
+than the stored baseline by more than --tolerance. Baselines are machine
+specific; save one on the machine the comparison runs on.
+'''
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hawcast import backend, synthetic
+from hawcast.postproc import HAWC2DataFrame, wetbAccessor
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    # registers a benchmark. The function takes the Campaign and returns
+    # (run, number of files, number of bytes) where run is timed.
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+
+class Campaign(object):
+    # a synthetic campaign in a temporary directory, generated once and
+    # shared by all benchmarks.
+    def __init__(self, directory, files, channels, scans):
+        self.directory = directory
+        self.res_dir = os.path.join(directory, 'res', 'synth')
+        self.filenames = synthetic.write_results(self.res_dir, files, channels, scans)
+        self.dat_bytes = sum(os.path.getsize(fn + '.dat') for fn in self.filenames)
+        self.channels = {f'ch{i}': i for i in range(2, channels + 1)}
+        # a large tag table for tag generation and filtering, and a smaller
+        # one for writing htc files
+        self.big_definition = synthetic.write_definition(
+            os.path.join(directory, 'synth_big.py'), n_variables=4, n_values=10)
+        self.definition = synthetic.write_definition(
+            os.path.join(directory, 'synth.py'), n_variables=3, n_values=8)
+        self.master = synthetic.write_master(os.path.join(directory, 'htc', '_master', 'synth.htc'))
+
+
+    def frame(self):
+        return HAWC2DataFrame(dir=self.res_dir, pattern=synthetic.RESULT_PATTERN, channels=self.channels)
+
+
+
+@benchmark('readHawc2Res')
+def bench_read(campaign):
+    def run():
+        for fn in campaign.filenames:
+            backend.readHawc2Res(fn)
+    return run, len(campaign.filenames), campaign.dat_bytes
+
+
+def stat_benchmark(name):
+    @benchmark(f'stat_{name}')
+    def bench_stat(campaign):
+        def run():
+            campaign.frame().wetb.compute([name])
+        return run, len(campaign.filenames), campaign.dat_bytes
+
+for name in wetbAccessor._stats:
+    stat_benchmark(name)
+
+
+@benchmark('gen_tags')
+def bench_gen_tags(campaign):
+    def run():
+        backend.Case(campaign.big_definition)
+    n = len(backend.Case(campaign.big_definition).tags)
+    return run, n, 0
+
+
+@benchmark('mask')
+def bench_mask(campaign):
+    tags = backend.Case(campaign.big_definition).tags
+    def run():
+        for wsp in range(4, 28, 2):
+            tags._mask(wsp=wsp, seed=slice(2, 6), var0=[1, 3, 5])
+    return run, len(tags), 0
+
+
+@benchmark('aggregate_rows')
+def bench_aggregate_rows(campaign):
+    df = campaign.frame().wetb.compute(['mean', 'max'])
+    def run():
+        df.wetb.aggregate_rows('seed', {'Mean': 'mean', 'Max': 'max'})
+    return run, len(df), 0
+
+
+@benchmark('generate_htc_files')
+def bench_htc(campaign):
+    tags = backend.Case(campaign.definition).tags
+    def run():
+        backend.generate_htc_files(tags, campaign.master, n_jobs=8)
+    return run, len(tags), len(tags) * os.path.getsize(campaign.master)
+
+
+@benchmark('htc2bat')
+def bench_bat(campaign):
+    tags = backend.Case(campaign.definition).tags
+    backend.generate_htc_files(tags, campaign.master)
+    def run():
+        backend.htc2bat(os.path.join('htc', 'synth'), n=8, balance=True)
+    return run, len(tags), 0
+
+
+
+def measure(run, repeat):
+    # best wall time of repeat runs, and peak traced memory of one more run
+    with redirect_stdout(io.StringIO()):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t0)
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return min(times), peak / 1e6
+
+
+def run_benchmarks(config, names=None, repeat=3):
+    '''
+    Runs the benchmarks matching names (all if None) on a campaign of the
+    given config. Returns {name: {'seconds', 'files_per_s', 'mb_per_s',
+    'peak_mb'}}.
+    '''
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='hawcast_bench_')
+    results = {}
+    try:
+        os.chdir(directory)
+        campaign = Campaign(directory, **config)
+        for name, func in BENCHMARKS.items():
+            if names and not any(x in name for x in names):
+                continue
+            with redirect_stdout(io.StringIO()):
+                run, n_files, n_bytes = func(campaign)
+            seconds, peak_mb = measure(run, repeat)
+            results[name] = {'seconds': seconds,
+                             'files_per_s': n_files / seconds,
+                             'mb_per_s': n_bytes / seconds / 1e6,
+                             'peak_mb': peak_mb}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.3):
+    '''
+    Returns a list of messages for the benchmarks which are slower, or use
+    more memory, than the baseline by more than tolerance (a fraction).
+    Memory increases below 1 MB are ignored.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append(f'{name}: {result["seconds"]:.3f} s, baseline {base["seconds"]:.3f} s')
+        if result['peak_mb'] > base['peak_mb'] * (1 + tolerance) + 1:
+            regressions.append(f'{name}: {result["peak_mb"]:.1f} MB, baseline {base["peak_mb"]:.1f} MB')
+    return regressions
+
+
+
+@click.command()
+@click.option('-k', 'names', multiple=True, help='Only run benchmarks whose name contains this.')
+@click.option('--files', default=50, help='Number of result files.')
+@click.option('--channels', default=30, help='Number of channels per result file.')
+@click.option('--scans', default=12000, help='Number of samples per channel.')
+@click.option('--repeat', default=3, help='Number of timed runs per benchmark.')
+@click.option('--baseline', 'baseline_fn', default=BASELINE, help='Baseline json file.')
+@click.option('--save', is_flag=True, help='Store the results as the new baseline.')
+@click.option('--tolerance', default=0.3, help='Allowed slowdown as a fraction of the baseline.')
+def main(names, files, channels, scans, repeat, baseline_fn, save, tolerance):
+    '''Runs the hawcast benchmarks on a synthetic campaign.'''
+    config = {'files': files, 'channels': channels, 'scans': scans}
+    results = run_benchmarks(config, names, repeat)
+
+    print(f'{"benchmark":<24}{"time [s]":>10}{"files/s":>12}{"MB/s":>10}{"peak MB":>10}')
+    for name, r in results.items():
+        mb_per_s = f'{r["mb_per_s"]:.1f}' if r['mb_per_s'] else '-'
+        print(f'{name:<24}{r["seconds"]:>10.3f}{r["files_per_s"]:>12.1f}{mb_per_s:>10}{r["peak_mb"]:>10.1f}')
+
+    if save:
+        with open(baseline_fn, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+        print(f'Baseline saved to {baseline_fn}.')
+        return
+
+    try:
+        with open(baseline_fn) as f:
+            baseline = json.load(f)
+    except OSError:
+        print(f'No baseline found at {baseline_fn}.')
+        return
+    if baseline['config'] != config:
+        print(f'The baseline was made with {baseline["config"]}, not comparing.')
+        return
+    regressions = compare(results, baseline['results'], tolerance)
+    for message in regressions:
+        print(f'REGRESSION {message}')
+    if regressions:
+        sys.exit(1)
+    print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
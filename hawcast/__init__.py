@@ -1,2 +1,15 @@
-from .hawcast import htc, jess
-from .postproc import HAWC2DataFrame
+# The submodules are imported on first use, so that importing hawcast (and
+# starting the command line tool) does not load pandas, scipy and wetb.
+_lazy = {'htc': 'hawcast', 'jess': 'hawcast', 'cli': 'hawcast', 'HAWC2DataFrame': 'postproc'}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        import importlib
+        module = importlib.import_module('.' + _lazy[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy))
@@ -1,13 +1,22 @@
-import os, sys, zipfile, importlib
+import os, sys, importlib, json, hashlib
+from collections.abc import Sequence
 import numpy as np
 import pandas as pd
 import re as magic
-from itertools import product
-
-from wetb.hawc2.htc_file import HTCFile
-from wetb.fatigue_tools.fatigue import eq_load
+from concurrent.futures import ThreadPoolExecutor
 
 from .myDataFrame import myDataFrame
+from .reader import Hawc2Result
+from .derived import ResultArray, resolve
+from .filtering import TagIndex
+from .template import Template
+# htc2bat, chunkify and the launch file functions are kept here for
+# backwards compatibility
+from .scheduling import htc2bat, chunkify
+from .pbs import (generate_model_zip, htc2pbs, htc2pbs_batch, PBS_KEYS, find_model_zip,
+                  resolve_model_zip, pbs_filename)
+from .prefetch import prefetch as _prefetch
+from . import profiling
 
 
 
@@ -23,269 +32,392 @@ def import_path(fullpath):
 
 
 
-def htc2bat(htc_dir, n=1, filter='all', app='hawc2mb'):
+def vectorized(func):
+    # marks an entry of Functions in a definition file as vectorized. A
+    # vectorized function receives a dataframe of whole tag columns instead
+    # of a dictionary of a single row, and returns a column.
+    func.vectorized = True
+    return func
 
-    htc_files = [os.path.join(htc_dir, x) for x in os.listdir(htc_dir) if x.endswith('.htc')]
-    bat_dir = 'bat'
-    if not os.path.exists(bat_dir):
-        os.makedirs(bat_dir)
 
-    chunks = chunkify(htc_files, n)
+def n_combinations(Vars):
+    # number of rows in the Cartesian product of the variables
+    return int(np.prod([len(x) for x in Vars.values()], dtype=np.int64))
 
-    for i, chunk in enumerate(chunks):
-        with open(os.path.join(bat_dir, f'{i+1}.bat'), 'w') as f:
-            f.write('cd ..\n')
-            for file in chunk:
-                f.write(f'{app} {file}\n')
 
+def tag_table(Consts, Vars, Funcs, start=0, stop=None):
+    # generates rows start to stop of the tag table: the Cartesian product of
+    # Vars (last variable varying fastest, as itertools.product) along with
+    # the constants and the outputs of Funcs. The product is built column by
+    # column with numpy, and vectorized functions are evaluated once on the
+    # whole columns. Other functions are called once per row.
+    stop = n_combinations(Vars) if stop is None else stop
+    rows = np.arange(start, stop)
+    n = len(rows)
 
-def chunkify(lst, n):
-# splits a list into n groups of approximately the same length
-    return [lst[i::n] for i in range(n)]
+    columns = {key: pd.Series([value]*n, index=rows, dtype=object).infer_objects()
+               for key, value in Consts.items()}
+    if Vars:
+        subs = np.unravel_index(rows, [len(x) for x in Vars.values()])
+        for (key, values), sub in zip(Vars.items(), subs):
+            columns[key] = pd.Series(pd.Series(list(values)).to_numpy()[sub], index=rows)
+    tags = myDataFrame(columns, index=rows)
 
+    for key, f in Funcs.items():
+        if getattr(f, 'vectorized', False):
+            tags[key] = f(tags)
+        else:
+            tags[key] = [f(row) for row in tags.to_dict('records')]
+    return tags
 
-def generate_htc_files(tag_list, template_fn, overwrite=True):
-    # generates htc files using a template htc file located at template_fn.
-    # uses parameters from self.params. if no destination folder is provided,
-    # the files are written in self.HTCDir. If overwrite is False, only
-    # htc files which do not exist will be written. Otherwise, all files will
-    # be written.
 
+def iter_tag_tables(Consts, Vars, Funcs, chunksize=100000):
+    # yields the tag table in consecutive chunks of chunksize rows
+    N = n_combinations(Vars)
+    for start in range(0, N, chunksize):
+        yield tag_table(Consts, Vars, Funcs, start, min(start + chunksize, N))
+
+
+def generate_htc_files(tag_list, template_fn, overwrite=True, incremental=False, n_jobs=8, source=None):
+    # generates htc files using a template htc file located at template_fn.
+    # The files are written to htc/[casename]/[case_id].htc. If overwrite is
+    # False, only htc files which do not exist will be written. Otherwise,
+    # all files will be written. Only {tag} placeholders of the columns of
+    # tag_list are substituted; other braces are kept as they are.
+    # In incremental mode, a hash of each rendered file is kept in a
+    # manifest in each htc directory, and only files whose content changed
+    # are rewritten. Files generated previously from the same source (the
+    # definition file, by default template_fn) which are no longer in
+    # tag_list are removed, also in casename directories no longer in
+    # tag_list. Files are written by a pool of n_jobs threads.
+    # Returns a dictionary with the number of written, unchanged and
+    # removed files.
 
     # error check
     if not os.path.isfile(template_fn):
         raise FileNotFoundError('Template file {} does not exist.'.format(template_fn))
 
+    template = Template.from_file(template_fn, fields=tag_list.columns)
+    source = os.path.normpath(source or template_fn)
+
+    manifests = {}
+    to_write = []
+    count = {'written': 0, 'unchanged': 0, 'removed': 0}
+    for paramset in tag_list.to_dict('records'):
+        dest = os.path.join('htc', paramset['casename'])
+        fn = os.path.join(dest, paramset['case_id'] + '.htc')
+        if dest not in manifests:
+            os.makedirs(dest, exist_ok=True)
+            manifests[dest] = (read_htc_manifest(dest)[1] if incremental else {}, {})
+        old, new = manifests[dest]
+
+        if not overwrite and os.path.exists(fn):
+            count['unchanged'] += 1
+            new[os.path.basename(fn)] = old.get(os.path.basename(fn))
+            continue
+
+        with profiling.stage('htc.render'):
+            text = template.render(paramset)
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        new[os.path.basename(fn)] = digest
+        if incremental and old.get(os.path.basename(fn)) == digest and os.path.exists(fn):
+            count['unchanged'] += 1
+            continue
+        to_write.append((fn, text))
+
+    with ThreadPoolExecutor(n_jobs) as pool:
+        list(pool.map(lambda x: write_text(*x), to_write))
+    count['written'] = len(to_write)
+
+    if incremental:
+        # casename directories generated from the same source before
+        for entry in os.scandir('htc') if os.path.isdir('htc') else []:
+            if entry.is_dir() and entry.path not in manifests:
+                old_source, old = read_htc_manifest(entry.path)
+                if old_source == source:
+                    manifests[entry.path] = (old, None)
+        for dest, (old, new) in manifests.items():
+            for name in set(old) - set(new or {}):
+                if os.path.exists(os.path.join(dest, name)):
+                    os.remove(os.path.join(dest, name))
+                    count['removed'] += 1
+            if new is None:
+                os.remove(os.path.join(dest, HTC_MANIFEST))
+                if not os.listdir(dest):
+                    os.rmdir(dest)
+            else:
+                write_htc_manifest(dest, new, source)
+    return count
+
+
+def write_text(filename, text):
+    with profiling.stage('htc.write'):
+        with open(filename, 'w') as f:
+            f.write(text)
+    profiling.count('htc_bytes', len(text))
+
+
+HTC_MANIFEST = '.hawcast_htc.json'
+
+def read_htc_manifest(htc_dir):
+    # (source, {htc filename: sha1 of its content}) of the files generated
+    # in htc_dir, see generate_htc_files. Manifests of earlier versions have
+    # no source.
+    try:
+        with open(os.path.join(htc_dir, HTC_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None, {}
+    if isinstance(manifest.get('files'), dict):
+        return manifest.get('source'), manifest['files']
+    return None, manifest
 
-    with open(template_fn) as f:
-        TemplateText = f.read()
-
-    for _, paramset in tag_list.iterrows():
-        dest = 'htc/' + paramset.casename + '/'
-        if not os.path.exists(dest):
-            os.makedirs(dest)
-
-        if not overwrite:
-            if os.path.exists(dest + paramset.case_id + '.htc'):
-                continue
-
-        FileText = TemplateText
-        for key, value in paramset.items():
-            FileText = FileText.replace('{' + key + '}', str(value))
 
-        with open(dest + paramset.case_id + '.htc', 'w') as f:
-            f.write(FileText)
+def write_htc_manifest(htc_dir, manifest, source=None):
+    with open(os.path.join(htc_dir, HTC_MANIFEST), 'w') as f:
+        json.dump({'source': source, 'files': {k: v for k, v in manifest.items() if v is not None}},
+                  f, indent=0)
 
 
 
 def readHawc2Res(filename, channels=None):
     #reads specific channels of HAWC2 binary output files and saves in a
     #pandas dataframe. Variable names and channels are defined in a dictionary
-    # called channels
+    # called channels, which may include derived channels (see
+    # hawcast.derived). Use ResultArray to avoid building a dataframe.
+    return ResultArray.load(filename, channels).to_frame()
 
-    #read .sel file
-    with open(filename + '.sel') as f:
-        lines = f.readlines()
 
-    NCh             = int(lines[8].split()[1])
-    NSc             = int(lines[8].split()[0])
-    Format          = lines[8].split()[3]
-    scaleFactor     = [float(x) for x in lines[NCh+14:]]
 
-    if channels is None:
-        channels = {str(i):i for i in range(NCh)}
 
-    #read .bin file
-    data = {}
-    fid = open(filename + '.dat', 'rb')
-    for key, ch in channels.items():
-        fid.seek((ch-1)*NSc*2)
-        data[key] = np.fromfile(fid, 'int16', NSc) * scaleFactor[ch-1]
 
-    out = pd.DataFrame(data)
-    return out
 
+class Seed(object):
+    # the seed class should keep track of the htc file and result file of a
+    # single simulation. A seed is a light view of row i of the tag table of
+    # its case; the tags and paths are looked up when they are used.
+    # Seed(definition module, tag row), as in earlier versions, still gives
+    # a seed of its own which is not a view of a case.
+    __slots__ = ('case', 'i', '_tags', '_definition', '_channels')
+
+    def __init__(self, case, i):
+        if isinstance(case, Case):
+            self.case, self.i, self._tags, self._definition = case, i, None, None
+        else:
+            self.case, self.i, self._tags, self._definition = None, None, i, case
+        self._channels = None
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = self.case.tags.iloc[self.i]
+        return self._tags
+
+    @property
+    def definition(self):
+        return self.case.Def if self.case is not None else self._definition
+
+    @property
+    def channels(self):
+        if self.case is not None:
+            return self.case.channels
+        if self._channels is None:
+            self._channels = resolve({**getattr(self._definition, 'channels', {}),
+                                      **getattr(self._definition, 'derived', {})})
+        return self._channels
+
+    @property
+    def case_id(self):
+        if self.case is None:
+            return str(self._tags['case_id'])
+        return str(self.case._case_ids[self.i])
+
+    @property
+    def casename(self):
+        if self.case is None:
+            return str(self._tags['casename'])
+        return str(self.case._casenames[self.i])
+
+    @property
+    def htc(self):
+        return 'htc/' + self.casename + '/' + self.case_id + '.htc'
+
+    @property
+    def log(self):
+        return None
+
+    @property
+    def res(self):
+        return 'res/' + self.casename + '/' + self.case_id + '.sel'
+
+    @property
+    def postproc(self):
+        return 'postproc/' + self.casename + '/' + self.case_id
+
+
+    def open(self):
+        # returns a memory-mapped view of the result file.
+        return Hawc2Result(self.res[:-4])
+
+
+    def loadData(self, as_array=False, dtype=np.float64):
+        # loads the channels and derived channels given in the definition
+        # file. If as_array is True, a (time x channel) numpy array is
+        # returned instead of a dataframe. Raises an error if the result can
+        # not be loaded.
+        with self.open() as res:
+            raw = ResultArray.from_result(res, self.channels, dtype=dtype)
+        return raw.data if as_array else raw.to_frame()
 
 
+    def __repr__(self):
+        return('Seed {}'.format(self.case_id))
 
 
 
-class Seed(object):
-    # the seed class should keep track of the htc file and result file of a
-    # single simulation.
-    def __init__(self, definition, row):
-        self.tags = row
-        self.definition = definition
-        self.htc = 'htc/' + self.tags.casename + '/' + self.tags.case_id + '.htc'
-        self.log = None
-        self.res  = 'res/' + self.tags.casename + '/' + self.tags.case_id + '.sel'
-        self.postproc = 'postproc/' + self.tags.casename + '/' + self.tags.case_id
+class SeedList(Sequence):
+    # the seeds of a selection of rows of a case, as returned by
+    # Case.__call__. Only the row numbers are stored; a Seed is created when
+    # an item is accessed, so selecting is cheap also for large cases. Use
+    # list(...) for a list of Seeds.
+    __slots__ = ('case', 'rows')
 
+    def __init__(self, case, rows):
+        self.case = case
+        self.rows = rows
 
-    def loadData(self):
-        try:
-            data = readHawc2Res(self.res[:-4], self.definition.channels)
-        except:
-            print('error loading data ' + self.tags.case_id)
-            data = None
+    def __len__(self):
+        return len(self.rows)
 
-        return data
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return SeedList(self.case, self.rows[i])
+        return Seed(self.case, int(self.rows[i]))
 
+    def __iter__(self):
+        case = self.case
+        for i in self.rows.tolist():
+            yield Seed(case, i)
 
     def __repr__(self):
-        return('Seed {}'.format(self.tags.case_id))
+        return 'SeedList ({} seeds)'.format(len(self))
 
 
 
 class Case(object):
-    # a base class that holds the simulation definitions
+    # a base class that holds the simulation definitions. The tag table is
+    # the only per-simulation storage; Seeds are created when iterating or
+    # filtering.
     def __init__(self, definition):
 
         #self.Definition = self.add_definition(definition)
         self.Def = import_path(definition)
         self.tags = self.gen_tags(self.Def.Constants, self.Def.Variables, self.Def.Functions)
+        # the channels and derived channels of the definition, see
+        # hawcast.derived
+        self.channels = resolve({**getattr(self.Def, 'channels', {}), **getattr(self.Def, 'derived', {})})
 
-        self.seeds = []
-        for _, row in self.tags.iterrows():
-            self.seeds.append(Seed(self.Def, row))
+        self._casenames = self.tags['casename'].to_numpy()
+        self._case_ids = self.tags['case_id'].to_numpy()
+        # cached value-to-row maps of the tag columns, used for filtering
+        self.index = TagIndex(self.tags)
 
     def __repr__(self):
         return self.tags.__repr__()
 
+    def __len__(self):
+        return len(self.tags)
+
     def __iter__(self):
-            yield from self.seeds
+        for i in range(len(self.tags)):
+            yield Seed(self, i)
+
+    def __getitem__(self, i):
+        return Seed(self, range(len(self.tags))[i])
 
     def __call__(self, **kwargs):
-        mask = self.tags(**kwargs)
-        return [i for (i, v) in zip(self.seeds, mask) if v]
+        # the seeds matching kwargs (see TagIndex.mask) as a SeedList
+        return SeedList(self, np.flatnonzero(self.index.mask(**kwargs)))
+
+    @property
+    def seeds(self):
+        return list(self)
+
+
+    def paths(self, kind='res', **kwargs):
+        # the htc, res or postproc paths of the simulations matching kwargs
+        # as an array of strings, built column-wise.
+        prefix, suffix = {'htc': ('htc/', '.htc'), 'res': ('res/', '.sel'),
+                          'postproc': ('postproc/', '')}[kind]
+        tags = self.tags[self.index.mask(**kwargs)] if kwargs else self.tags
+        paths = prefix + tags['casename'].astype(str) + '/' + tags['case_id'].astype(str) + suffix
+        return paths.to_numpy()
 
 
 
     def iter_tags(self, **kwargs):
-        for _, tags in self.tags(**kwargs).iterrows():
+        for _, tags in self.tags[self.index.mask(**kwargs)].iterrows():
             yield tags
 
 
 
-    def iter_results(self, **kwargs):
-        for sim in self(**kwargs):
-            try:
-                res = sim.loadData()
-            except:
-                res = None
-            yield sim.tags, res
+    def iter_results(self, stats=None, cache=None, n_jobs=1, prefetch=0, errors='warn', **kwargs):
+        # yields the tags and results of the simulations matching kwargs. If
+        # stats is given (as in HAWC2DataFrame.wetb.compute), the statistics
+        # of the definition channels (and derived channels) are yielded as
+        # {label: values} instead of the time series, taken from the
+        # StatsCache cache where possible.
+        # With prefetch > 0 the next prefetch results are loaded in
+        # background threads. Results which can not be loaded are yielded as
+        # None with a message, or raise their error if errors is 'raise'.
+        if stats is None:
+            for sim, res, error in _prefetch(Seed.loadData, self(**kwargs), prefetch):
+                if error is not None:
+                    if errors == 'raise':
+                        raise error
+                    print(f'error loading data {sim.tags.case_id}: {type(error).__name__}: {error}')
+                yield sim.tags, res
+            return
+
+        from .postproc import wetbAccessor, reduce_files
+        reducers = wetbAccessor.reducers(stats)
+        labels = [x for label, *_ in reducers
+                  for x in (label if isinstance(label, tuple) else (label,))]
+        sims = self(**kwargs)
+        tasks = [(sim.res[:-4], None, self.channels) for sim in sims]
+        results = reduce_files(tasks, reducers, n_jobs=n_jobs, cache=cache)
+        for sim, (values, error) in zip(sims, results):
+            if error is not None:
+                if errors == 'raise':
+                    raise IOError(f'{sim.res}: {error}')
+                print(f'error loading data {sim.tags.case_id}: {error}')
+                yield sim.tags, None
+            else:
+                yield sim.tags, dict(zip(labels, values))
 
 
 
     def gen_tags(self, Consts, Vars, Funcs):
 
     # number of combinations:
-        self.N = 1
-        for n in [len(x) for x in Vars.values()]:
-            self.N *= n
+        self.N = n_combinations(Vars)
     # number of attributes:
         attributes = list(Consts.keys()) + list(Vars.keys()) + list(Funcs.keys())
         self.M = len(attributes)
 
     # generate a Pandas dataframe where each row has one of the combinations
     # of simulation tags
-        manifest = []
-        for v in product(*list(Vars.values())):
-            v_dict = dict(zip(Vars.keys(), v))
-            this_dict = {**Consts, **v_dict}
-
-            for key, f in Funcs.items():
-
-                this_dict[key] = f(this_dict)
-
-            manifest.append(list(this_dict.values()))
-
-        return myDataFrame(manifest, columns=attributes)
-
+        return tag_table(Consts, Vars, Funcs)
 
 
+    def iter_tag_chunks(self, chunksize=100000):
+        # yields the tag table in chunks of chunksize rows without building
+        # the full table.
+        yield from iter_tag_tables(self.Def.Constants, self.Def.Variables,
+                                   self.Def.Functions, chunksize)
 
 
 
-def generate_model_zip(zipfilename):
-    zipf = zipfile.ZipFile(zipfilename, 'w', zipfile.ZIP_DEFLATED)
-    for root, dirs, files in os.walk('control'):
-        for file in files:
-            zipf.write(os.path.join(root, file))
 
-    for root, dirs, files in os.walk('data'):
-        for file in files:
-            zipf.write(os.path.join(root, file))
-    zipf.close()
 
 
-def htc2pbs(htc_fn, pbs_template_fn):
-    """
-    Creates a PBS launch file (.p) based on a HAWC2 .htc file.
-    - Assumes htc files are within a htc/[casename]/ directory relative to current directory.
-    - Assumes there is a .zip file in the current directory which contains the turbine model.
-      If there is none, the zip file is set to 'model.zip' by default
-    - Will place a .p fine in pbs_in/[casename]/ directory relative to current directory.
-    -
-
-    Parameters
-    ----------
-    htc_fn : str
-        The file name and path to the .htc file
-    pbs_template_fn : str
-        The filename and path to the template .p file
-
-
-    Returns
-    -------
-    str
-        The filename and path to the output .p file
-
-    Raises
-    ------
-    FileNotFoundError: If the file structure is not correct.
-    """
-
-
-
-    basename = os.path.relpath(os.path.dirname(htc_fn), 'htc')
-    jobname = os.path.splitext(os.path.basename(htc_fn))[0]
-    pbs_in_dir = os.path.join('pbs_in', basename)
-    if basename == '.':
-        raise FileNotFoundError('File structure is incorrect.')
-
-
-    try:
-        zipfile = [x for x in os.listdir() if x.lower().endswith('.zip')][0]
-    except:
-        print('No .zip file found in current directory. Set model zip to \'model.zip\'')
-        zipfile = 'model.zip'
-
-    #   get the required parameters for the pbs file from the htc file
-    htc = HTCFile(htc_fn) #modelpath='../..')
-    p = {
-        'walltime'      : '00:40:00',
-        'modelzip'      : zipfile,
-        'jobname'       : jobname,
-        'htcdir'        : 'htc/' + basename,
-        'logdir'        :  os.path.dirname(htc.simulation.logfile.str_values())[2:] + '/',
-        'resdir'        : os.path.dirname(htc.output.filename.str_values())[2:] + '/',
-        'turbdir'       : os.path.dirname(htc.wind.mann.filename_u.str_values()) + '/',
-        'turbfileroot'  : os.path.basename(htc.wind.mann.filename_u.str_values()).split('u.')[0],
-        'pbsoutdir'     : 'pbs_out/' + basename
-        }
-
-
-    #Write pbs file based on template file and tags
-    if not os.path.exists(pbs_in_dir):
-        os.makedirs(pbs_in_dir)
-
-    with open(pbs_template_fn) as f:
-        template = f.read()
-
-    for key, value in p.items():
-        template = template.replace('[' + key + ']', value)
-
-    with open(os.path.join(pbs_in_dir, jobname + '.p'), 'w') as f:
-        f.write(template)
-        #print('{}.p created.'.format(jobname))
@@ -0,0 +1,177 @@
+'''
+A columnar store of converted HAWC2 time series.
+
+HAWC2 writes one .sel/.dat pair per simulation, so reading a few channels of
+every simulation in a campaign means opening thousands of files and seeking
+into each of them. The store keeps each channel of all simulations in one
+contiguous file, store/ch{channel}.bin, with the simulations one after the
+other, and a manifest.json holding the simulation names, their number of
+samples and the scale factors. Reading a channel of the whole campaign is
+then a single sequential read.
+
+By default the raw int16 samples are stored along with the scale factors, as
+in the .dat files. Give a float dtype to store the scaled values instead.
+Converting more results into an existing store appends them as a new chunk;
+simulations already in the store are skipped.
+'''
+import os
+import json
+import numpy as np
+
+from .reader import Hawc2Result, read_sel
+
+
+MANIFEST = 'manifest.json'
+
+
+class ColumnarStore(object):
+    '''
+    A channel-major store of many HAWC2 results.
+
+    example:
+        store = convert_results(filenames, 'postproc/dlc12_store', channels=[10, 26, 27])
+        Mx = store.channel(26)                 # all simulations, one read
+        x = store.read('dlc12_wsp10_s1001', {'Mx1': 26, 'My1': 27})
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.dtype = np.dtype(manifest['dtype'])
+        self.channels = manifest['channels']
+        self.names = manifest['names']
+        self.NSc = np.array(manifest['NSc'], dtype=np.int64)
+        # scale factors, (simulation x stored channel), only for int16 stores
+        self.scale_factors = np.array(manifest['scale_factors'], dtype=np.float64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.NSc)])
+        self._position = {name: i for i, name in enumerate(self.names)}
+        self._column = {ch: i for i, ch in enumerate(self.channels)}
+
+
+    def __repr__(self):
+        return 'ColumnarStore {} ({} results, {} channels)'.format(
+            self.path, len(self.names), len(self.channels))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._position
+
+
+    def _file(self, ch):
+        return os.path.join(self.path, f'ch{ch}.bin')
+
+
+    def raw(self, ch):
+        '''
+        Returns a memory-mapped view of the stored samples of a channel for
+        all simulations.
+        '''
+        if ch not in self._column:
+            raise KeyError(f'Channel {ch} is not in the store.')
+        if self.offsets[-1] == 0:
+            return np.empty(0, self.dtype)
+        return np.memmap(self._file(ch), dtype=self.dtype, mode='r', shape=(int(self.offsets[-1]),))
+
+
+    def channel(self, ch, dtype=np.float64):
+        '''
+        Returns the scaled values of a channel for all simulations as one
+        array. Simulation i spans offsets[i]:offsets[i+1].
+        '''
+        raw = self.raw(ch)
+        if self.dtype != np.int16:
+            return np.asarray(raw, dtype=dtype)
+        scale = np.repeat(self.scale_factors[:, self._column[ch]], self.NSc)
+        out = np.asarray(raw, dtype=dtype)
+        out *= scale
+        return out
+
+
+    def split(self, ch, dtype=np.float64):
+        '''
+        Returns a list with the scaled values of a channel per simulation.
+        '''
+        return np.split(self.channel(ch, dtype), self.offsets[1:-1])
+
+
+    def read(self, name, channels=None, dtype=np.float64):
+        '''
+        Returns a (time x channel) array of a single simulation. channels is a
+        dictionary of {name: channel number} or a list of channel numbers, by
+        default all stored channels.
+        '''
+        channels = self.channels if channels is None else channels
+        if isinstance(channels, dict):
+            channels = list(channels.values())
+        i = self._position[name]
+        a, b = self.offsets[i], self.offsets[i+1]
+        out = np.empty((b - a, len(channels)), dtype=dtype)
+        for j, ch in enumerate(channels):
+            out[:, j] = self.raw(ch)[a:b]
+            if self.dtype == np.int16:
+                out[:, j] *= self.scale_factors[i, self._column[ch]]
+        return out
+
+
+
+def convert_results(filenames, path, channels=None, dtype=None):
+    '''
+    Converts HAWC2 binary results (given without extension) into the
+    columnar store at path and returns the ColumnarStore. channels is a list
+    of channel numbers, by default all channels of the first result. If dtype
+    is None the raw int16 samples are stored with their scale factors,
+    otherwise the scaled values are stored with the given dtype. Results
+    already in the store are skipped.
+    '''
+    os.makedirs(path, exist_ok=True)
+    try:
+        store = ColumnarStore(path)
+        manifest = {'dtype': store.dtype.str, 'channels': store.channels, 'names': store.names,
+                    'NSc': store.NSc.tolist(), 'scale_factors': store.scale_factors.tolist()}
+        if dtype is not None and np.dtype(dtype) != store.dtype:
+            raise ValueError(f'Store {path} holds {store.dtype} samples, not {np.dtype(dtype)}.')
+        if channels is not None and list(channels) != store.channels:
+            raise ValueError(f'Store {path} holds channels {store.channels}.')
+    except FileNotFoundError:
+        if channels is None:
+            channels = list(range(1, read_sel(filenames[0]).NCh + 1))
+        manifest = {'dtype': np.dtype(dtype or np.int16).str, 'channels': list(channels),
+                    'names': [], 'NSc': [], 'scale_factors': []}
+    channels = manifest['channels']
+    dtype = np.dtype(manifest['dtype'])
+    total = sum(manifest['NSc'])
+    existing = set(manifest['names'])
+
+    # data written after the last complete conversion is discarded
+    files = []
+    for ch in channels:
+        f = open(os.path.join(path, f'ch{ch}.bin'), 'ab')
+        f.truncate(total * dtype.itemsize)
+        files.append(f)
+    try:
+        for filename in filenames:
+            name = os.path.basename(filename)
+            if name in existing:
+                continue
+            with Hawc2Result(filename) as res:
+                if res.header.NCh < max(channels):
+                    raise ValueError(f'{filename} has {res.header.NCh} channels.')
+                for f, ch in zip(files, channels):
+                    if dtype == np.int16:
+                        res[ch].tofile(f)
+                    else:
+                        res.channel(ch, dtype=dtype).tofile(f)
+                manifest['names'].append(name)
+                manifest['NSc'].append(res.header.NSc)
+                if dtype == np.int16:
+                    manifest['scale_factors'].append([float(res.header.scale_factors[ch-1]) for ch in channels])
+            existing.add(name)
+    finally:
+        for f in files:
+            f.close()
+        with open(os.path.join(path, MANIFEST + '.tmp'), 'w') as f:
+            json.dump(manifest, f)
+        os.replace(os.path.join(path, MANIFEST + '.tmp'), os.path.join(path, MANIFEST))
+    return ColumnarStore(path)
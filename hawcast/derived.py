@@ -0,0 +1,380 @@
+'''
+Derived channels and a NumPy-native result object.
+
+Derived channels are declared in a definition module next to the channels,
+
+    from hawcast.derived import hypot, mbc, lowpass, scale
+    channels = {'azi': 2, 'My1': 26, 'My2': 29, 'My3': 32, 'Mx1': 25, 'P': 100}
+    derived = {'Mres1': hypot('Mx1', 'My1'),
+               'Mtilt': mbc('My1', 'My2', 'My3', azimuth='azi', component='cos'),
+               'Mres1_lp': lowpass('Mres1', cutoff=0.5),
+               'P_MW': scale('P', 1e-6)}
+
+and used wherever channels are given, e.g. HAWC2DataFrame(channels={**channels,
+**derived}). Sources are channel names (raw or derived) or channel numbers.
+ResultArray reads all source channels of a file in a single (time x
+channel) array, then evaluates the derived channels level by level (a
+derived channel after its sources), where all derived channels of the same
+kind and parameters are evaluated in one vectorised operation over the
+columns of the array. Only the channels needed are read from disk.
+'''
+import copy
+import importlib
+import numpy as np
+
+from .reader import Hawc2Result
+
+
+class Derived(object):
+    '''
+    Base class of derived channels. sources are channel names, numbers or
+    derived channels, and params are the parameters of the operation.
+    Subclasses implement evaluate, which receives one (time x n) array per
+    source, holding the sources of n derived channels of the same kind and
+    parameters, and returns a (time x n) array.
+    '''
+    # whether the value at a time step only depends on the sources at that
+    # time step, which allows evaluation on blocks of a streamed file
+    pointwise = True
+
+    def __init__(self, *sources, **params):
+        self.sources = sources
+        self.params = params
+
+
+    @property
+    def key(self):
+        # identifies the definition also across processes, e.g. in cache
+        # keys. Functions are identified by their qualified name, which expr
+        # makes sure is unique.
+        params = tuple((k, f'{v.__module__}.{v.__qualname__}' if callable(v) else v)
+                       for k, v in sorted(self.params.items()))
+        sources = tuple(s.key if isinstance(s, Derived) else s for s in self.sources)
+        return (type(self).__name__, sources, params)
+
+    @property
+    def _identity(self):
+        # as key, but with the function objects themselves, for comparisons
+        # within a process
+        sources = tuple(s._identity if isinstance(s, Derived) else s for s in self.sources)
+        return (type(self), sources, tuple(sorted(self.params.items())))
+
+    def __eq__(self, other):
+        return isinstance(other, Derived) and self._identity == other._identity
+
+    def __hash__(self):
+        return hash(self._identity)
+
+    def __repr__(self):
+        args = [repr(s) for s in self.sources] + [f'{k}={v!r}' for k, v in self.params.items()]
+        return '{}({})'.format(type(self).__name__.lower(), ', '.join(args))
+
+
+    def numbers(self):
+        # the raw channel numbers the channel depends on
+        out = []
+        for s in self.sources:
+            out.extend(s.numbers() if isinstance(s, Derived) else [s])
+        return out
+
+
+    @staticmethod
+    def evaluate(inputs, fs, **params):
+        raise NotImplementedError
+
+
+
+class Hypot(Derived):
+    @staticmethod
+    def evaluate(inputs, fs):
+        return np.sqrt(sum(x * x for x in inputs))
+
+
+class Scale(Derived):
+    @staticmethod
+    def evaluate(inputs, fs, factor=1.0, offset=0.0):
+        return inputs[0] * factor + offset
+
+
+class MBC(Derived):
+    @staticmethod
+    def evaluate(inputs, fs, component='cos', offset=0.0, deg=True):
+        *blades, azimuth = inputs
+        if component == 'collective':
+            return sum(blades) / 3
+        psi = np.radians(azimuth + offset) if deg else azimuth + offset
+        trig = {'cos': np.cos, 'sin': np.sin}[component]
+        return 2 / 3 * sum(x * trig(psi + 2 * np.pi * k / 3) for k, x in enumerate(blades))
+
+
+class LowPass(Derived):
+    pointwise = False
+
+    @staticmethod
+    def evaluate(inputs, fs, cutoff, order=4):
+        from scipy import signal
+        sos = signal.butter(order, cutoff, fs=fs, output='sos')
+        return signal.sosfiltfilt(sos, inputs[0], axis=0)
+
+
+class Expr(Derived):
+    @staticmethod
+    def evaluate(inputs, fs, func):
+        return func(*inputs)
+
+
+
+def hypot(*sources):
+    '''
+    The resultant of the sources, sqrt(x1**2 + x2**2 + ...), e.g. the
+    resultant blade root moment hypot('Mx1', 'My1').
+    '''
+    return Hypot(*sources)
+
+
+def scale(source, factor=1.0, offset=0.0):
+    '''
+    source * factor + offset, e.g. a unit conversion.
+    '''
+    return Scale(source, factor=factor, offset=offset)
+
+
+def mbc(blade1, blade2, blade3, azimuth, component='cos', offset=0.0, deg=True):
+    '''
+    A component of the multi-blade coordinate (Coleman) transform of a
+    quantity given for the three blades: 'collective' (the mean), 'cos' or
+    'sin', 2/3 sum(x_k cos(psi_k)) (and sin), where blade k is at azimuth
+    psi_k = azimuth + offset + (k - 1) * 120 deg. With deg False, azimuth and
+    offset are in radians.
+    '''
+    if component not in ('collective', 'cos', 'sin'):
+        raise ValueError(f'Unknown MBC component {component}.')
+    return MBC(blade1, blade2, blade3, azimuth, component=component, offset=offset, deg=deg)
+
+
+def lowpass(source, cutoff, order=4):
+    '''
+    The source filtered forwards and backwards (zero phase) by a Butterworth
+    low-pass filter of the given order and cutoff frequency in Hz.
+    '''
+    return LowPass(source, cutoff=cutoff, order=order)
+
+
+def expr(func, *sources):
+    '''
+    A vectorised function of the sources, func(x1, x2, ...), which receives
+    (time x n) arrays and returns a (time x n) array. func must be a
+    function defined at module level (not a lambda or a nested function), as
+    it is identified by its qualified name in cache keys and sent by name to
+    worker processes.
+    '''
+    name = getattr(func, '__qualname__', None)
+    if name is None or '<lambda>' in name or '<locals>' in name:
+        raise ValueError(f'expr needs a function defined at module level, not {func!r}.')
+    return Expr(*sources, func=func)
+
+
+
+_kinds = {cls.__name__.lower(): cls for cls in (Hypot, Scale, MBC, LowPass, Expr)}
+
+def to_json(value):
+    '''
+    A JSON serialisable form of a channel number or resolved derived
+    channel, e.g. {'kind': 'hypot', 'sources': [5, 2], 'params': {}}, as
+    stored with saved tables. Functions of expr are stored by name.
+    '''
+    if not isinstance(value, Derived):
+        return value
+    params = {k: {'function': f'{v.__module__}:{v.__qualname__}'} if callable(v) else v
+              for k, v in value.params.items()}
+    return {'kind': type(value).__name__.lower(), 'sources': [to_json(x) for x in value.sources],
+            'params': params}
+
+
+def from_json(value):
+    '''
+    The channel number or derived channel of to_json(value).
+    '''
+    if not isinstance(value, dict):
+        return value
+    params = {}
+    for k, v in value['params'].items():
+        if isinstance(v, dict) and 'function' in v:
+            module, qualname = v['function'].split(':')
+            v = importlib.import_module(module)
+            for name in qualname.split('.'):
+                v = getattr(v, name)
+        params[k] = v
+    return _kinds[value['kind']](*[from_json(x) for x in value['sources']], **params)
+
+
+
+def resolve(channels):
+    '''
+    Returns a copy of channels, {name: channel number or derived channel},
+    in which the source names of derived channels are replaced by channel
+    numbers and derived channels, so that each channel can be evaluated on
+    its own. Raises a KeyError for unknown sources and a ValueError for
+    circular definitions.
+    '''
+    def bind(value, seen):
+        if not isinstance(value, Derived):
+            return value
+        out = copy.copy(value)
+        out.sources = tuple(source(s, seen) for s in value.sources)
+        return out
+
+    def source(s, seen):
+        if not isinstance(s, str):
+            return bind(s, seen)
+        if s in seen:
+            raise ValueError(f'Derived channel {s} depends on itself.')
+        if s not in channels:
+            raise KeyError(f'Unknown source channel {s}.')
+        return bind(channels[s], seen | {s})
+
+    return {name: bind(value, {name}) for name, value in channels.items()}
+
+
+def plan(channels):
+    '''
+    Returns the channel numbers to read and the derived channels of
+    resolved channels, grouped in levels which only depend on the channels
+    read and the levels before.
+    '''
+    numbers, levels = {}, []
+    def visit(x):
+        if not isinstance(x, Derived):
+            if isinstance(x, str):
+                raise ValueError(f'Source channel {x} is not resolved.')
+            numbers[int(x)] = None
+            return 0
+        depth = 1 + max(visit(s) for s in x.sources)
+        while len(levels) < depth:
+            levels.append({})
+        levels[depth - 1][x] = None
+        return depth
+    for value in channels.values():
+        visit(value)
+    return list(numbers), [list(level) for level in levels]
+
+
+def evaluate(data, numbers, levels, fs):
+    '''
+    Evaluates the derived channels of plan on data, a (time x channel)
+    array of the channels numbers. Returns {channel number or derived
+    channel: column}.
+    '''
+    columns = {n: data[:, i] for i, n in enumerate(numbers)}
+    for level in levels:
+        groups = {}
+        for x in level:
+            groups.setdefault((type(x), tuple(sorted(x.params.items())), len(x.sources)), []).append(x)
+        for (kind, _, n_sources), group in groups.items():
+            inputs = [np.column_stack([columns[x.sources[j]] for x in group]) for j in range(n_sources)]
+            out = kind.evaluate(inputs, fs, **group[0].params)
+            for k, x in enumerate(group):
+                columns[x] = out[:, k]
+    return columns
+
+
+def _assemble(columns, channels, dtype):
+    out = np.empty((len(next(iter(columns.values()))), len(channels)), dtype=dtype)
+    for j, value in enumerate(channels.values()):
+        out[:, j] = columns[value if isinstance(value, Derived) else int(value)]
+    return out
+
+
+def _has_derived(channels):
+    return channels is not None and any(isinstance(x, Derived) for x in channels.values())
+
+
+def iter_blocks(res, channels, blocksize=60000, dtype=np.float64):
+    '''
+    Yields consecutive (time x channel) blocks of an open Hawc2Result as
+    Hawc2Result.iter_blocks, including resolved derived channels. Raises a
+    ValueError if a derived channel can not be evaluated block by block.
+    '''
+    if not _has_derived(channels):
+        yield from res.iter_blocks(channels, blocksize, dtype)
+        return
+    numbers, levels = plan(channels)
+    for level in levels:
+        for x in level:
+            if not x.pointwise:
+                raise ValueError(f'Derived channel {x} can not be computed in streaming mode.')
+    fs = res.header.NSc / res.header.Time
+    for block in res.iter_blocks(numbers, blocksize):
+        yield _assemble(evaluate(block, numbers, levels, fs), channels, dtype)
+
+
+
+class ResultArray(object):
+    '''
+    The channels of a single result file as a (time x channel) array, with
+    the channel names. Columns are accessed by name, res['Mres1'], or as a
+    2D array, res[['Mx1', 'My1']].
+
+    example:
+        res = ResultArray.load('res/dlc12/dlc12_wsp10_s1001', {**channels, **derived})
+    '''
+    def __init__(self, data, names, fs=None):
+        self.data = data
+        self.names = list(names)
+        self.fs = fs
+        self._column = {name: j for j, name in enumerate(self.names)}
+
+
+    def __repr__(self):
+        return 'ResultArray ({} scans, {} channels)'.format(*self.data.shape)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+
+    def __getitem__(self, name):
+        if isinstance(name, (list, tuple)):
+            return self.data[:, [self._column[x] for x in name]]
+        return self.data[:, self._column[name]]
+
+
+    def to_frame(self):
+        # a pandas dataframe with one column per channel
+        import pandas as pd
+        return pd.DataFrame(self.data, columns=self.names)
+
+
+    @classmethod
+    def from_result(cls, res, channels=None, dtype=np.float64, fs=None):
+        '''
+        Reads the channels of an open Hawc2Result. channels is {name:
+        channel number or derived channel}, with derived channels as
+        returned by resolve, or None for all channels. fs (for filters)
+        defaults to the sample rate of the .sel header.
+        '''
+        if channels is None:
+            channels = {str(i): i for i in range(1, res.header.NCh + 1)}
+        if fs is None and res.header.Time > 0:
+            fs = res.header.NSc / res.header.Time
+        if not _has_derived(channels):
+            return cls(res.read(channels, dtype=dtype), channels, fs)
+
+        numbers, levels = plan(channels)
+        columns = evaluate(res.read(numbers), numbers, levels, fs)
+        return cls(_assemble(columns, channels, dtype), channels, fs)
+
+
+    @classmethod
+    def load(cls, filename, channels=None, header=None, dtype=np.float64, fs=None):
+        '''
+        Reads the channels of a result file, given without extension, see
+        from_result. Names of derived channel sources are resolved.
+        '''
+        if _has_derived(channels):
+            channels = resolve(channels)
+        with Hawc2Result(filename, header) as res:
+            return cls.from_result(res, channels, dtype, fs)
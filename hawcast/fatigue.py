@@ -0,0 +1,268 @@
+'''
+Batched fatigue calculations on (time x channel) arrays.
+
+The rainflow counting is the Windap method used by wetb.fatigue_tools
+(signal discretised into 255 levels, half cycles below a threshold ignored),
+so the equivalent loads agree with wetb's eq_load. Unlike eq_load, each
+channel is rainflow counted once, after which equivalent loads for any number
+of Woehler exponents and equivalent cycle counts are computed from the cycle
+histogram.
+'''
+import warnings
+from collections import namedtuple
+import numpy as np
+
+
+CycleHistogram = namedtuple('CycleHistogram', ['cycles', 'ampl_bin_mean', 'ampl_edges'])
+
+
+def turning_points(x):
+    '''
+    Reduces a 1d signal to its first point, its local extrema and its last
+    point. Rainflow counting of the reduced signal is identical to counting
+    the full signal.
+    '''
+    x = np.asarray(x)
+    if len(x) < 3:
+        return x.copy()
+    # remove plateaus, then keep the points where the slope changes sign
+    y = x[np.r_[0, np.flatnonzero(np.diff(x)) + 1]]
+    if len(y) < 3:
+        return y
+    d = np.diff(y)
+    extrema = np.flatnonzero(d[:-1] * d[1:] < 0) + 1
+    return y[np.r_[0, extrema, len(y) - 1]]
+
+
+def rainflow(x, levels=255., threshold=255/50):
+    '''
+    Windap rainflow counting of each channel of a (time x channel) array.
+    The discretisation of the signals is done for all channels at once.
+    Returns a list with one (ampl, mean) pair of half cycle arrays per
+    channel. Channels without variation give empty arrays.
+    '''
+    from wetb.fatigue_tools.rainflowcounting import peak_trough, pair_range
+    x = np.asarray(x, dtype=np.float64)
+    x = x.reshape(len(x), -1)
+    offset = np.nanmin(x, axis=0)
+    span = np.nanmax(x, axis=0) - offset
+    gain = np.where(span > 0, span, 1) / levels
+    levelled = np.round((x - offset) / gain).astype(int)
+
+    out = []
+    for i in range(x.shape[1]):
+        if not span[i] > 0:
+            out.append((np.empty(0), np.empty(0)))
+            continue
+        sig_ext = peak_trough.peak_trough(np.ascontiguousarray(levelled[:, i]), threshold)
+        ampl_mean = np.array(pair_range.pair_range_amplitude_mean(sig_ext), dtype=np.float64)
+        if len(ampl_mean) == 0:
+            out.append((np.empty(0), np.empty(0)))
+            continue
+        ampl_mean = np.round(ampl_mean / threshold) * gain[i] * threshold
+        ampl_mean[:, 1] += offset[i]
+        out.append((ampl_mean[:, 0], ampl_mean[:, 1]))
+    return out
+
+
+def cycle_histogram(ampl, no_bins=46, counts=None):
+    '''
+    Bins half cycle amplitudes into no_bins equally wide amplitude bins
+    between zero and the largest amplitude. Returns a CycleHistogram with
+    the number of full cycles and the mean amplitude of each bin. If counts
+    is given, ampl are distinct amplitudes and counts their numbers of half
+    cycles.
+    '''
+    if counts is not None:
+        ampl, counts = ampl[counts > 0], counts[counts > 0]
+    if len(ampl) == 0:
+        return CycleHistogram(np.zeros(no_bins), np.full(no_bins, np.nan), np.zeros(no_bins + 1))
+    edges = np.linspace(0, 1, num=no_bins + 1) * ampl.max()
+    count, _ = np.histogram(ampl, edges, weights=counts)
+    total, _ = np.histogram(ampl, edges, weights=ampl if counts is None else ampl * counts)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        ampl_bin_mean = total / np.where(count, count, np.nan)
+    return CycleHistogram(count / 2, ampl_bin_mean, edges)
+
+
+def _peak_trough_step(x, R, state, out):
+    # the peak-trough filter of wetb's peak_trough, resumable between
+    # blocks. state is [zone, peak, trough], zone 0 before the first extremum
+    # and 1 (2) while looking for a trough (peak). The confirmed extrema are
+    # written to out, and their number is returned.
+    zone, peak, trough = state[0], state[1], state[2]
+    n = 0
+    for v in x:
+        if zone == 0:
+            if v > peak:
+                peak = v
+                if peak - trough >= R:
+                    out[n] = trough
+                    n += 1
+                    zone = 2
+            elif v < trough:
+                trough = v
+                if peak - trough >= R:
+                    out[n] = peak
+                    n += 1
+                    zone = 1
+        elif zone == 1:
+            if v < trough:
+                trough = v
+            elif v - trough >= R:
+                out[n] = trough
+                n += 1
+                peak = v
+                zone = 2
+        else:
+            if v > peak:
+                peak = v
+            elif peak - v >= R:
+                out[n] = peak
+                n += 1
+                trough = v
+                zone = 1
+    state[0], state[1], state[2] = zone, peak, trough
+    return n
+
+
+def _pair_range_step(x, S, p, counts):
+    # pushes the extrema x on the residue stack S[:p] of wetb's pair range
+    # counting. Closed cycles are removed from the stack and counted as two
+    # half cycles of their (integer) amplitude in counts. Returns the new
+    # stack size.
+    for v in x:
+        S[p] = v
+        p += 1
+        while p >= 4:
+            a, b, c, d = S[p - 4], S[p - 3], S[p - 2], S[p - 1]
+            if (b > a and c >= a and d >= b) or (b < a and c <= a and d <= b):
+                counts[int(abs(b - c))] += 2
+                S[p - 3] = d
+                p -= 2
+            else:
+                break
+    return p
+
+
+_kernels = None
+
+def streaming_kernels():
+    '''
+    Returns _peak_trough_step and _pair_range_step compiled with numba (a
+    dependency of wetb), which is done on first use.
+    '''
+    global _kernels
+    if _kernels is None:
+        from numba import njit
+        _kernels = njit(_peak_trough_step), njit(_pair_range_step)
+    return _kernels
+
+
+
+class StreamingRainflow(object):
+    '''
+    The rainflow counting of rainflow, for a signal given in consecutive
+    blocks. The signal range must be known in advance, as it sets the
+    discretisation. Only the state of the peak-trough filter, the residue of
+    the pair range counting and the number of half cycles of each of the
+    levels+1 possible amplitudes are kept, so memory does not grow with the
+    length of the signal. The histogram equals that of the full signal.
+    '''
+    def __init__(self, minimum, maximum, levels=255, threshold=255/50):
+        self.offset = minimum
+        self.span = maximum - minimum
+        self.gain = (self.span if self.span > 0 else 1) / levels
+        self.threshold = threshold
+        self.counts = np.zeros(int(levels) + 1)
+        self._state = None
+        self._stack = np.empty(2 * int(levels) + 8)
+        self._p = 0
+
+
+    def update(self, x):
+        if not self.span > 0 or len(x) == 0:
+            return
+        peak_trough, pair_range = streaming_kernels()
+        levelled = np.round((np.asarray(x, dtype=np.float64) - self.offset) / self.gain)
+        if self._state is None:
+            self._state = np.array([0., levelled[0], levelled[0]])
+        extrema = np.empty(len(levelled))
+        n = peak_trough(levelled, self.threshold, self._state, extrema)
+        self._push(extrema[:n])
+
+
+    def _push(self, extrema):
+        _, pair_range = streaming_kernels()
+        if len(self._stack) < self._p + len(extrema):
+            self._stack = np.concatenate([self._stack, np.empty(len(extrema))])
+        self._p = pair_range(extrema, self._stack, self._p, self.counts)
+
+
+    def histogram(self, no_bins=46):
+        '''
+        Returns the CycleHistogram of the signal so far, which is then ended.
+        '''
+        if self._state is not None:
+            zone, peak, trough = self._state
+            last = {0: (trough + peak) / 2, 1: trough, 2: peak}[int(zone)]
+            self._push(np.array([last]))
+            self._state = None
+            residue = self._stack[:self._p]
+            for a in np.abs(np.diff(residue)).astype(int):
+                self.counts[a] += 1
+            self._p = 0
+        ampl = np.round(np.arange(len(self.counts)) / self.threshold) * self.gain * self.threshold
+        return cycle_histogram(ampl, no_bins, self.counts)
+
+
+
+def equivalent_load_from_cycles(histograms, m, neq=1, weights=None):
+    '''
+    Equivalent loads from one or more cycle histograms. If several
+    histograms are given, their damage is summed with the given weights
+    (e.g. the probability of each wind speed) to give a lifetime equivalent
+    load. Returns an array of shape (len(neq), len(m)).
+    '''
+    if isinstance(histograms, CycleHistogram):
+        histograms = [histograms]
+    weights = np.ones(len(histograms)) if weights is None else np.asarray(weights, dtype=float)
+    m = np.atleast_1d(np.asarray(m, dtype=float))
+    neq = np.atleast_1d(np.asarray(neq, dtype=float))
+
+    damage = np.zeros(len(m))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for w, h in zip(weights, histograms):
+            damage += w * np.nansum(h.cycles * h.ampl_bin_mean ** m[:, None], axis=1)
+        return (damage[None, :] / neq[:, None]) ** (1 / m[None, :])
+
+
+def equivalent_loads(x, m=(3, 4, 6, 8, 10, 12), neq=1, no_bins=46, return_cycles=False):
+    '''
+    Damage equivalent loads of every channel of a (time x channel) array for
+    all combinations of Woehler exponents m and equivalent cycle counts neq.
+    Each channel is rainflow counted once.
+
+    Returns an array of shape (len(neq), len(m), channels), and if
+    return_cycles is True, also the list of CycleHistogram of each channel,
+    which can be passed to equivalent_load_from_cycles later. Channels
+    without variation give NaN, as in wetb's eq_load.
+    '''
+    x = np.asarray(x)
+    x = x.reshape(len(x), -1)
+    m = np.atleast_1d(m)
+    neq = np.atleast_1d(neq)
+
+    dels = np.full((len(neq), len(m), x.shape[1]), np.nan)
+    histograms = []
+    for i, (ampl, _) in enumerate(rainflow(x)):
+        h = cycle_histogram(ampl, no_bins)
+        histograms.append(h)
+        if len(ampl):
+            dels[:, :, i] = equivalent_load_from_cycles(h, m, neq)
+
+    if return_cycles:
+        return dels, histograms
+    return dels
@@ -0,0 +1,108 @@
+'''
+Vectorised filtering of tag tables.
+
+Filters are given as keyword arguments, one per column:
+    scalar         rows equal to the value,             wsp=12
+    list/array     rows equal to any of the values,     wsp=[10, 12, 14]
+    slice          rows within an inclusive range,      wsp=slice(10, 14)
+    callable       rows for which it returns True,      yaw=lambda x: abs(x) > 5
+'''
+import numpy as np
+import pandas as pd
+
+
+def column(df, key):
+    # the values of a tag column. Tag columns of a HAWC2DataFrame are
+    # labelled (key, '').
+    if isinstance(df.columns, pd.MultiIndex) and not isinstance(key, tuple):
+        key = (key, '')
+    return df[key]
+
+
+def condition(col, value):
+    '''
+    Returns a boolean array of the rows of the series col which satisfy a
+    single filter value.
+    '''
+    if isinstance(value, slice):
+        out = np.ones(len(col), dtype=bool)
+        if value.start is not None:
+            out &= (col >= value.start).to_numpy()
+        if value.stop is not None:
+            out &= (col <= value.stop).to_numpy()
+        return out
+    elif callable(value):
+        return np.asarray(value(col), dtype=bool)
+    elif isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+        return col.isin(list(value)).to_numpy()
+    return (col == value).to_numpy()
+
+
+def mask(df, **kwargs):
+    '''
+    Returns a boolean numpy array of the rows of df which satisfy all
+    filters.
+    example: mask(dlc, wsp=[12, 14], controller='noIPC')
+    '''
+    out = np.ones(len(df), dtype=bool)
+    for key, value in kwargs.items():
+        out &= condition(column(df, key), value)
+    return out
+
+
+
+class TagIndex(object):
+    '''
+    Cached value-to-row maps of the columns of a tag table. Equality and
+    membership filters on an indexed column are answered by looking up the
+    rows of each value instead of comparing the whole column. Maps are built
+    the first time a column is filtered. Columns (or filter values) which
+    are not hashable, e.g. lists, are filtered by comparison as in mask. The
+    table must not be modified after the index is created.
+    '''
+    def __init__(self, df):
+        self._df = df
+        self._rows = {}
+
+
+    def rows(self, key, values):
+        '''
+        Returns the sorted row positions in which column key takes any of the
+        given values. Raises a TypeError if the column or a value is not
+        hashable.
+        '''
+        if key not in self._rows:
+            try:
+                self._rows[key] = column(self._df, key).groupby(
+                    column(self._df, key), sort=False).indices
+            except TypeError:
+                self._rows[key] = None
+        rows = self._rows[key]
+        if rows is None:
+            raise TypeError(f'Column {key} holds values which are not hashable.')
+        found = [rows[v] for v in values if v in rows]
+        if not found:
+            return np.empty(0, dtype=int)
+        return np.sort(np.concatenate(found))
+
+
+    def mask(self, **kwargs):
+        '''
+        Same as filtering.mask(df, **kwargs), using the cached maps where
+        possible.
+        '''
+        out = np.ones(len(self._df), dtype=bool)
+        for key, value in kwargs.items():
+            if isinstance(value, (slice, np.ndarray, pd.Series)) or callable(value):
+                out &= condition(column(self._df, key), value)
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            try:
+                rows = self.rows(key, values)
+            except TypeError:
+                out &= condition(column(self._df, key), value)
+                continue
+            this = np.zeros(len(self._df), dtype=bool)
+            this[rows] = True
+            out &= this
+        return out
@@ -2,43 +2,70 @@
 import argparse
 import sys
 import os
-from hawcast import backend
+import re
+# backend and postproc import numpy, pandas and wetb, which is slow. They
+# are imported by the commands that need them, so that --help, bat, run and
+# jess start quickly.
+from hawcast.runner import Runner
+from hawcast.scheduling import estimate_costs, htc2bat
+from hawcast.profiling import Profiler
+from hawcast import sharding
+import shlex
 import click
 
 
 @click.group()
-def cli():
+@click.option('--profile', is_flag=True,
+              help='Time the stages of the command and write a summary to hawcast_profile.json.')
+@click.option('--trace', type=click.Path(), help='Also write a Chrome trace to this file.')
+@click.pass_context
+def cli(ctx, profile=False, trace=None):
     '''Hawcast - a HAWC2 workflow tool based on WETB '''
-    pass
+    if profile or trace:
+        profiler = ctx.with_resource(Profiler('hawcast_profile.json', trace))
+        ctx.call_on_close(lambda: print(profiler.report()))
 
 
 @cli.command()
 @click.argument('definition')
 @click.argument('dest', required=False)
 @click.option('--master', help='Relative filepath to master HTC file.')
-def htc(definition, dest=None, master=None):
+@click.option('--incremental', is_flag=True, help='Only rewrite htc files whose content changed.')
+@click.option('-j', 'n_jobs', default=8, help='Number of writer threads.')
+def htc(definition, dest=None, master=None, incremental=False, n_jobs=8):
     ''' Generate htc files'''
+    from hawcast import backend
     if master == None:
         master = os.path.join('htc/_master',
         os.path.splitext(os.path.basename(definition))[0] + '.htc')
     case = backend.Case(definition)
     print('Creating {} htc files...'.format(len(case.tags)))
-    backend.generate_htc_files(case.tags, master)
+    count = backend.generate_htc_files(case.tags, master, incremental=incremental, n_jobs=n_jobs,
+                                       source=definition)
+    print('{written} written, {unchanged} unchanged, {removed} removed.'.format(**count))
 
 
 
 @cli.command()
 @click.argument('htc_dir')
 @click.argument('dest', required=False)
-def jess(htc_dir, dest=None):
+@click.option('-j', 'n_jobs', default=8, help='Number of worker processes.')
+@click.option('--force', is_flag=True, help='Also recreate .p files which are newer than their htc file.')
+@click.option('--hashed-zip', is_flag=True,
+              help='Package control/ and data/ into a content-hashed model-<hash>.zip and use it.')
+def jess(htc_dir, dest=None, n_jobs=8, force=False, hashed_zip=False):
     '''Generates launch scripts for jess HPC'''
+    from hawcast import pbs
     pbs_template = os.path.join(os.path.dirname(__file__), 'pbs_template.p')
 
-    htc_files = [x for x in os.listdir(htc_dir) if x.endswith('.htc')]
+    htc_files = [os.path.join(htc_dir, x) for x in os.listdir(htc_dir) if x.endswith('.htc')]
     print('Creating {} .p files...'.format(len(htc_files)))
-    with click.progressbar(htc_files) as bar:
-        for file in bar:
-            backend.htc2pbs(os.path.join(htc_dir, file), pbs_template)
+    out = pbs.htc2pbs_batch(htc_files, pbs_template, n_jobs=n_jobs, force=force,
+                            model_zip='hashed' if hashed_zip else None)
+    print('{} written, {} up to date, {} failed.'.format(
+        len(out['written']), len(out['skipped']), len(out['errors'])))
+    for htc_fn, error in out['errors'].items():
+        print(f'{htc_fn}: {error}')
 
 
 
@@ -46,8 +73,192 @@ def jess(htc_dir, dest=None):
 @click.argument('htc_dir')
 @click.argument('dest', required=False)
 @click.option('-n', default=1)
-def bat(htc_dir, dest=None, n=1):
+@click.option('--balance', is_flag=True,
+              help='Distribute jobs by estimated cost instead of round-robin.')
+def bat(htc_dir, dest=None, n=1, balance=False):
     '''Generates bat launch files from htc files.'''
     n_htc = len([x for x in os.listdir(htc_dir) if x.endswith('.htc')])
     print(f'Creating {n} bat files for {n_htc} htc files...')
-    backend.htc2bat(htc_dir, n)
+    makespans, unit = htc2bat(htc_dir, n, balance=balance)
+    for i, makespan in enumerate(makespans):
+        print(f'{i+1}.bat: expected makespan {makespan:.6g} ({unit})')
+
+
+
+@cli.command()
+@click.argument('htc_dir')
+@click.option('-j', 'n_jobs', default=1, help='Number of simultaneous simulations.')
+@click.option('--exe', default='hawc2mb', help='HAWC2 executable (may include arguments).')
+@click.option('--retries', default=1, help='Number of retries of a failed simulation.')
+@click.option('--force', is_flag=True, help='Also rerun simulations with complete results.')
+@click.option('--verbose', is_flag=True, help='Echo the output of the simulations.')
+def run(htc_dir, n_jobs=1, exe='hawc2mb', retries=1, force=False, verbose=False):
+    '''Runs the htc files of a directory locally.'''
+    htc_files = [os.path.join(htc_dir, x) for x in os.listdir(htc_dir) if x.endswith('.htc')]
+    # start the longest simulations first
+    costs, _ = estimate_costs(htc_files)
+    htc_files = [x for _, x in sorted(zip(costs, htc_files), key=lambda x: -x[0])]
+
+    runner = Runner(exe, n_jobs=n_jobs, retries=retries, echo=verbose)
+    print(f'Running {len(htc_files)} htc files with {n_jobs} processes...')
+    with click.progressbar(length=len(htc_files)) as bar:
+        out = runner.run(htc_files, force=force, callback=lambda *args: bar.update(1))
+        bar.update(len(out['skipped']))
+    print('{} done, {} already complete, {} failed.'.format(
+        len(out['done']), len(out['skipped']), len(out['failed'])))
+    for htc_fn, error in out['failed'].items():
+        print(f'{htc_fn}: {error}')
+
+
+
+def parse_shard_option(ctx, param, value):
+    # click callback turning --shard i/N into (i, N)
+    try:
+        return sharding.parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@cli.command()
+@click.argument('res_dir')
+@click.argument('pattern')
+@click.option('-c', '--channel', 'channels', multiple=True, required=True,
+              help='Channel as name=number, e.g. -c TbFA=17. May be repeated.')
+@click.option('-s', '--stat', 'stats', multiple=True, default=['mean', 'std', 'min', 'max', 'DEL'],
+              help='Statistic with optional arguments, e.g. -s DEL:m=3,4,10. May be repeated.')
+@click.option('--shard', default='0/1', callback=parse_shard_option,
+              help='Only compute shard i of N (zero based), e.g. 2/8.')
+@click.option('--by', type=click.Choice(['size', 'hash']), default='size',
+              help='Assign files to shards by result size or by a hash of the name.')
+@click.option('--out', 'out_dir', default='postproc', help='Directory of the (partial) stats tables.')
+@click.option('-j', 'n_jobs', default=1, help='Number of worker processes per shard.')
+@click.option('--pbs', 'n_shards', type=int,
+              help='Write a PBS array job running this many shards instead of computing.')
+@click.option('--walltime', default='04:00:00', help='Walltime of the PBS array tasks.')
+@click.option('--index-dir', help='Directory of the result index, if not RES_DIR (e.g. when it is read-only).')
+def postproc(res_dir, pattern, channels, stats, shard=(0, 1), by='size', out_dir='postproc',
+             n_jobs=1, n_shards=None, walltime='04:00:00', index_dir=None):
+    '''Computes statistics of the result files in RES_DIR matching PATTERN,
+    e.g. 'dlc12_wsp{wsp}_s{seed}'. With --shard i/N only part i of N is
+    computed; combine the parts with hawcast merge.'''
+    channels = dict(sharding.parse_channel(x) for x in channels)
+    stats = dict(sharding.parse_stat(x) for x in stats)
+
+    if n_shards:
+        args = ['hawcast', 'postproc', res_dir, pattern, '--by', by, '--out', out_dir, '-j', str(n_jobs)]
+        args += [f'-c{k}={v}' for k, v in channels.items()]
+        args += [f'-s{x}' for x in stats_args(stats)]
+        args += ['--index-dir', index_dir] if index_dir else []
+        pbs_fn = write_postproc_pbs(' '.join(shlex.quote(x) for x in args), n_shards, n_jobs, walltime)
+        print(f'Wrote {pbs_fn}. Run hawcast merge {out_dir} when all {n_shards} shards are done.')
+        return
+
+    from hawcast.postproc import HAWC2DataFrame
+    i, n = shard
+    df = HAWC2DataFrame(dir=res_dir, pattern=pattern, channels=channels, index=index_dir or True)
+    part = df.wetb.shard(i, n, by=by)
+    print(f'Shard {i}/{n}: {len(part)} of {len(df)} result files.')
+    part = part.wetb.compute(stats, n_jobs=n_jobs)
+    os.makedirs(out_dir, exist_ok=True)
+    fn = sharding.part_filename(out_dir, i, n)
+    part.wetb.to_pickle(fn)
+    print(f'Wrote {fn}.')
+    if n == 1:
+        merge_parts(out_dir, n)
+
+
+def stats_args(stats):
+    # the command line form of a dictionary of statistics, see parse_stat
+    for name, kwargs in stats.items():
+        args = [f'{k}=' + ','.join(map(str, v if isinstance(v, list) else [v]))
+                for k, v in (kwargs or {}).items()]
+        yield ':'.join([name] + args)
+
+
+def write_postproc_pbs(command, n_shards, ppn=1, walltime='04:00:00'):
+    # writes the PBS array job script running the shards of a postproc command
+    from hawcast.template import Template, PBS_PLACEHOLDER
+    template = Template.from_file(os.path.join(os.path.dirname(__file__), 'pbs_postproc_template.p'),
+                                  PBS_PLACEHOLDER)
+    os.makedirs('pbs_in', exist_ok=True)
+    os.makedirs('pbs_out', exist_ok=True)
+    pbs_fn = os.path.join('pbs_in', 'postproc.p')
+    with open(pbs_fn, 'w') as f:
+        f.write(template.render({'jobname': 'postproc', 'pbsoutdir': 'pbs_out', 'walltime': walltime,
+                                 'ppn': ppn, 'last_shard': n_shards - 1, 'n_shards': n_shards,
+                                 'command': command}))
+    return pbs_fn
+
+
+def merge_parts(out_dir, n_shards=None, csv=None):
+    from hawcast.postproc import wetbAccessor
+    # every part of a single run with N shards must be present
+    parts = {}
+    for x in os.listdir(out_dir):
+        m = re.fullmatch(r'part-(\d+)-of-(\d+)\.pkl', x)
+        if m:
+            parts.setdefault(int(m.group(2)), []).append(int(m.group(1)))
+    if n_shards is None:
+        if not parts:
+            raise click.ClickException(f'No partial stats tables in {out_dir}.')
+        if len(parts) > 1:
+            raise click.ClickException(f'{out_dir} holds parts of runs with different numbers of shards '
+                                       f'({", ".join(map(str, sorted(parts)))}); remove the stale ones.')
+        n_shards, = parts
+    missing = sorted(set(range(n_shards)) - set(parts.get(n_shards, [])))
+    if missing:
+        raise click.ClickException(f'{len(missing)} of {n_shards} shards are missing: ' +
+                                   ', '.join(sharding.part_filename(out_dir, i, n_shards) for i in missing))
+    filenames = sharding.part_filenames(out_dir, n_shards)
+    df = wetbAccessor.merge_shards(filenames)
+    df.wetb.to_pickle(os.path.join(out_dir, 'stats.pkl'))
+    if csv:
+        df.to_csv(csv, index=False)
+    print(f'Merged {n_shards} shards, {len(df)} result files, {len(df.wetb.errors)} failed, '
+          f'into {os.path.join(out_dir, "stats.pkl")}.')
+    return df
+
+
+@cli.command()
+@click.argument('out_dir', default='postproc')
+@click.option('--csv', help='Also write the merged table to this csv file.')
+def merge(out_dir='postproc', csv=None):
+    '''Merges the partial stats tables of hawcast postproc --shard.'''
+    merge_parts(out_dir, csv=csv)
+
+
+
+@cli.command()
+@click.argument('res_dir')
+@click.argument('pattern')
+@click.option('-c', '--channel', 'channels', multiple=True, required=True,
+              help='Channel as name=number, e.g. -c TbFA=17. May be repeated.')
+@click.option('-s', '--stat', 'stats', multiple=True, default=['mean', 'std', 'min', 'max', 'DEL'],
+              help='Statistic with optional arguments, e.g. -s DEL:m=3,4,10. May be repeated.')
+@click.option('--table', default='postproc/stats.pkl', help='Stats table to keep up to date.')
+@click.option('--interval', default=60., help='Seconds between updates if no files are written.')
+@click.option('--once', is_flag=True, help='Update the table once and exit.')
+@click.option('--min-age', default=0., help='Seconds since a result was written before it is used.')
+@click.option('-j', 'n_jobs', default=1, help='Number of worker processes.')
+def watch(res_dir, pattern, channels, stats, table='postproc/stats.pkl', interval=60., once=False,
+          min_age=0., n_jobs=1):
+    '''Postprocesses results in RES_DIR matching PATTERN as they complete,
+    appending their statistics to a stats table.'''
+    from hawcast.watch import StatsTable
+    channels = dict(sharding.parse_channel(x) for x in channels)
+    stats = dict(sharding.parse_stat(x) for x in stats)
+    stats_table = StatsTable(table, res_dir, pattern, channels, stats, n_jobs=n_jobs, min_age=min_age)
+    report = lambda n: n and print(f'{n} results added to {table}.')
+    if once:
+        report(stats_table.update())
+        stats_table.compact()
+        return
+    print(f'Watching {res_dir}, press Ctrl+C to stop.')
+    try:
+        stats_table.watch(interval, callback=report)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    cli()
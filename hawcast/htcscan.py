@@ -0,0 +1,66 @@
+'''
+A fast, targeted scanner for HAWC2 .htc files.
+
+Building a full wetb HTCFile object is slow when only a handful of values
+are needed from thousands of files. scan_htc makes a single pass over the
+text, tracking the begin/end block structure, and records the first value of
+every line by its dotted path, e.g. 'simulation.logfile' or
+'wind.mann.filename_u'. It does not resolve continue_in_file or other
+includes; use wetb's HTCFile for that.
+'''
+
+
+def scan_htc(text):
+    '''
+    Scans the text of a htc file. Returns two dictionaries:
+        values  {dotted path: value string}, first occurrence of each line,
+                with multiple values joined by a space as in wetb's
+                str_values().
+        counts  {dotted block path: number of lines in the block(s)}, e.g.
+                counts['output'] is the number of lines in output blocks.
+    '''
+    values, counts = {}, {}
+    stack = []
+    for line in text.splitlines():
+        tokens = line.split(';', 1)[0].split()
+        if not tokens:
+            continue
+        key = tokens[0].lower()
+        if key == 'begin':
+            stack.append(tokens[1].lower() if len(tokens) > 1 else '')
+        elif key == 'end':
+            if stack:
+                stack.pop()
+        elif key == 'exit':
+            break
+        else:
+            path = '.'.join(stack)
+            counts[path] = counts.get(path, 0) + 1
+            values.setdefault(path + '.' + key if path else key, ' '.join(tokens[1:]))
+    return values, counts
+
+
+def scan_htc_file(filename):
+    with open(filename) as f:
+        return scan_htc(f.read())
+
+
+def htc_values(filename, keys):
+    '''
+    Returns {key: value string} for the given dotted keys of a htc file. The
+    file is scanned with scan_htc, and only if a key is not found there the
+    file is parsed with wetb's HTCFile, which resolves includes.
+    '''
+    values, _ = scan_htc_file(filename)
+    if all(key in values for key in keys):
+        return {key: values[key] for key in keys}
+
+    from wetb.hawc2.htc_file import HTCFile
+    htc = HTCFile(filename)
+    out = {}
+    for key in keys:
+        section = htc
+        for name in key.split('.'):
+            section = section[name]
+        out[key] = section.str_values()
+    return out
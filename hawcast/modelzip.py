@@ -0,0 +1,309 @@
+'''
+Incremental packaging of the turbine model.
+
+The model zip (the control/ and data/ directories) is copied to every
+cluster node, and rebuilding it from scratch is slow when the model holds
+large controller DLLs and data files. package keeps a manifest next to the
+zip with the size, modification time and SHA-256 hash of every file:
+
+- if no file changed, the zip is left untouched,
+- otherwise a new zip is written in which the compressed data of unchanged
+  entries is copied from the old zip, and only new or changed files are
+  compressed, by a pool of threads,
+- files with an extension in store (e.g. already compressed binaries) are
+  stored without compression.
+
+Entries have a fixed timestamp, so the same model always gives the same zip.
+hashed_package names the zip after the hash of its content
+(model-<hash>.zip), so that a zip which is cached on the cluster nodes can
+be reused by every campaign with the same model.
+
+example:
+    package('model.zip', n_jobs=8, store=('.dll', '.so'))
+    zipfilename = hashed_package()
+'''
+import os
+import json
+import glob
+import zlib
+import shutil
+import struct
+import hashlib
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .prefetch import prefetch
+from . import profiling
+
+
+MODEL_DIRS = ('control', 'data')
+CHUNKSIZE = 1 << 20
+# compressed entries larger than this are spooled to a temporary file
+SPOOL_SIZE = 32 << 20
+# 1980-01-01 00:00, the earliest date of the zip format
+DOS_TIME, DOS_DATE = 0, (1 << 5) | 1
+ZIP64_LIMIT = 0xFFFFFFFF
+# extensions of already compressed files, which are not worth recompressing
+COMPRESSED_EXTENSIONS = ('.zip', '.gz', '.bz2', '.xz', '.7z', '.rar')
+
+
+def scan(dirs=MODEL_DIRS):
+    '''
+    Returns {archive name: (path, size, mtime_ns, mode)} of the files in
+    dirs, sorted by archive name.
+    '''
+    files = {}
+    for directory in dirs:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                files[path.replace(os.sep, '/')] = (path, st.st_size, st.st_mtime_ns, st.st_mode)
+    return dict(sorted(files.items()))
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNKSIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_hashes(files, previous=None, n_jobs=None):
+    '''
+    Returns {archive name: SHA-256} of files (as returned by scan). The hash
+    in the previous manifest entries is reused for files with the same size
+    and modification time.
+    '''
+    previous = previous or {}
+    out, todo = {}, []
+    for name, (path, size, mtime_ns, _) in files.items():
+        old = previous.get(name)
+        if old and old['size'] == size and old['mtime_ns'] == mtime_ns:
+            out[name] = old['sha256']
+        else:
+            todo.append(name)
+    with profiling.stage('zip.hash'):
+        with ThreadPoolExecutor(n_jobs) as pool:
+            for name, digest in zip(todo, pool.map(sha256, [files[x][0] for x in todo])):
+                out[name] = digest
+    return {name: out[name] for name in files}
+
+
+def content_hash(entries):
+    # a hash of the archive names, file contents and compression of a manifest
+    h = hashlib.sha256()
+    for name, entry in sorted(entries.items()):
+        h.update(f'{name}\0{entry["sha256"]}\0{entry["method"]}\0{entry["level"]}\n'.encode())
+    return h.hexdigest()
+
+
+def read_manifest(zipfilename):
+    # the manifest of zipfilename, or None if there is none or the zip
+    # changed since it was written
+    try:
+        with open(zipfilename + '.json') as f:
+            manifest = json.load(f)
+        if os.path.getsize(zipfilename) != manifest['zip_size']:
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest
+
+
+def _write_manifest(zipfilename, entries):
+    manifest = {'zip_size': os.path.getsize(zipfilename), 'hash': content_hash(entries),
+                'entries': entries}
+    with open(zipfilename + '.json.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(zipfilename + '.json.tmp', zipfilename + '.json')
+    return manifest
+
+
+
+def _compress(args):
+    # compresses a file into a (spooled) temporary file. Returns
+    # (crc, compressed size, temporary file).
+    path, method, level = args
+    out = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    crc = 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if method == zipfile.ZIP_DEFLATED else None
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNKSIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            out.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        out.write(compressor.flush())
+    size = out.tell()
+    out.seek(0)
+    return crc, size, out
+
+
+
+class _ZipWriter(object):
+    # writes zip entries whose compressed data is already known, with zip64
+    # extensions where sizes or offsets need them.
+    def __init__(self, f):
+        self.f = f
+        self.central = []
+
+    def add(self, name, data, crc, compress_size, size, method, mode):
+        offset = self.f.tell()
+        name = name.encode('utf-8')
+        flags = 0x800 if not name.isascii() else 0
+        zip64 = max(size, compress_size, offset) >= ZIP64_LIMIT
+        version = 45 if zip64 else 20
+        extra = struct.pack('<HHQQ', 1, 16, size, compress_size) if zip64 else b''
+        sizes = (ZIP64_LIMIT, ZIP64_LIMIT) if zip64 else (compress_size, size)
+        self.f.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, method, DOS_TIME,
+                                 DOS_DATE, crc, *sizes, len(name), len(extra)))
+        self.f.write(name + extra)
+        shutil.copyfileobj(data, self.f, CHUNKSIZE)
+
+        extra = struct.pack('<HHQQQ', 1, 24, size, compress_size, offset) if zip64 else b''
+        header = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, flags,
+                             method, DOS_TIME, DOS_DATE, crc, *sizes, len(name), len(extra), 0, 0,
+                             0, (mode & 0xFFFF) << 16, ZIP64_LIMIT if zip64 else offset)
+        self.central.append(header + name + extra)
+
+    def close(self):
+        start = self.f.tell()
+        for header in self.central:
+            self.f.write(header)
+        end = self.f.tell()
+        n, size = len(self.central), end - start
+        if n >= 0xFFFF or end >= ZIP64_LIMIT:
+            self.f.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                                     n, n, size, start))
+            self.f.write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+            n, size, start = min(n, 0xFFFF), min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT)
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, n, n, size, start, 0))
+
+
+
+def _raw_entry(f, info):
+    # a file object positioned at the compressed data of info, limited to
+    # its compressed size
+    f.seek(info.header_offset + 26)
+    name_len, extra_len = struct.unpack('<HH', f.read(4))
+    f.seek(info.header_offset + 30 + name_len + extra_len)
+    return _Limited(f, info.compress_size)
+
+
+class _Limited(object):
+    # reads at most n bytes of f
+    def __init__(self, f, n):
+        self.f, self.n = f, n
+
+    def read(self, size=-1):
+        size = self.n if size < 0 else min(size, self.n)
+        data = self.f.read(size)
+        self.n -= len(data)
+        return data
+
+
+
+def _entries(files, hashes, store=(), level=6):
+    # the manifest entries of files (as returned by scan)
+    store = tuple(x.lower() for x in store)
+    entries = {}
+    for name, (_, size, mtime_ns, mode) in files.items():
+        deflate = not name.lower().endswith(store)
+        entries[name] = {'size': size, 'mtime_ns': mtime_ns, 'mode': mode, 'sha256': hashes[name],
+                         'method': zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED,
+                         'level': level if deflate else 0}
+    return entries
+
+
+def package(zipfilename, dirs=MODEL_DIRS, n_jobs=None, store=(), level=6, base=None):
+    '''
+    Brings zipfilename up to date with the files in dirs. Unchanged entries
+    of the existing zip (or of base, another model zip with a manifest) are
+    copied without recompression, new and changed files are compressed by
+    n_jobs threads (default: the number of CPUs), and files with an extension
+    in store are stored uncompressed.
+
+    Returns
+    -------
+    dict
+        {'written': [compressed entries], 'copied': [reused entries],
+        'removed': [entries no longer in dirs], 'hash': content hash}.
+        If the zip is up to date, written, copied and removed are empty.
+    '''
+    n_jobs = n_jobs or os.cpu_count()
+    manifest = read_manifest(zipfilename)
+    source = zipfilename
+    if manifest is None and base is not None:
+        manifest, source = read_manifest(base), base
+    old = manifest['entries'] if manifest else {}
+
+    with profiling.stage('zip.scan'):
+        files = scan(dirs)
+    entries = _entries(files, file_hashes(files, old, n_jobs), store, level)
+    out = {'written': [], 'copied': [], 'removed': [], 'hash': content_hash(entries)}
+    if source == zipfilename and manifest and manifest['hash'] == out['hash']:
+        # up to date; the manifest is refreshed if files were only touched
+        if any(old[x]['mtime_ns'] != entries[x]['mtime_ns'] for x in entries):
+            _write_manifest(zipfilename, entries)
+        return out
+
+    def same(name):
+        a, b = entries[name], old.get(name)
+        return b is not None and all(a[k] == b[k] for k in ('sha256', 'method', 'level'))
+
+    copy = [name for name in entries if same(name)]
+    todo = [name for name in entries if not same(name)]
+
+    def compress(name):
+        return _compress((files[name][0], entries[name]['method'], entries[name]['level']))
+
+    tmp_fn = zipfilename + '.tmp'
+    with profiling.stage('zip.write'):
+        with open(tmp_fn, 'wb') as f:
+            writer = _ZipWriter(f)
+            if copy:
+                with open(source, 'rb') as old_f, zipfile.ZipFile(source) as old_zip:
+                    for name in copy:
+                        info = old_zip.getinfo(name)
+                        writer.add(name, _raw_entry(old_f, info), info.CRC, info.compress_size,
+                                   info.file_size, info.compress_type, entries[name]['mode'])
+            # files are compressed in background threads and written in order
+            for name, result, error in prefetch(compress, todo, 2 * n_jobs, n_jobs):
+                if error is not None:
+                    raise error
+                crc, compress_size, data = result
+                with data:
+                    writer.add(name, data, crc, compress_size, entries[name]['size'],
+                               entries[name]['method'], entries[name]['mode'])
+                profiling.count('zip_bytes', entries[name]['size'])
+            writer.close()
+    os.replace(tmp_fn, zipfilename)
+    _write_manifest(zipfilename, entries)
+    out.update(written=todo, copied=copy, removed=sorted(set(old) - set(entries)))
+    return out
+
+
+def hashed_package(directory='.', dirs=MODEL_DIRS, prefix='model-', n_jobs=None, store=(), level=6):
+    '''
+    Packages dirs into directory/<prefix><hash>.zip, named after the first
+    12 characters of the content hash, and returns the zip filename. The
+    most recent model zip in directory is used as the base of an incremental
+    update, and the zip is touched when it becomes the most recent one.
+    Older model zips are kept, as launch files may refer to them.
+    '''
+    zips = sorted(glob.glob(os.path.join(directory, prefix + '*.zip')), key=os.path.getmtime)
+    base = zips[-1] if zips else None
+    manifest = read_manifest(base) if base else None
+
+    # the content hash decides the name, so the files are hashed first. The
+    # hashes are reused by package through the refreshed manifests.
+    files = scan(dirs)
+    hashes = file_hashes(files, manifest['entries'] if manifest else None, n_jobs)
+    zipfilename = os.path.join(directory, prefix + content_hash(_entries(files, hashes, store, level))[:12] + '.zip')
+    package(zipfilename, dirs, n_jobs, store, level, base=base)
+    if zipfilename != base:
+        # an earlier model zip which is reused becomes the most recent one
+        os.utime(zipfilename)
+    return zipfilename
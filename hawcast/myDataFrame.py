@@ -1,5 +1,5 @@
 import pandas as pd
-import numpy as np
+from .filtering import mask
 
 class myDataFrame(pd.DataFrame):
     ''' A modified pandas dataframe that can be called. The call function filters and
@@ -19,15 +19,7 @@ class myDataFrame(pd.DataFrame):
         '''
         Returns a mask for refering to a dataframe, or self.Data, or self.Data_f, etc.
         example. dlc.mask(wsp=[12, 14], controller='noIPC')
+        Ranges are given as slices, wsp=slice(10, 14), and predicates as
+        callables, yaw=lambda x: x != 0. See hawcast.filtering.
         '''
-        N = len(self)
-        mask = [True] * N
-        for key, value in kwargs.items():
-            if isinstance(value, (list, tuple, np.ndarray)):
-                mask_temp = [False] * N
-                for v in value:
-                    mask_temp = mask_temp | (self[key] == v)
-                mask = mask & mask_temp
-            else: #scalar, or single value
-                mask = mask & (self[key] == value)
-        return mask
+        return mask(self, **kwargs)
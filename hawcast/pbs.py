@@ -0,0 +1,183 @@
+'''
+Launch files for HAWC2 simulations on a PBS cluster (e.g. jess) and the
+model zip they refer to.
+
+Writing launch files only needs a few values of each htc file, which are
+found by the targeted scanner of htcscan, so this module does not depend on
+numpy or pandas and 'hawcast jess' starts quickly.
+'''
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .template import Template, PBS_PLACEHOLDER
+from .htcscan import htc_values
+from . import profiling, modelzip
+
+
+
+def generate_model_zip(zipfilename, incremental=False, n_jobs=None, store=()):
+    # zips the control and data directories. If incremental is True, the
+    # zip is only rebuilt when files changed, and only changed files are
+    # recompressed (see modelzip.package, which also describes n_jobs and
+    # store).
+    if incremental:
+        return modelzip.package(zipfilename, n_jobs=n_jobs, store=store)
+    zipf = zipfile.ZipFile(zipfilename, 'w', zipfile.ZIP_DEFLATED)
+    for root, dirs, files in os.walk('control'):
+        for file in files:
+            zipf.write(os.path.join(root, file))
+
+    for root, dirs, files in os.walk('data'):
+        for file in files:
+            zipf.write(os.path.join(root, file))
+    zipf.close()
+
+
+def htc2pbs(htc_fn, pbs_template_fn, model_zip=None):
+    """
+    Creates a PBS launch file (.p) based on a HAWC2 .htc file.
+    - Assumes htc files are within a htc/[casename]/ directory relative to current directory.
+    - Assumes there is a .zip file in the current directory which contains the turbine model.
+      If there is none, the zip file is set to 'model.zip' by default
+    - Will place a .p fine in pbs_in/[casename]/ directory relative to current directory.
+    -
+
+    Parameters
+    ----------
+    htc_fn : str
+        The file name and path to the .htc file
+    pbs_template_fn : str
+        The filename and path to the template .p file
+    model_zip : str, optional
+        The model zip file. If 'hashed', the model is packaged into a
+        content-hashed model-<hash>.zip (see modelzip.hashed_package), which
+        cluster nodes can cache across campaigns. By default the first .zip
+        file in the current directory is used.
+
+
+    Returns
+    -------
+    str
+        The filename and path to the output .p file
+
+    Raises
+    ------
+    FileNotFoundError: If the file structure is not correct.
+    """
+    template = Template.from_file(pbs_template_fn, PBS_PLACEHOLDER)
+    return _write_pbs(htc_fn, template, resolve_model_zip(model_zip))
+
+
+PBS_KEYS = ['simulation.logfile', 'output.filename', 'wind.mann.filename_u']
+
+
+def find_model_zip():
+    # the turbine model zip file in the current directory
+    try:
+        return [x for x in os.listdir() if x.lower().endswith('.zip')][0]
+    except IndexError:
+        print('No .zip file found in current directory. Set model zip to \'model.zip\'')
+        return 'model.zip'
+
+
+def resolve_model_zip(model_zip=None):
+    # the model zip given to htc2pbs(_batch)
+    if model_zip is None:
+        return find_model_zip()
+    if model_zip == 'hashed':
+        return os.path.basename(modelzip.hashed_package(store=modelzip.COMPRESSED_EXTENSIONS))
+    return model_zip
+
+
+def pbs_filename(htc_fn):
+    basename = os.path.relpath(os.path.dirname(htc_fn), 'htc')
+    jobname = os.path.splitext(os.path.basename(htc_fn))[0]
+    return os.path.join('pbs_in', basename, jobname + '.p')
+
+
+def _write_pbs(htc_fn, template, zipfile):
+    # writes the .p file of a single htc file. Returns the .p filename.
+    basename = os.path.relpath(os.path.dirname(htc_fn), 'htc')
+    jobname = os.path.splitext(os.path.basename(htc_fn))[0]
+    pbs_in_dir = os.path.join('pbs_in', basename)
+    if basename == '.':
+        raise FileNotFoundError('File structure is incorrect.')
+
+    #   get the required parameters for the pbs file from the htc file
+    with profiling.stage('pbs.scan_htc'):
+        htc = htc_values(htc_fn, PBS_KEYS)
+    p = {
+        'walltime'      : '00:40:00',
+        'modelzip'      : zipfile,
+        'jobname'       : jobname,
+        'htcdir'        : 'htc/' + basename,
+        'logdir'        :  os.path.dirname(htc['simulation.logfile'])[2:] + '/',
+        'resdir'        : os.path.dirname(htc['output.filename'])[2:] + '/',
+        'turbdir'       : os.path.dirname(htc['wind.mann.filename_u']) + '/',
+        'turbfileroot'  : os.path.basename(htc['wind.mann.filename_u']).split('u.')[0],
+        'pbsoutdir'     : 'pbs_out/' + basename
+        }
+
+    #Write pbs file based on template file and tags
+    os.makedirs(pbs_in_dir, exist_ok=True)
+    pbs_fn = os.path.join(pbs_in_dir, jobname + '.p')
+    with profiling.stage('pbs.render'):
+        text = template.render(p, strict=False)
+    with profiling.stage('pbs.write'):
+        with open(pbs_fn, 'w') as f:
+            f.write(text)
+    return pbs_fn
+
+
+def _write_pbs_or_error(htc_fn, template, zipfile):
+    try:
+        return _write_pbs(htc_fn, template, zipfile), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def htc2pbs_batch(htc_files, pbs_template_fn, n_jobs=8, chunksize=64, force=False, model_zip=None):
+    """
+    Creates PBS launch files for many htc files. The model zip and the
+    template are resolved once, the htc files are scanned with the targeted
+    scanner of htcscan (falling back to a full HTCFile parse) and processed
+    by a pool of n_jobs worker processes. Unless force is True, only htc
+    files which are newer than their .p file (or the model zip) are
+    processed. model_zip is as in htc2pbs.
+
+    Returns
+    -------
+    dict
+        {'written': [.p filenames], 'skipped': [htc filenames up to date],
+        'errors': {htc filename: error message}}
+    """
+    template = Template.from_file(pbs_template_fn, PBS_PLACEHOLDER)
+    zipfile = resolve_model_zip(model_zip)
+
+    # .p files older than the model zip may refer to a previous one
+    zip_mtime = os.path.getmtime(zipfile) if os.path.exists(zipfile) else 0
+
+    todo, skipped = [], []
+    for htc_fn in htc_files:
+        pbs_fn = pbs_filename(htc_fn)
+        if not force and os.path.exists(pbs_fn) and \
+                os.path.getmtime(pbs_fn) >= max(os.path.getmtime(htc_fn), zip_mtime):
+            skipped.append(htc_fn)
+        else:
+            todo.append(htc_fn)
+
+    out = {'written': [], 'skipped': skipped, 'errors': {}}
+    args = (todo, [template]*len(todo), [zipfile]*len(todo))
+    if n_jobs > 1 and len(todo) > chunksize:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            results = list(pool.map(_write_pbs_or_error, *args, chunksize=chunksize))
+    else:
+        results = list(map(_write_pbs_or_error, *args))
+
+    for htc_fn, (pbs_fn, error) in zip(todo, results):
+        if error is None:
+            out['written'].append(pbs_fn)
+        else:
+            out['errors'][htc_fn] = error
+    return out
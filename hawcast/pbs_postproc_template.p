@@ -0,0 +1,20 @@
+### Standard Output
+#PBS -N [jobname]
+#PBS -o [pbsoutdir]/[jobname].out
+### Standard Error
+#PBS -e [pbsoutdir]/[jobname].err
+#PBS -W umask=0003
+### Maximum wallclock time format HOURS:MINUTES:SECONDS
+#PBS -l walltime=[walltime]
+#PBS -l nodes=1:ppn=[ppn]
+### Queue name
+#PBS -q workq
+### One array task per shard
+#PBS -t 0-[last_shard]
+
+cd $PBS_O_WORKDIR
+# Torque sets PBS_ARRAYID, PBS Pro sets PBS_ARRAY_INDEX
+SHARD=${PBS_ARRAYID:-$PBS_ARRAY_INDEX}
+echo "postprocessing shard $SHARD of [n_shards]"
+[command] --shard $SHARD/[n_shards]
+exit
@@ -1,9 +1,20 @@
 import pandas as pd
 import numpy as np
 import re, os
-from .backend import readHawc2Res
-from wetb.fatigue_tools.fatigue import eq_load
-from scipy import signal
+from .reader import Hawc2Result, read_sel
+from .resultindex import ResultIndex, index_path
+from .statscache import StatsCache
+from .columnar import convert_results
+from .derived import Derived, ResultArray, resolve, iter_blocks, to_json, from_json
+from .prefetch import prefetch as _prefetch
+from . import profiling
+from .sharding import assign_shards
+from .spectra import Spectra, file_spectrum, frequency_axis
+from .filtering import mask, column
+from .fatigue import equivalent_loads, equivalent_load_from_cycles
+from .streaming import StreamingStats, RainflowAccumulator, WelchAccumulator
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps # This convenience func preserves name and docstring
 import click
 
@@ -15,6 +26,172 @@ def isFloat(string):
     except ValueError:
         return False
 
+def _load(filename, header, channels):
+    # the channels of a file, including derived channels, as a ResultArray
+    with Hawc2Result(filename, header) as res:
+        return ResultArray.from_result(res, channels)
+
+
+def _stream_file(filename, header, channels, reducers, blocksize):
+    # feeds the file block by block to the accumulators of the streaming
+    # statistics, then returns a list of (label, statistic)
+    accumulators, finalisers = {}, []
+    for label, func, args, kwargs in reducers:
+        if func not in _streaming or args:
+            raise ValueError(f'{func.__name__} can not be computed in streaming mode.')
+        kind, finalise = _streaming[func]
+        factory, argnames = _accumulators[kind]
+        key = (kind, tuple(kwargs.get(x) for x in argnames))
+        if key not in accumulators:
+            accumulators[key] = factory(**{x: kwargs[x] for x in argnames if x in kwargs})
+        finalisers.append((label, finalise, accumulators[key], kwargs))
+
+    with Hawc2Result(filename, header) as res:
+        # rainflow counting needs the range of each channel, from a first pass
+        ranged = [acc for acc in accumulators.values() if hasattr(acc, 'observe')]
+        if ranged:
+            with profiling.stage('reduce.streaming'):
+                for block in iter_blocks(res, channels, blocksize):
+                    for acc in ranged:
+                        acc.observe(block)
+        for block in iter_blocks(res, channels, blocksize):
+            with profiling.stage('reduce.streaming'):
+                for acc in accumulators.values():
+                    acc.update(block)
+    return [(label, finalise(acc, **kwargs)) for label, finalise, acc, kwargs in finalisers]
+
+
+def _reduce_file(filename, header, channels, reducers, blocksize=None):
+    '''
+    Loads a single result file and applies a list of reducers to it, or
+    streams it in blocks of blocksize scans if blocksize is given. Runs in
+    worker processes, so any error is returned as a message rather than
+    raised. Returns (list of statistics, error message or None).
+    '''
+    try:
+        if blocksize:
+            results = _stream_file(filename, header, channels, reducers, blocksize)
+        else:
+            raw = _load(filename, header, channels)
+            frame = None
+            results = []
+            for label, func, args, kwargs in reducers:
+                name = '+'.join(label) if isinstance(label, tuple) else label
+                with profiling.stage(f'reduce.{name}'):
+                    # statistics registered with array=True take the 2D
+                    # array, others a dataframe, built once per file
+                    if getattr(func, 'array', False):
+                        x = raw.data
+                    else:
+                        x = frame = raw.to_frame() if frame is None else frame
+                    results.append((label, func(x, *args, **kwargs)))
+        stats = []
+        for label, stat in results:
+            if isinstance(label, tuple):
+                stats.extend(stat)
+            else:
+                stats.append(stat)
+        return stats, None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def _channel_id(ch, scale_factors):
+    # identifies a channel in cache keys by its number and scale factor, or a
+    # derived channel by its definition and the scale factors of its sources
+    if isinstance(ch, Derived):
+        return repr(ch.key), tuple(scale_factors[n-1] for n in ch.numbers())
+    return ch, scale_factors[ch-1]
+
+
+def _cache_keys(filename, header, channels, reducers):
+    # cache keys of the statistics of a file, [label][channel]
+    file_id = StatsCache.file_id(filename)
+    header = header or read_sel(filename)
+    ids = [_channel_id(ch, header.scale_factors) for ch in channels.values()]
+    keys = []
+    for label, func, args, kwargs in reducers:
+        # list arguments are batched, and their values are part of the labels
+        params = (args, sorted((k, v) for k, v in kwargs.items() if not isinstance(v, list)))
+        for this in (label if isinstance(label, tuple) else (label,)):
+            stat = (func.__module__, func.__qualname__, this)
+            keys.append([StatsCache.key(file_id, ch, scale, stat, params) for ch, scale in ids])
+    return keys
+
+
+def reduce_files(tasks, reducers, n_jobs=1, chunksize=1, blocksize=None, cache=None):
+    '''
+    Applies a list of reducers to the result files given as tasks, a list of
+    (filename, header, channels), and yields (statistics, error) for each
+    file in order. statistics is a list with one list of per-channel values
+    per label. Files are processed by n_jobs worker processes (all cores if
+    -1). If a StatsCache is given, only the channels of a file with a
+    statistic missing from the cache are loaded, and files with all
+    statistics in the cache are not opened at all.
+    '''
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    keys, hits, todo = [None] * len(tasks), {}, []
+    for i, (filename, header, channels) in enumerate(tasks):
+        if cache is not None:
+            try:
+                keys[i] = _cache_keys(filename, header, channels, reducers)
+            except (OSError, ValueError, IndexError):
+                pass
+    if cache is not None:
+        hits = cache.get_many(k for file_keys in keys if file_keys for label_keys in file_keys for k in label_keys)
+
+    missing = []
+    for i, (filename, header, channels) in enumerate(tasks):
+        if keys[i] is None:
+            this = channels
+        else:
+            this = {name: ch for j, (name, ch) in enumerate(channels.items())
+                    if any(label_keys[j] not in hits for label_keys in keys[i])}
+        missing.append(this)
+        if this:
+            todo.append((filename, header, this, reducers, blocksize))
+
+    pool = ProcessPoolExecutor(n_jobs) if n_jobs > 1 and todo else None
+    pending = []
+    try:
+        if pool is None:
+            results = (_reduce_file(*task) for task in todo)
+        else:
+            results = pool.map(_reduce_file, *zip(*todo), chunksize=chunksize)
+
+        for i, (filename, header, channels) in enumerate(tasks):
+            if not missing[i]:
+                yield [[hits[k] for k in label_keys] for label_keys in keys[i]], None
+                continue
+            stats, error = next(results)
+            if error is not None or keys[i] is None:
+                yield stats, error
+                continue
+            # merge computed and cached channels
+            merged = []
+            for label_keys, computed in zip(keys[i], stats):
+                computed = iter(computed)
+                values = []
+                for j, name in enumerate(channels):
+                    if name in missing[i]:
+                        values.append(next(computed))
+                        pending.append((label_keys[j], values[-1]))
+                    else:
+                        values.append(hits[label_keys[j]])
+                merged.append(values)
+            if len(pending) > 5000:
+                cache.put_many(pending)
+                pending = []
+            yield merged, None
+    finally:
+        if pending:
+            cache.put_many(pending)
+        if pool is not None:
+            pool.shutdown()
+
+
 class HAWC2DataFrame(pd.DataFrame):
     
     _metadata = ['wetb']
@@ -22,10 +199,10 @@ class HAWC2DataFrame(pd.DataFrame):
     def _constructor(self):
         return HAWC2DataFrame
         
-    def __init__(self, *args, dir=None, pattern=None, channels=None, **kwargs):
+    def __init__(self, *args, dir=None, pattern=None, channels=None, index=True, **kwargs):
         if all(x is not None for x in [dir, pattern, channels]):
             self.wetb = wetbAccessor(self)
-            res = self.wetb.link_results(dir, pattern, channels)
+            res = self.wetb.link_results(dir, pattern, channels, index)
             super(HAWC2DataFrame, self).__init__(res)
 
         else:
@@ -58,38 +235,52 @@ class HAWC2DataFrame(pd.DataFrame):
         '''
         Returns a mask for refering to a dataframe, or self.Data, or self.Data_f, etc.
         example. dlc.mask(wsp=[12, 14], controller='noIPC')
+        Ranges are given as slices, wsp=slice(10, 14), and predicates as
+        callables, yaw=lambda x: x != 0. See hawcast.filtering.
         '''
-        N = len(self)
-        mask = [True] * N
-        for key, value in kwargs.items():
-            if isinstance(value, (list, tuple, np.ndarray)):
-                mask_temp = [False] * N
-                for v in value:
-                    mask_temp = mask_temp | (self[key] == v)
-                mask = mask & mask_temp
-            else: #scalar, or single value
-                mask = mask & (self[key] == value)
-        return mask
+        return mask(self, **kwargs)
 
 
 
 class wetbAccessor(object):
+    # statistics registered with populate_method, {method_name: (func, label, batch)}
+    _stats = {}
+
     def __init__(self, pandas_obj):
         self._obj = pandas_obj
         
-    def link_results(self, directory, pattern_string, channels):
+    def link_results(self, directory, pattern_string, channels, index=True):
+        # index is where the result index is kept, see index_path: True for
+        # the result directory, the path of another directory, or False. An
+        # open ResultIndex of the directory is used as it is.
         self._directory = directory
         pattern, self._fields = self._compile_pattern(pattern_string)
 
-        # get all filenames that fit the pattern
-        self._filenames = [x[:-4] for x in os.listdir(directory) if x.endswith('.sel')]
-        self._filenames = [x for x in self._filenames if pattern.match(x)]
+        # get all filenames that fit the pattern, along with their tags. The
+        # result index caches filenames, tags and .sel headers on disk.
+        # Without an index, the headers are read when the results are.
+        path = index if isinstance(index, ResultIndex) else index_path(directory, index)
+        self.errors = {}
+        if path is not None:
+            self._index = path if isinstance(path, ResultIndex) else ResultIndex(directory, path)
+            matches = self._index.match(pattern)
+            for idx, (fn, _) in enumerate(matches):
+                if fn in self._index.errors:
+                    self.errors[idx] = self._index.errors[fn]
+                    print(f'File {fn} has an invalid header: {self.errors[idx]}')
+        else:
+            self._index = None
+            with profiling.stage('discover'):
+                filenames = [x[:-4] for x in os.listdir(directory) if x.endswith('.sel')]
+            matches = [(x, pattern.match(x).groups()) for x in filenames if pattern.match(x)]
+        self._filenames = [fn for fn, _ in matches]
         
-        self.channels = channels
+        # the sources of derived channels are resolved, see hawcast.derived
+        self.channels = resolve(channels)
         # Extract input attributes and put in dataframe
         dat = []
-        for fn in self._filenames:
-            dat.append([float(x) if isFloat(x) else x for x in pattern.findall(fn)[0]])
+        for _, tags in matches:
+            dat.append([float(x) if isFloat(x) else x for x in tags])
         dat = pd.DataFrame(dat)
         
         # set column multi index
@@ -97,15 +288,33 @@ class wetbAccessor(object):
             column_tuples = list(zip(*[self._fields, ['']*len(self._fields)]))
             dat.columns = pd.MultiIndex.from_tuples(column_tuples, names=['channel', 'stat'])
         return dat
+
+
+    def header(self, idx):
+        '''
+        Returns the .sel header of a result file given an index number.
+        '''
+        fn = self._filenames[idx]
+        if getattr(self, '_index', None) is not None and fn not in self._index.errors:
+            return self._index.header(fn)
+        return read_sel(os.path.join(self._directory, fn))
+
     
     @classmethod    
-    def populate_method(cls, method_name, label=None):
+    def populate_method(cls, method_name, label=None, batch=None, array=False):
+        # batch names a keyword argument for which the function accepts a
+        # list of values, returning one set of statistics per value. If array
+        # is True, the function receives a (time x channel) numpy array
+        # instead of a dataframe.
         label = label or method_name
         def decorator(func):
+            func.array = array
             @wraps(func) 
-            def wrapper(self, channels, *args, **kwargs): 
-                return self._add_stat(func, label, channels, *args, **kwargs)
+            def wrapper(self, channels=None, *args, n_jobs=1, chunksize=1, cache=None, **kwargs): 
+                return self._add_stat(func, label, channels, *args, n_jobs=n_jobs,
+                                      chunksize=chunksize, cache=cache, **kwargs)
             setattr(cls, method_name, wrapper)
+            cls._stats[method_name] = (func, label, batch)
             # Note we are not binding func, but wrapper which accepts self but does exactly the same as func
             return func # returning func means func can still be used normally
         return decorator            
@@ -118,88 +327,255 @@ class wetbAccessor(object):
         return re.compile(pattern_string), fields
         
         
-    def fetch_result(self, idx, channels=None):
+    def fetch_result(self, idx, channels=None, as_array=False, dtype=np.float64):
         '''
-        Returns a dataframe of a single result file given an index number.
+        Returns a dataframe of a single result file given an index number. If
+        as_array is True, a (time x channel) numpy array of the given dtype is
+        returned instead. Raises an error if the file can not be loaded.
         '''
         fn = self._filenames[idx]
         channels = channels or self.channels
-        try:
-            raw = readHawc2Res(os.path.join(self._directory, fn), channels)
-            return raw
-        except:
-            print(f'File {fn} could not be loaded.')
-        
-        
-        
-        
-    def iter_sim(self, **kwargs):
+        with Hawc2Result(os.path.join(self._directory, fn), self.header(idx)) as res:
+            raw = ResultArray.from_result(res, resolve(channels), dtype=dtype)
+        if as_array:
+            return raw.data
+        return raw.to_frame()
+
+
+    def iter_sim(self, prefetch=0, errors='warn', **kwargs):
         '''
         Iterates over simulation result files given the input filter defined in kwargs.
+        If prefetch is larger than zero, the next prefetch results are loaded
+        in background threads while the current one is processed. Files which
+        can not be loaded are yielded as None and recorded in self.errors if
+        errors is 'warn', or raise the error when reached if errors is 'raise'.
         '''
         sims_to_iterate = self._obj(**kwargs)
-        for idx, row in sims_to_iterate.iterrows():
-            raw = self.fetch_result(idx)
-            yield row[self._fields], raw
+        self.errors = {}
+        for idx, raw, error in _prefetch(self.fetch_result, sims_to_iterate.index, prefetch):
+            if error is not None:
+                if errors == 'raise':
+                    raise error
+                self.errors[idx] = f'{type(error).__name__}: {error}'
+                print(f'File {self._filenames[idx]} could not be loaded: {self.errors[idx]}')
+            yield sims_to_iterate.loc[idx, self._fields], raw
 
-                 
-        
-        
-        
-    def _add_stat(self, func, stat_name, channels=None, *args, **kwargs):
+
+    def _channel_subset(self, channels=None):
+        if channels is None:
+            return self.channels
+        return {k:v for k,v in self.channels.items() if k in channels}
+
+
+    def _add_stat(self, func, stat_name, channels=None, *args, n_jobs=1, chunksize=1, cache=None, **kwargs):
         '''
         Adds a column of statistics for the given channels using the given function.
-        The function should take a pandas series (1d array) and return a float.
+        The function should take a dataframe of the channels (or a (time x channel)
+        array if registered with array=True) and return one value per channel.
+        List arguments of registered statistics are expanded as in compute.
         '''
-        values = []
-        if channels is None:
-            channels = self.channels
+        names = [name for name, (f, label, _) in self._stats.items() if f is func and label == stat_name]
+        if names and not args:
+            reducers = self.reducers({names[0]: kwargs})
         else:
-            channels = {k:v for k,v in self.channels.items() if k in channels}
-        
+            reducers = [(stat_name, func, args, kwargs)]
+        return self._reduce(reducers, channels, n_jobs, chunksize, cache=cache)
+
+
+    @classmethod
+    def reducers(cls, stats):
+        '''
+        Returns the list of reducers, (label, func, args, kwargs), of a
+        dictionary of {method_name: kwargs} as described in compute.
+        '''
+        if not isinstance(stats, dict):
+            stats = {name: None for name in stats}
+
+        reducers = []
+        for name, kwargs in stats.items():
+            if name not in cls._stats:
+                raise KeyError(f'Unknown statistic {name}. Available statistics '
+                               f'are {", ".join(cls._stats)}.')
+            func, label, batch = cls._stats[name]
+            kwargs = kwargs or {}
+            expand = {k: v for k, v in kwargs.items() if isinstance(v, (list, tuple))}
+            fixed = {k: v for k, v in kwargs.items() if k not in expand}
+            if not expand:
+                reducers.append((label, func, (), fixed))
+                continue
+            # a batched argument is passed on as a list in a single call
+            batched = expand.pop(batch, None)
+            for values in product(*expand.values()):
+                this = {**fixed, **dict(zip(expand, values))}
+                suffix = ''.join(f'_{k}{v}' for k, v in zip(expand, values))
+                if batched is None:
+                    reducers.append((label + suffix, func, (), this))
+                else:
+                    labels = tuple(f'{label}{suffix}_{batch}{v}' for v in batched)
+                    reducers.append((labels, func, (), {**this, batch: list(batched)}))
+
+        return reducers
+
+
+    def compute(self, stats, channels=None, n_jobs=1, chunksize=1, blocksize=None, cache=None):
+        '''
+        Adds columns for several statistics while reading each result file
+        only once. stats is a dictionary of {method_name: kwargs} (kwargs may
+        be None), or a list of method names. A list given as a keyword
+        argument is expanded into one statistic per value, labelled with the
+        argument name and value.
+        example: df.wetb.compute({'mean': None, 'std': None, 'DEL': {'m': [3, 4, 10]}})
+        adds the statistics Mean, Std, DEL_m3, DEL_m4 and DEL_m10.
+
+        If n_jobs is larger than one, result files are processed by a pool of
+        n_jobs worker processes (all cores if n_jobs is -1), handing out
+        chunksize files at a time. Statistics of files which fail to load or
+        reduce are set to NaN, and the error messages are kept in
+        self.errors, {index: message}.
+
+        If blocksize is given, result files are streamed in blocks of
+        blocksize scans and the statistics are accumulated block by block,
+        which bounds memory use for long simulations. Only mean, var, std,
+        min, max, final, DEL and PSD support streaming.
+
+        If a StatsCache is given as cache, statistics computed earlier for
+        unchanged result files are taken from the cache, and only the
+        missing ones are computed.
+        '''
+        return self._reduce(self.reducers(stats), channels, n_jobs, chunksize, blocksize, cache)
+
+
+    def _tasks(self, channels):
+        # work items for reduce_files, one per row. Workers only receive file
+        # paths, channel maps and cached headers.
+        for idx in self._obj.index:
+            fn = self._filenames[idx]
+            try:
+                header = self._index.header(fn)
+            except (AttributeError, KeyError):
+                header = None
+            yield os.path.join(self._directory, fn), header, channels
+
+
+    def _reduce(self, reducers, channels=None, n_jobs=1, chunksize=1, blocksize=None, cache=None):
+        '''
+        Applies a list of reducers, given as (label, func, args, kwargs), to
+        every result file and joins the statistics to the dataframe. If label
+        is a tuple, func returns one set of statistics per label. Each
+        file is read once regardless of the number of reducers. Results are
+        collected in index order, also when running in parallel.
+        '''
+        channels = self._channel_subset(channels)
+        labels = [label for label, *_ in reducers]
+        labels = [x for label in labels for x in (label if isinstance(label, tuple) else (label,))]
+        values = {label: [] for label in labels}
+        nan_row = [np.nan] * len(channels)
+        self.errors = {}
+
         channel_string = ', '.join(channels)
-        print(f'Calculating {stat_name} for {channel_string}...')
-        
-        with click.progressbar(self._obj.index) as bar:
-            for idx in bar:
-                raw = self.fetch_result(idx, channels)
-                values.append(func(raw, *args, **kwargs))
+        stat_string = ', '.join(values)
+        print(f'Calculating {stat_string} for {channel_string}...')
 
-                     
+        tasks = list(self._tasks(channels))
+        results = reduce_files(tasks, reducers, n_jobs, chunksize, blocksize, cache)
+        with click.progressbar(results, length=len(tasks)) as bar:
+            for idx, (stats, error) in zip(self._obj.index, bar):
+                if error is not None:
+                    self.errors[idx] = error
+                    stats = [nan_row] * len(labels)
+                for label, stat in zip(values, stats):
+                    values[label].append(stat)
+
+        for idx, error in self.errors.items():
+            print(f'File {self._filenames[idx]} could not be processed: {error}')
 
-        df = pd.DataFrame(values)
         # add multi index columns
-        col_ch     = list(channels.keys())
-        col_stat   = [stat_name]*len(col_ch)
-        col_tuples = list(zip(*[col_ch, col_stat]))
-        df.columns = pd.MultiIndex.from_tuples(col_tuples, names=['channel', 'stat'])
+        frames = []
+        for label, vals in values.items():
+            df = pd.DataFrame(vals, index=self._obj.index)
+            col_tuples = [(ch, label) for ch in channels]
+            df.columns = pd.MultiIndex.from_tuples(col_tuples, names=['channel', 'stat'])
+            frames.append(df)
 
-        
-        self._obj =  self._obj.join(df)
+        self._obj =  self._obj.join(pd.concat(frames, axis=1))
         return self._obj
 
 
 
         
-    def aggregate_rows(self, key):
-        # used for taking the mean over all seeds
-        print(f'Calculating mean over key={key}...')
-        in_fields = [x for x in self._fields if x != key]
-        out_fields = [x for x in list(self._obj) if x[0] not in self._fields]
-        in_atts = self._obj[in_fields].drop_duplicates()
-        new_dat = []
-        with click.progressbar(in_atts.iterrows()) as bar:
-            for _, x in bar:
-                filt = {k[0]: v for k, v in dict(x).items()}
-                new_dat.append(list(x) + list(self._obj(**filt)[out_fields].mean().values))
-            
+    def aggregate_rows(self, key, reducers='mean', weights=None):
+        '''
+        Aggregates the statistics over one or more tag fields, e.g. over all
+        seeds, in a single groupby. key is a field name or a list of field
+        names; rows are grouped by the remaining fields.
+
+        reducers is either a single reducer applied to every statistic, or a
+        dictionary of {stat label: reducer} where statistics not listed are
+        averaged. A reducer is one of
+            'mean'  the (weighted) mean,
+            'max', 'min',
+            'DEL'   the Woehler exponent weighted mean, (mean(x**m))**(1/m).
+                    m is read from stat labels such as DEL_m10 (4 for DEL),
+                    or given explicitly as ('DEL', m).
+        A list of reducers gives one column per reducer, labelled
+        {stat}_{reducer}.
+
+        weights is the name (or label) of a column holding probability
+        weights, e.g. a Weibull wind speed probability. Weighted means are
+        normalised by the sum of the weights within each group, so
+        aggregating DELs over wind speed and seed with the 'DEL' reducer
+        gives lifetime equivalent loads.
+        example: df.wetb.aggregate_rows(['wsp', 'seed'], {'DEL_m4': 'DEL'}, weights='prob')
+        '''
+        keys = [key] if isinstance(key, str) else list(key)
+        print(f'Calculating aggregate over key={", ".join(keys)}...')
+        in_fields = [x for x in self._fields if x not in keys]
+        out_fields = [x for x in list(self._obj) if x[0] not in self._fields
+                      and weights not in (x, x[0]) and pd.api.types.is_numeric_dtype(self._obj[x])]
+
+        groups = [self._obj[(x, '')].to_numpy() for x in in_fields] or [np.zeros(len(self._obj))]
+        if weights is None:
+            w = np.ones(len(self._obj))
+        else:
+            w = np.asarray(column(self._obj, weights), dtype=float)
+        X = pd.DataFrame(self._obj[out_fields].to_numpy(dtype=float), columns=range(len(out_fields)))
+
+        def weighted_mean(values):
+            valid = values.notna().to_numpy()
+            num = (values.fillna(0) * w[:, None]).groupby(groups, sort=False, dropna=False).sum()
+            den = pd.DataFrame(valid * w[:, None]).groupby(groups, sort=False, dropna=False).sum()
+            return num / den.to_numpy()
+
+        reduced, columns = [], []
+        grouped = X.groupby(groups, sort=False, dropna=False)
+        for i, (ch, stat) in enumerate(out_fields):
+            spec = reducers.get(stat, 'mean') if isinstance(reducers, dict) else reducers
+            specs = spec if isinstance(spec, list) else [spec]
+            for spec in specs:
+                name, m = (spec if isinstance(spec, tuple) else (spec, None))
+                if name == 'mean':
+                    reduced.append(weighted_mean(X[[i]])[i])
+                elif name in ('max', 'min'):
+                    reduced.append(getattr(grouped[i], name)())
+                elif name == 'DEL':
+                    if m is None:
+                        match = re.search(r'_m([\d.]+)', stat)
+                        m = float(match.group(1)) if match else 4
+                    reduced.append(weighted_mean(X[[i]]**m)[i]**(1/m))
+                else:
+                    raise ValueError(f'Unknown reducer {name}.')
+                label = stat if len(specs) == 1 else f'{stat}_{name}'
+                columns.append((ch, label))
+
+        out = pd.concat(reduced, axis=1) if reduced else pd.DataFrame(index=grouped.size().index)
+        atts = out.index.to_frame(index=False).iloc[:, :len(in_fields)]
+
         wetb_temp = self._obj.wetb
-        self._obj = HAWC2DataFrame(new_dat)
+        self._obj = HAWC2DataFrame(np.column_stack([atts.to_numpy(dtype=object),
+                                                    out.to_numpy(dtype=object)])).infer_objects()
         self._obj.wetb = wetb_temp
         # add multi index columns
-        col_ch     = in_fields + [x[0] for x in out_fields]
-        col_stat   = ['']*len(in_fields) + [x[1] for x in out_fields]
-        col_tuples = list(zip(*[col_ch, col_stat]))
+        col_tuples = [(x, '') for x in in_fields] + columns
         self._obj.columns = pd.MultiIndex.from_tuples(col_tuples,
                     names=['channel', 'stat'])
         return self._obj
@@ -216,6 +592,199 @@ class wetbAccessor(object):
             self._obj[(key_root, stat)] = self._obj[keys].mean(axis=1)
         return self
 
+
+    def spectra(self, channels=None, fs=None, nperseg=1024*8, noverlap=None, window='hann',
+                bands=None, freqs=None, n_jobs=1, chunksize=1, dtype=np.float32, **kwargs):
+        '''
+        Computes the Welch PSD of the given channels of the result files
+        matching the filter in kwargs. Returns a Spectra tuple (f, psd,
+        channels, index) where psd is a dense (simulation x channel x
+        frequency) array of the given dtype, f the shared frequency vector
+        and index the dataframe index of the simulations.
+
+        fs defaults to the sample rate of the first result file. The
+        frequency axis can be reduced by averaging over bands, given as a
+        number of log-spaced bands or as band edges, or by extracting the
+        frequencies in freqs (e.g. [1P, 3P]). Files which fail, or are
+        shorter than nperseg, are NaN and recorded in self.errors.
+        example: sp = df.wetb.spectra(['TbFA'], nperseg=4096, freqs=[0.2, 0.6], wsp=12)
+        '''
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        channels = self._channel_subset(channels)
+        index = self._obj(**kwargs).index if kwargs else self._obj.index
+        selected = set(index)
+        tasks = [task for task, idx in zip(self._tasks(channels), self._obj.index) if idx in selected]
+        if fs is None and tasks:
+            header = tasks[0][1] or read_sel(tasks[0][0])
+            fs = header.NSc / header.Time
+        f = frequency_axis(fs or 1.0, nperseg, bands, freqs)
+        psd = np.full((len(tasks), len(channels), len(f)), np.nan, dtype=dtype)
+        params = dict(fs=fs, nperseg=nperseg, noverlap=noverlap, window=window,
+                      bands=bands, freqs=freqs, dtype=dtype)
+        self.errors = {}
+
+        print(f'Calculating PSD for {", ".join(channels)}...')
+        if n_jobs > 1 and len(tasks) > 1:
+            pool = ProcessPoolExecutor(n_jobs)
+            results = pool.map(file_spectrum, *zip(*tasks), *[[v] * len(tasks) for v in params.values()],
+                               chunksize=chunksize)
+        else:
+            pool = None
+            results = (file_spectrum(*task, **params) for task in tasks)
+        try:
+            with click.progressbar(results, length=len(tasks)) as bar:
+                for i, (idx, (P, error)) in enumerate(zip(index, bar)):
+                    if error is None:
+                        psd[i] = P
+                    else:
+                        self.errors[idx] = error
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        for idx, error in self.errors.items():
+            print(f'File {self._filenames[idx]} could not be processed: {error}')
+        return Spectra(f, psd, list(channels), index)
+
+
+    def _state(self):
+        # the links to the result files, stored along with saved tables, or
+        # None for a dataframe which is not linked (e.g. from read_csv)
+        if getattr(self, '_directory', None) is None:
+            return None
+        return {'directory': self._directory, 'fields': self._fields,
+                'filenames': self._filenames,
+                'channels': {k: to_json(v) for k, v in self.channels.items()},
+                'errors': sorted(getattr(self, 'errors', {}).items())}
+
+
+    @staticmethod
+    def _restore(df, state, index=None):
+        # attaches an accessor with the given state to a HAWC2DataFrame
+        df.wetb = wetbAccessor(df)
+        df.wetb._directory = state['directory']
+        df.wetb._fields = state['fields']
+        df.wetb._filenames = state['filenames']
+        df.wetb.channels = {k: from_json(v) for k, v in state['channels'].items()}
+        df.wetb.errors = {int(idx): error for idx, error in state.get('errors', [])}
+        df.wetb._index = index
+        return df
+
+
+    def to_parquet(self, filename, **kwargs):
+        '''
+        Writes the dataframe to a Parquet file. Unlike csv, the (channel, stat)
+        column index and the column types are kept, along with the links to
+        the result files, so statistics can still be added after reading the
+        file with read_parquet. Requires pyarrow.
+        '''
+        out = pd.DataFrame(self._obj, copy=False)
+        state = self._state()
+        out.attrs = {'wetb': state} if state else {}
+        out.to_parquet(filename, **kwargs)
+
+
+    @staticmethod
+    def read_parquet(filename):
+        '''
+        Reads a Parquet file written by to_parquet. Returns a HAWC2DataFrame.
+        '''
+        raw = pd.read_parquet(filename)
+        df = HAWC2DataFrame(raw)
+        if raw.attrs.get('wetb'):
+            wetbAccessor._restore(df, raw.attrs['wetb'])
+        else:
+            df.wetb = wetbAccessor(df)
+        return df
+
+
+    def to_pickle(self, filename):
+        '''
+        Writes the dataframe and the links to the result files to a pickle
+        file, as to_parquet but without the pyarrow dependency.
+        '''
+        out = pd.DataFrame(self._obj, copy=False)
+        state = self._state()
+        out.attrs = {'wetb': state} if state else {}
+        out.to_pickle(filename)
+
+
+    @staticmethod
+    def read_pickle(filename):
+        '''
+        Reads a pickle file written by to_pickle. Returns a HAWC2DataFrame.
+        '''
+        raw = pd.read_pickle(filename)
+        df = HAWC2DataFrame(raw)
+        if raw.attrs.get('wetb'):
+            wetbAccessor._restore(df, raw.attrs['wetb'])
+        else:
+            df.wetb = wetbAccessor(df)
+        return df
+
+
+    def shard(self, i, n_shards, by='size'):
+        '''
+        Returns the rows of shard i of n_shards as a new HAWC2DataFrame, on
+        which statistics can be computed independently of the other shards.
+        Rows are assigned to shards deterministically, balanced by result
+        size (number of scans times channels) if by is 'size', or by a hash
+        of the filename if by is 'hash'. See hawcast.sharding.
+        example:
+            part = df.wetb.shard(3, 8).wetb.compute(['mean', 'DEL'])
+            part.wetb.to_pickle(part_filename('postproc', 3, 8))
+        '''
+        names = [self._filenames[idx] for idx in self._obj.index]
+        costs = None
+        if by == 'size':
+            costs = []
+            for idx in self._obj.index:
+                header = self.header(idx)
+                costs.append(header.NSc * header.NCh)
+        shards = np.array(assign_shards(names, n_shards, costs), dtype=int)
+        return self.subset(self._obj.index[shards == i])
+
+
+    def subset(self, index):
+        '''
+        Returns the rows with the given index labels as a new HAWC2DataFrame
+        with its own accessor, so that statistics can be computed for these
+        rows alone.
+        '''
+        df = HAWC2DataFrame(pd.DataFrame(self._obj, copy=False).loc[index])
+        return wetbAccessor._restore(df, self._state(), getattr(self, '_index', None))
+
+
+    @staticmethod
+    def merge_shards(filenames):
+        '''
+        Combines the partial tables written by the shards (with to_pickle)
+        into one HAWC2DataFrame in the original row order. Raises an error if
+        the shards were linked to different result files.
+        '''
+        parts = [pd.read_pickle(fn) for fn in filenames]
+        states = [part.attrs['wetb'] for part in parts]
+        for fn, state in zip(filenames[1:], states[1:]):
+            if state['filenames'] != states[0]['filenames']:
+                raise ValueError(f'{fn} was computed from other result files than {filenames[0]}.')
+        df = HAWC2DataFrame(pd.concat(parts).sort_index())
+        state = dict(states[0], errors=sorted(x for state in states for x in state['errors']))
+        return wetbAccessor._restore(df, state)
+
+
+    def to_store(self, path, channels=None, dtype=None, **kwargs):
+        '''
+        Converts the result files matching the filter in kwargs into a
+        columnar store (see hawcast.columnar) holding the given channels, by
+        default all linked channels. Returns the ColumnarStore.
+        '''
+        channels = list(self._channel_subset(channels).values())
+        if any(isinstance(ch, Derived) for ch in channels):
+            raise ValueError('Derived channels can not be stored, select raw channels only.')
+        rows = self._obj(**kwargs).index if kwargs else self._obj.index
+        filenames = [os.path.join(self._directory, self._filenames[idx]) for idx in rows]
+        return convert_results(filenames, path, channels, dtype)
+
     
     @staticmethod
     def read_csv(filename):
@@ -236,37 +805,79 @@ class wetbAccessor(object):
 
 
 
-@wetbAccessor.populate_method('DEL')
-def DEL(x, m=4):
-    DEL = []
-    for k in list(x):
-        DEL.append(eq_load(x[k].values, m=m)[0][0])
-    return DEL
+# the built in statistics take the (time x channel) array of a result file
+@wetbAccessor.populate_method('DEL', batch='m', array=True)
+def DEL(x, m=4, neq=1):
+    # each channel is rainflow counted once, also when m is a list of
+    # Woehler exponents, in which case a list of DELs per exponent is returned.
+    DEL = equivalent_loads(x, m=m, neq=neq)[0]
+    if np.ndim(m) == 0:
+        return list(DEL[0])
+    return [list(d) for d in DEL]
     
-@wetbAccessor.populate_method('mean', label='Mean')
+@wetbAccessor.populate_method('mean', label='Mean', array=True)
 def _mean(x):
-    return x.mean().values
+    return x.mean(axis=0)
     
-@wetbAccessor.populate_method('var', label='Var')
+@wetbAccessor.populate_method('var', label='Var', array=True)
 def _var(x):
-    return x.var().values
+    return x.var(axis=0, ddof=1)
 
-@wetbAccessor.populate_method('std', label='Std')
+@wetbAccessor.populate_method('std', label='Std', array=True)
 def _std(x):
-    return x.std().values
+    return x.std(axis=0, ddof=1)
 
 
-@wetbAccessor.populate_method('final')
+@wetbAccessor.populate_method('min', label='Min', array=True)
+def _min(x):
+    return x.min(axis=0)
+
+@wetbAccessor.populate_method('max', label='Max', array=True)
+def _max(x):
+    return x.max(axis=0)
+
+@wetbAccessor.populate_method('final', array=True)
 def _final(x):
-    return x.iloc[-1].values
-
-@wetbAccessor.populate_method('PSD')
-def _psd(x, fs=100):
-    PSD = []
-    for k in list(x):
-        f, Py = signal.welch(x[k].values, fs=fs, nperseg=1024*8)
-        PSD.append(Py)
-    return PSD
-            
+    return x[-1].copy()
+
+@wetbAccessor.populate_method('PSD', array=True)
+def _psd(x, fs=100, nperseg=1024*8, noverlap=None):
+    # one PSD array per channel. Use wetbAccessor.spectra for a dense array.
+    from scipy import signal
+    f, Pxx = signal.welch(x, fs=fs, nperseg=nperseg, noverlap=noverlap, axis=0)
+    return list(Pxx.T)
+
+
+
+def _stream_DEL(acc, m=4, neq=1):
+    # the cycle histograms counted while streaming. Channels without cycles
+    # give NaN, as DEL.
+    DEL = np.array([equivalent_load_from_cycles(h, m, neq)[0] if h.cycles.sum() else np.full(np.size(m), np.nan)
+                    for h in acc.histograms()]).T
+    if np.ndim(m) == 0:
+        return list(DEL[0])
+    return [list(d) for d in DEL]
+
+# streaming versions of the statistics, {func: (accumulator kind, finaliser)}
+_streaming = {
+    _mean   : ('stats', lambda acc: list(acc.mean)),
+    _var    : ('stats', lambda acc: list(acc.var)),
+    _std    : ('stats', lambda acc: list(acc.std)),
+    _min    : ('stats', lambda acc: list(acc.min)),
+    _max    : ('stats', lambda acc: list(acc.max)),
+    _final  : ('stats', lambda acc: list(acc.final)),
+    DEL     : ('rainflow', _stream_DEL),
+    _psd    : ('welch', lambda acc, **kwargs: list(acc.result()[1])),
+}
+
+# {accumulator kind: (factory, keyword arguments passed to the factory)}.
+# Statistics with the same kind and factory arguments share an accumulator.
+_accumulators = {
+    'stats'          : (StreamingStats, ()),
+    'rainflow'       : (RainflowAccumulator, ()),
+    'welch'          : (lambda fs=100, nperseg=1024*8, noverlap=None: WelchAccumulator(fs, nperseg, noverlap),
+                        ('fs', 'nperseg', 'noverlap')),
+}
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,53 @@
+'''
+Bounded prefetching of result files.
+
+Iterating over simulation results one at a time leaves the disk (or network
+file system) idle while the caller processes a result, and the caller idle
+while the next result is read. prefetch keeps the next few items loading in
+background threads while the current one is processed. Results are yielded
+in order, and at most depth results are held in memory besides the one being
+processed.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(func, items, depth=4, n_threads=None):
+    '''
+    Yields (item, func(item), error) for each item in order. The next depth
+    items are loaded by n_threads (default depth) background threads while
+    the caller processes the current one. If func raises, the result is None
+    and error is the exception; iteration continues with the next item. With
+    depth 0, items are loaded synchronously.
+    '''
+    items = iter(items)
+    if depth <= 0:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    pool = ThreadPoolExecutor(n_threads or depth)
+    queue = deque()
+    try:
+        for item in items:
+            queue.append((item, pool.submit(func, item)))
+            if len(queue) == depth:
+                break
+        while queue:
+            item, future = queue.popleft()
+            # keep depth items loading while this one is processed
+            for following in items:
+                queue.append((following, pool.submit(func, following)))
+                break
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            yield item, result, error
+    finally:
+        for _, future in queue:
+            future.cancel()
+        pool.shutdown()
@@ -0,0 +1,157 @@
+'''
+Lightweight instrumentation of hawcast stages.
+
+Library code marks stages with `with stage('read_dat'):` and counts work
+with `count('dat_bytes', n)`. Nothing is recorded unless a Profiler is
+active, in which case the total time and number of calls of every stage, and
+the counters, are collected and can be written as a JSON summary and as a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+
+example:
+    with Profiler(json_fn='profile.json', trace_fn='trace.json') as prof:
+        df.wetb.compute(['mean', 'DEL'])
+    print(prof.report())
+
+Stages running in worker processes (n_jobs > 1) are not recorded.
+'''
+import os
+import json
+import time
+import threading
+
+
+_active = None
+
+
+class _NullStage(object):
+    # returned by stage() when profiling is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_stage = _NullStage()
+
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+
+def stage(name):
+    '''
+    Returns a context manager timing the stage name if a Profiler is active.
+    '''
+    if _active is None:
+        return _null_stage
+    return _Stage(_active, name)
+
+
+def count(name, value=1):
+    '''
+    Adds value to the counter name if a Profiler is active.
+    '''
+    if _active is not None:
+        _active.add(name, value)
+
+
+
+class Profiler(object):
+    '''
+    Collects stage timers and counters while active (used as a context
+    manager). If json_fn or trace_fn are given, the summary and the Chrome
+    trace are written to them when the profiler is stopped.
+    '''
+    def __init__(self, json_fn=None, trace_fn=None):
+        self.json_fn = json_fn
+        self.trace_fn = trace_fn
+        self.stages = {}
+        self.counters = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._previous = None
+        self._start = None
+        self.wall_time = None
+
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        _active = self._previous
+        self.wall_time = time.perf_counter() - self._start
+        if self.json_fn:
+            self.write_json(self.json_fn)
+        if self.trace_fn:
+            self.write_trace(self.trace_fn)
+        return False
+
+
+    def record(self, name, start, end):
+        with self._lock:
+            calls, total = self.stages.get(name, (0, 0.))
+            self.stages[name] = (calls + 1, total + end - start)
+            if self.trace_fn:
+                self.events.append((name, start, end, threading.get_ident()))
+
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def summary(self):
+        '''
+        Returns {'wall_time', 'stages': {name: {'calls', 'seconds'}},
+        'counters': {name: value}}.
+        '''
+        wall_time = self.wall_time
+        if wall_time is None and self._start is not None:
+            wall_time = time.perf_counter() - self._start
+        return {'wall_time': wall_time,
+                'stages': {name: {'calls': calls, 'seconds': total}
+                           for name, (calls, total) in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items()))}
+
+
+    def report(self):
+        # a text table of the summary
+        summary = self.summary()
+        lines = [f'{"stage":<28}{"calls":>10}{"seconds":>12}']
+        for name, s in summary['stages'].items():
+            lines.append(f'{name:<28}{s["calls"]:>10}{s["seconds"]:>12.3f}')
+        for name, value in summary['counters'].items():
+            lines.append(f'{name:<28}{value:>22}')
+        lines.append(f'{"wall time":<28}{summary["wall_time"]:>22.3f}')
+        return '\n'.join(lines)
+
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+    def write_trace(self, filename):
+        # Chrome trace event format, with complete ('X') events in us
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self._start) * 1e6, 'dur': (end - start) * 1e6}
+                  for name, start, end, tid in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'otherData': self.counters}, f)
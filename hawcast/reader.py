@@ -0,0 +1,171 @@
+'''
+Memory-mapped reading of HAWC2 binary result files.
+
+A HAWC2 binary result consists of a .sel header file and a .dat file holding
+NCh consecutive blocks of NSc int16 samples, one block per channel. The
+Hawc2Result class maps the .dat file into memory so that channels are only
+read from disk (and scaled) when they are asked for.
+'''
+import os
+from collections import namedtuple
+import numpy as np
+
+from . import profiling
+
+
+SelHeader = namedtuple('SelHeader', ['NSc', 'NCh', 'Time', 'Format', 'scale_factors'])
+
+
+def read_sel(filename):
+    '''
+    Parses the header of a HAWC2 .sel file. The filename is given without the
+    .sel extension. Returns a SelHeader.
+    '''
+    with profiling.stage('parse_header'):
+        with open(filename + '.sel') as f:
+            lines = f.readlines()
+
+        fields = lines[8].split()
+        NSc, NCh = int(fields[0]), int(fields[1])
+        scale_factors = np.array([float(x) for x in lines[NCh+14:] if x.strip()])
+    profiling.count('headers')
+    return SelHeader(NSc, NCh, float(fields[2]), fields[3], scale_factors)
+
+
+
+class Hawc2Result(object):
+    '''
+    A lazy, memory-mapped view of a HAWC2 binary result file. Nothing is read
+    from the .dat file until a channel is accessed. Channel numbers are one
+    based, as in the .sel file.
+
+    example:
+        with Hawc2Result('res/dlc12/dlc12_wsp10_s1001') as res:
+            x = res.read({'Mx1': 26, 'My1': 27}, dtype=np.float32)
+    '''
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.header = header or read_sel(filename)
+        if self.header.Format.upper() != 'BINARY':
+            raise ValueError(f'{filename}.sel is not a binary result file.')
+        self._data = np.memmap(filename + '.dat', dtype='<i2', mode='r',
+                               shape=(self.header.NCh, self.header.NSc))
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return 'Hawc2Result {} ({} channels, {} scans)'.format(
+            self.filename, self.header.NCh, self.header.NSc)
+
+
+    def close(self):
+        '''
+        Releases the memory map. Views handed out by __getitem__ keep the
+        mapping alive until they are garbage collected.
+        '''
+        self._data = None
+
+
+    @property
+    def closed(self):
+        return self._data is None
+
+
+    def __getitem__(self, ch):
+        # unscaled int16 view of a single channel. No data is copied.
+        return self._data[ch-1]
+
+
+    def channel(self, ch, dtype=np.float64):
+        '''
+        Returns a single scaled channel as a new array of the given dtype.
+        '''
+        with profiling.stage('read_dat'):
+            profiling.count('dat_bytes', self._data.shape[1] * 2)
+            return np.multiply(self._data[ch-1], self.header.scale_factors[ch-1], dtype=dtype)
+
+
+    def _channel_index(self, channels):
+        if channels is None:
+            return np.arange(self.header.NCh)
+        elif isinstance(channels, dict):
+            return np.fromiter(channels.values(), dtype=int, count=len(channels)) - 1
+        return np.asarray(channels, dtype=int) - 1
+
+
+    def read(self, channels=None, dtype=np.float64):
+        '''
+        Returns a (time x channel) array of the requested channels, scaled and
+        cast to dtype. channels is either a dictionary of {name: channel} as
+        used in the definition files, or a list of channel numbers. All
+        channels are gathered from the memory map in a single indexing
+        operation.
+        '''
+        idx = self._channel_index(channels)
+        with profiling.stage('read_dat'):
+            raw = self._data[idx]
+            profiling.count('dat_bytes', raw.nbytes)
+            return np.multiply(raw.T, self.header.scale_factors[idx], dtype=dtype)
+
+
+    def iter_blocks(self, channels=None, blocksize=60000, dtype=np.float64):
+        '''
+        Yields consecutive (time x channel) blocks of at most blocksize scans,
+        scaled and cast to dtype. Only one block is held in memory at a time.
+        '''
+        idx = self._channel_index(channels)
+        scale = self.header.scale_factors[idx]
+        for start in range(0, self.header.NSc, blocksize):
+            with profiling.stage('read_dat'):
+                raw = self._data[idx, start:start + blocksize]
+                profiling.count('dat_bytes', raw.nbytes)
+                block = np.multiply(raw.T, scale, dtype=dtype)
+            yield block
+
+
+
+def write_hawc2_res(filename, data, names=None, time=None):
+    '''
+    Writes a (time x channel) array as a HAWC2 binary result file pair
+    (filename.sel and filename.dat). The scale factors are chosen so that
+    each channel uses the full int16 range. Mainly used for testing.
+    '''
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64).T).T
+    NSc, NCh = data.shape
+    names = names or [f'channel {i+1}' for i in range(NCh)]
+    time = NSc / 100 if time is None else time
+
+    peak = np.abs(data).max(axis=0)
+    scale_factors = np.where(peak > 0, peak / 32000, 1.0)
+    scale_factors = np.array([float(f'{s:.5E}') for s in scale_factors])
+    ints = np.round(data / scale_factors).astype('<i2')
+
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    rule = '_' * 120 + '\n'
+    lines = [rule,
+             '  Version ID : hawcast\n',
+             ' ' * 60 + 'Time : 00:00:00\n',
+             ' ' * 60 + 'Date : 01:01.2000\n',
+             rule,
+             f'  Result file : {os.path.basename(filename)}.dat\n',
+             rule,
+             '   Scans    Channels    Time [sec]      Format\n',
+             f'{NSc:>12}{NCh:>10}{time:>16.3f}       BINARY\n',
+             '\n',
+             '  Channel   Variable Descriptions\n',
+             ' \n']
+    lines += [f'{i+1:>7}      {name}\n' for i, name in enumerate(names)]
+    lines += [rule, 'Scale factors:\n']
+    lines += [f'  {s:.5E}\n' for s in scale_factors]
+
+    with open(filename + '.sel', 'w') as f:
+        f.writelines(lines)
+    ints.T.tofile(filename + '.dat')
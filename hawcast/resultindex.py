@@ -0,0 +1,220 @@
+'''
+A persistent index of the HAWC2 result files in a directory.
+
+The index is a small SQLite database, by default stored next to the results
+(see index_path for other locations). It holds the parsed .sel header of
+every result file (including the scale factors) along with the size and
+modification time of the .sel and .dat files, so that headers are only
+parsed again when a file has changed. Filename tags matched against a
+pattern are cached as well.
+'''
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+from .reader import SelHeader, read_sel
+from . import profiling
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    name      TEXT PRIMARY KEY,
+    sel_mtime INTEGER,
+    sel_size  INTEGER,
+    dat_mtime INTEGER,
+    dat_size  INTEGER,
+    NSc       INTEGER,
+    NCh       INTEGER,
+    Time      REAL,
+    Format    TEXT,
+    scale     BLOB
+);
+CREATE TABLE IF NOT EXISTS tags (
+    pattern   TEXT,
+    name      TEXT,
+    tags      TEXT,
+    PRIMARY KEY (pattern, name)
+);
+'''
+
+
+def index_path(directory, index=True):
+    '''
+    The location of the index of a result directory: in the directory if
+    index is True, or in index if it is the path of another directory (e.g.
+    when the results are shared), named after the result directory. Returns
+    None if index is False or the location is not writable, in which case
+    results are linked without an index.
+    '''
+    if not index:
+        return None
+    if index is True:
+        path = os.path.join(directory, ResultIndex.filename)
+    else:
+        name = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+        path = os.path.join(index, f'{name}.sqlite')
+        os.makedirs(index, exist_ok=True)
+    if os.path.exists(path):
+        return path if os.access(path, os.W_OK) else None
+    return path if os.access(os.path.dirname(path) or '.', os.W_OK) else None
+
+
+
+class ResultIndex(object):
+    '''
+    On-disk index of the .sel/.dat result pairs in a directory. The index is
+    brought up to date on construction; only entries whose files were added,
+    changed or removed since the last refresh are touched. Results whose
+    .sel header can not be parsed are listed by names() and match() (in
+    directory order, as os.listdir), with the error in self.errors.
+
+    example:
+        index = ResultIndex('res/dlc12')
+        for name, tags in index.match(re.compile('dlc12_wsp(.*)_s(.*)')):
+            header = index.header(name)
+    '''
+    filename = '.hawcast_index.sqlite'
+
+    def __init__(self, directory, path=None, refresh=True):
+        self.directory = directory
+        self.path = path or os.path.join(directory, self.filename)
+        # headers are also looked up from the threads prefetching results
+        try:
+            self._con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._con.executescript(_SCHEMA)
+        except sqlite3.OperationalError:
+            # read-only result directory. Keep the index in memory instead.
+            self._con = sqlite3.connect(':memory:', check_same_thread=False)
+            self._con.executescript(_SCHEMA)
+        self._headers = None
+        self._names = None
+        self.errors = {}
+        self._lock = threading.Lock()
+        if refresh:
+            self.refresh()
+
+
+    def __repr__(self):
+        return 'ResultIndex {} ({} results)'.format(self.directory, len(self))
+
+    def __len__(self):
+        return self._con.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def __contains__(self, name):
+        return self._con.execute('SELECT 1 FROM results WHERE name=?', (name,)).fetchone() is not None
+
+
+    def close(self):
+        self._con.close()
+
+
+    def refresh(self):
+        '''
+        Scans the directory and re-parses the headers of new or modified
+        result files. Returns the names of the entries that were updated.
+        '''
+        stats = {}
+        with profiling.stage('discover'), os.scandir(self.directory) as it:
+            for entry in it:
+                root, ext = os.path.splitext(entry.name)
+                if ext in ('.sel', '.dat'):
+                    st = entry.stat()
+                    stats[(root, ext)] = (st.st_mtime_ns, st.st_size)
+
+        on_disk = {}
+        for (root, ext), (sel_mtime, sel_size) in stats.items():
+            if ext == '.sel':
+                dat_mtime, dat_size = stats.get((root, '.dat'), (None, None))
+                on_disk[root] = (sel_mtime, sel_size, dat_mtime, dat_size)
+
+        known = {row[0]: tuple(row[1:]) for row in self._con.execute(
+            'SELECT name, sel_mtime, sel_size, dat_mtime, dat_size FROM results')}
+
+        updated, rows, errors = [], [], {}
+        for name, key in on_disk.items():
+            if known.get(name) == key:
+                continue
+            try:
+                header = read_sel(os.path.join(self.directory, name))
+            except (OSError, ValueError, IndexError) as e:
+                # unreadable or partially written header, parsed again at the
+                # next refresh
+                errors[name] = f'{type(e).__name__}: {e}'
+                continue
+            rows.append((name, *key, header.NSc, header.NCh, header.Time,
+                         header.Format, header.scale_factors.astype(np.float64).tobytes()))
+            updated.append(name)
+
+        removed = [(name,) for name in known if name not in on_disk or name in errors]
+        with self._con:
+            self._con.executemany('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+            self._con.executemany('DELETE FROM results WHERE name=?', removed)
+            self._con.executemany('DELETE FROM tags WHERE name=?', removed)
+
+        if updated or removed:
+            self._headers = None
+        self._names = list(on_disk)
+        self.errors = errors
+        return updated
+
+
+    def names(self):
+        # the results in directory order, or by name if the index was not
+        # refreshed
+        if self._names is not None:
+            return list(self._names)
+        return [row[0] for row in self._con.execute('SELECT name FROM results ORDER BY name')]
+
+
+    def stat(self, name):
+        '''
+        Returns (sel_mtime, sel_size, dat_mtime, dat_size) of a result as
+        recorded at the last refresh. Times are in nanoseconds.
+        '''
+        return self._con.execute('SELECT sel_mtime, sel_size, dat_mtime, dat_size '
+                                 'FROM results WHERE name=?', (name,)).fetchone()
+
+
+    def header(self, name):
+        '''
+        Returns the cached SelHeader of a result file.
+        '''
+        with self._lock:
+            if self._headers is None:
+                headers = {}
+                for name_, NSc, NCh, Time, Format, scale in self._con.execute(
+                        'SELECT name, NSc, NCh, Time, Format, scale FROM results'):
+                    headers[name_] = SelHeader(NSc, NCh, Time, Format,
+                                               np.frombuffer(scale, dtype=np.float64))
+                self._headers = headers
+        return self._headers[name]
+
+
+    def match(self, pattern):
+        '''
+        Returns a list of (name, tags) for all results whose name matches the
+        compiled regular expression pattern. tags is the tuple of matched
+        groups. Match results are cached in the index per pattern.
+        '''
+        cached = {row[0]: row[1] for row in self._con.execute(
+            'SELECT name, tags FROM tags WHERE pattern=?', (pattern.pattern,))}
+
+        out, new = [], []
+        for name in self.names():
+            if name in cached:
+                tags = cached[name]
+                tags = None if tags is None else tuple(json.loads(tags))
+            else:
+                m = pattern.match(name)
+                tags = m.groups() if m else None
+                new.append((pattern.pattern, name, None if tags is None else json.dumps(tags)))
+            if tags is not None:
+                out.append((name, tags))
+
+        if new:
+            with self._con:
+                self._con.executemany('INSERT OR REPLACE INTO tags VALUES (?,?,?)', new)
+        return out
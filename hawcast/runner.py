@@ -0,0 +1,142 @@
+'''
+Local parallel execution of HAWC2 simulations.
+
+Simulations are run from the project directory, as in the .bat launch files,
+with htc files in htc/[casename]/ and results written to the output filename
+given in the htc file (res/[casename]/[case_id] by convention). Jobs whose
+results already exist and are complete are skipped, so an interrupted
+campaign can be resumed by running the same command again.
+'''
+import os
+import shlex
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .htcscan import scan_htc_file
+
+
+def result_base(htc_fn):
+    '''
+    Returns the result filename (without extension) of a htc file, taken
+    from output.filename, or res/[casename]/[case_id] if there is none.
+    '''
+    try:
+        values, _ = scan_htc_file(htc_fn)
+        return os.path.normpath(values['output.filename'])
+    except (OSError, KeyError):
+        casename = os.path.relpath(os.path.dirname(htc_fn), 'htc')
+        jobname = os.path.splitext(os.path.basename(htc_fn))[0]
+        return os.path.join('res', casename, jobname)
+
+
+def result_complete(base):
+    '''
+    True if the .sel and .dat files of a result exist and the .dat file has
+    the size given by the number of scans and channels in the .sel file.
+    '''
+    try:
+        with open(base + '.sel') as f:
+            lines = f.readlines()
+        NSc, NCh, _, Format = lines[8].split()[:4]
+        dat_size = os.path.getsize(base + '.dat')
+    except (OSError, IndexError, ValueError):
+        return False
+    if Format.upper() == 'BINARY':
+        return dat_size == int(NSc) * int(NCh) * 2
+    return dat_size > 0
+
+
+
+class Runner(object):
+    '''
+    Runs HAWC2 (or any executable taking a htc file as its last argument) on
+    a list of htc files with at most n_jobs simultaneous processes. The
+    output of each job is streamed to run_out/[casename]/[case_id].out.
+    Failed jobs are retried up to retries times.
+
+    example:
+        out = Runner('hawc2mb', n_jobs=8).run(htc_files)
+    '''
+    def __init__(self, exe='hawc2mb', n_jobs=1, retries=1, out_dir='run_out', echo=False):
+        self.cmd = shlex.split(exe) if isinstance(exe, str) else list(exe)
+        self.n_jobs = n_jobs
+        self.retries = retries
+        self.out_dir = out_dir
+        self.echo = echo
+        self._lock = threading.Lock()
+
+
+    def out_file(self, htc_fn):
+        casename = os.path.relpath(os.path.dirname(htc_fn), 'htc')
+        jobname = os.path.splitext(os.path.basename(htc_fn))[0]
+        return os.path.join(self.out_dir, casename, jobname + '.out')
+
+
+    def run_job(self, htc_fn):
+        '''
+        Runs a single job, retrying on failure. A job has succeeded if the
+        process exits with status zero and its result files are complete.
+        Returns None on success, otherwise an error message.
+        '''
+        base = result_base(htc_fn)
+        out_fn = self.out_file(htc_fn)
+        os.makedirs(os.path.dirname(out_fn), exist_ok=True)
+        jobname = os.path.splitext(os.path.basename(htc_fn))[0]
+
+        error = None
+        for attempt in range(self.retries + 1):
+            with open(out_fn, 'a') as out:
+                out.write(f'# attempt {attempt + 1}: {" ".join(self.cmd + [htc_fn])}\n')
+                try:
+                    proc = subprocess.Popen(self.cmd + [htc_fn], stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, text=True, errors='replace')
+                except OSError as e:
+                    # e.g. the executable does not exist
+                    error = f'{type(e).__name__}: {e}'
+                    out.write(f'# {error}\n')
+                    continue
+                for line in proc.stdout:
+                    out.write(line)
+                    out.flush()
+                    if self.echo:
+                        with self._lock:
+                            print(f'[{jobname}] {line}', end='')
+                returncode = proc.wait()
+
+            if returncode != 0:
+                error = f'exit status {returncode} (see {out_fn})'
+            elif not result_complete(base):
+                error = f'result {base} is missing or incomplete'
+            else:
+                return None
+        return error
+
+
+    def run(self, htc_files, force=False, callback=None):
+        '''
+        Runs all jobs whose results are not complete yet (all jobs if force
+        is True). callback(htc_fn, error) is called as each job finishes.
+        Returns {'done': [...], 'skipped': [...], 'failed': {htc_fn: error}}.
+        '''
+        out = {'done': [], 'skipped': [], 'failed': {}}
+        todo = []
+        for htc_fn in htc_files:
+            if not force and result_complete(result_base(htc_fn)):
+                out['skipped'].append(htc_fn)
+            else:
+                todo.append(htc_fn)
+
+        def job(htc_fn):
+            error = self.run_job(htc_fn)
+            with self._lock:
+                if error is None:
+                    out['done'].append(htc_fn)
+                else:
+                    out['failed'][htc_fn] = error
+                if callback is not None:
+                    callback(htc_fn, error)
+
+        with ThreadPoolExecutor(self.n_jobs) as pool:
+            list(pool.map(job, todo))
+        return out
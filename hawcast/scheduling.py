@@ -0,0 +1,143 @@
+'''
+Cost estimates for HAWC2 simulations and load balancing of launch scripts.
+
+The cost of a simulation is estimated from its htc file as the number of time
+steps (time_stop / deltat), weighted by the number of output channels. Where
+a previous run left a HAWC2 log file with its elapsed time, the wall times
+are used to calibrate the estimate to seconds. Jobs are then distributed
+over batches with the longest-processing-time-first heuristic. htc2bat
+only balances the batches if asked to; by default it distributes the jobs
+round-robin, as before.
+'''
+import os
+import re
+import heapq
+from statistics import median
+
+from .htcscan import scan_htc_file
+from . import profiling
+
+
+DEFAULT_DELTAT = 0.02
+# relative cost of writing one output channel, per time step
+OUTPUT_WEIGHT = 0.01
+# commands of the output block which are not channels
+OUTPUT_COMMANDS = ('filename', 'data_format', 'buffer', 'time')
+
+_elapsed = re.compile(r'elapsed time\s*:\s*([\d.]+)', re.IGNORECASE)
+
+
+def output_channels(values, counts):
+    '''
+    Estimates the number of output channels from scan_htc results, as the
+    number of lines in output blocks minus the setup commands
+    (OUTPUT_COMMANDS) found in them. Returns 0 if the htc file has no output
+    block, e.g. when it is included with continue_in_file, in which case the
+    cost only counts time steps.
+    '''
+    n = counts.get('output', 0) - sum(f'output.{x}' in values for x in OUTPUT_COMMANDS)
+    return max(n, 0)
+
+
+def model_cost(htc_fn):
+    '''
+    Returns the relative cost of a simulation, the number of time steps
+    times (1 + OUTPUT_WEIGHT * number of output channels), along with the
+    log file name given in the htc file.
+    '''
+    values, counts = scan_htc_file(htc_fn)
+    try:
+        time_stop = float(values['simulation.time_stop'].split()[0])
+    except (KeyError, ValueError, IndexError):
+        time_stop = 600.
+    try:
+        deltat = float(values['simulation.newmark.deltat'].split()[0])
+    except (KeyError, ValueError, IndexError):
+        deltat = DEFAULT_DELTAT
+    n_out = output_channels(values, counts)
+    return time_stop / deltat * (1 + OUTPUT_WEIGHT * n_out), values.get('simulation.logfile')
+
+
+def log_wall_time(log_fn):
+    '''
+    Returns the elapsed time in seconds recorded in a HAWC2 log file, or
+    None if the file does not exist or the simulation did not finish.
+    '''
+    try:
+        with open(log_fn, errors='ignore') as f:
+            matches = _elapsed.findall(f.read())
+    except OSError:
+        return None
+    return float(matches[-1]) if matches else None
+
+
+def estimate_costs(htc_files, use_logs=True):
+    '''
+    Estimates the cost of each htc file. If use_logs is True and some
+    simulations have a log file with an elapsed time, those wall times are
+    used directly and the others are scaled to seconds with the median ratio
+    of wall time to model cost. Returns (costs, unit), where unit is
+    'seconds' or 'relative'.
+    '''
+    models, walls = [], []
+    for htc_fn in htc_files:
+        cost, log_fn = model_cost(htc_fn)
+        models.append(cost)
+        walls.append(log_wall_time(log_fn) if use_logs and log_fn else None)
+
+    ratios = [w / m for w, m in zip(walls, models) if w and m]
+    if not ratios:
+        return models, 'relative'
+    scale = median(ratios)
+    return [w if w else m * scale for w, m in zip(walls, models)], 'seconds'
+
+
+def lpt_schedule(costs, n):
+    '''
+    Distributes jobs over n batches with the longest-processing-time-first
+    heuristic: jobs are taken in order of decreasing cost and each is given
+    to the batch with the smallest total so far. Returns a list of n lists
+    of job indices and a list of the total cost (makespan) of each batch.
+    '''
+    heap = [(0., i) for i in range(n)]
+    batches = [[] for _ in range(n)]
+    loads = [0.] * n
+    for job in sorted(range(len(costs)), key=lambda j: -costs[j]):
+        load, i = heapq.heappop(heap)
+        batches[i].append(job)
+        loads[i] = load + costs[job]
+        heapq.heappush(heap, (loads[i], i))
+    return batches, loads
+
+
+def htc2bat(htc_dir, n=1, filter='all', app='hawc2mb', balance=False):
+    # writes the htc files of htc_dir into n .bat launch files in bat/. The
+    # jobs are distributed round-robin, or if balance is True, by their
+    # estimated cost (see estimate_costs). Returns the expected makespan of
+    # each .bat file and its unit ('seconds', 'relative' or 'jobs').
+
+    with profiling.stage('discover'):
+        htc_files = [os.path.join(htc_dir, x) for x in os.listdir(htc_dir) if x.endswith('.htc')]
+    bat_dir = 'bat'
+    if not os.path.exists(bat_dir):
+        os.makedirs(bat_dir)
+
+    if balance:
+        costs, unit = estimate_costs(htc_files)
+        batches, makespans = lpt_schedule(costs, n)
+        chunks = [[htc_files[i] for i in batch] for batch in batches]
+    else:
+        chunks = chunkify(htc_files, n)
+        makespans, unit = [len(chunk) for chunk in chunks], 'jobs'
+
+    for i, chunk in enumerate(chunks):
+        with open(os.path.join(bat_dir, f'{i+1}.bat'), 'w') as f:
+            f.write('cd ..\n')
+            for file in chunk:
+                f.write(f'{app} {file}\n')
+    return makespans, unit
+
+
+def chunkify(lst, n):
+# splits a list into n groups of approximately the same length
+    return [lst[i::n] for i in range(n)]
@@ -0,0 +1,87 @@
+'''
+Splitting postprocessing over several processes or cluster nodes.
+
+The result files linked to a HAWC2DataFrame are assigned to N shards
+deterministically, so that N independent processes (e.g. the tasks of a PBS
+array job) compute disjoint parts of the stats table without communicating.
+Files are either balanced by their size (longest-processing-time first) or
+assigned by a hash of their name, which keeps the assignment of a file fixed
+when other files are added. Each shard writes a partial table, and
+merge_shards (postproc) combines them in the original order.
+'''
+import os
+import zlib
+
+from .scheduling import lpt_schedule
+
+
+def parse_shard(text):
+    '''
+    Parses a shard given as 'i/N' (zero based). Returns (i, N).
+    '''
+    try:
+        i, n = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise ValueError(f'Shard {text!r} is not of the form i/N.')
+    if not 0 <= i < n:
+        raise ValueError(f'Shard {i} is not in 0..{n-1}.')
+    return i, n
+
+
+def assign_shards(names, n_shards, costs=None):
+    '''
+    Returns the shard number of each name. If costs are given, the shards
+    are balanced by cost, otherwise names are assigned by a CRC32 hash.
+    Both are deterministic across processes and machines.
+    '''
+    if costs is None:
+        return [zlib.crc32(name.encode()) % n_shards for name in names]
+    batches, _ = lpt_schedule(costs, n_shards)
+    out = [0] * len(names)
+    for shard, batch in enumerate(batches):
+        for j in batch:
+            out[j] = shard
+    return out
+
+
+def part_filename(out_dir, i, n_shards):
+    # the partial stats table of shard i
+    return os.path.join(out_dir, f'part-{i:04d}-of-{n_shards:04d}.pkl')
+
+
+def part_filenames(out_dir, n_shards):
+    return [part_filename(out_dir, i, n_shards) for i in range(n_shards)]
+
+
+def _value(text):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_stat(text):
+    '''
+    Parses a statistic given on the command line as name[:key=value...],
+    where a comma separated value is a list. Returns (name, kwargs).
+    example: 'DEL:m=3,4,10:neq=600' gives ('DEL', {'m': [3, 4, 10], 'neq': 600})
+    '''
+    name, *args = text.split(':')
+    kwargs = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        values = [_value(x) for x in value.split(',')]
+        kwargs[key] = values if len(values) > 1 else values[0]
+    return name, kwargs or None
+
+
+def parse_channel(text):
+    '''
+    Parses a channel given on the command line as name=number.
+    '''
+    name, _, number = text.partition('=')
+    if not number.isdigit():
+        raise ValueError(f'Channel {text!r} is not of the form name=number.')
+    return name, int(number)
@@ -0,0 +1,115 @@
+'''
+Dense power spectral densities of many result files.
+
+Storing one PSD per channel and simulation as an array in a dataframe cell
+costs a Python object per cell and slow unpacking later. Here Welch's method
+is applied to all channels of a (time x channel) array at once, and the
+spectra of a campaign are collected in a single (simulation x channel x
+frequency) float32 array with one shared frequency vector. The frequency
+axis can be reduced further by averaging over log-spaced bands or by
+extracting selected frequencies, such as 1P and 3P.
+'''
+from collections import namedtuple
+import numpy as np
+
+from .reader import Hawc2Result
+from .derived import ResultArray
+
+
+# f is shared by all spectra, psd is (simulation x channel x frequency)
+Spectra = namedtuple('Spectra', ['f', 'psd', 'channels', 'index'])
+
+
+def welch(x, fs=1.0, nperseg=8192, noverlap=None, window='hann'):
+    '''
+    Welch PSD of every column of a (time x channel) array. Returns the
+    frequencies and a (channel x frequency) array.
+    '''
+    from scipy import signal
+    x = np.asarray(x)
+    if x.shape[0] < nperseg:
+        raise ValueError(f'{x.shape[0]} samples is less than nperseg={nperseg}.')
+    f, Pxx = signal.welch(x, fs=fs, window=window, nperseg=nperseg, noverlap=noverlap, axis=0)
+    return f, Pxx.T
+
+
+def log_bands(f, n_bands, fmin=None, fmax=None):
+    '''
+    Returns the edges of n_bands logarithmically spaced frequency bands
+    between fmin (default the lowest nonzero frequency) and fmax (default
+    the highest frequency).
+    '''
+    fmin = fmin or f[f > 0][0]
+    fmax = fmax or f[-1]
+    return np.geomspace(fmin, fmax, n_bands + 1)
+
+
+def band_average(f, P, edges):
+    '''
+    Averages spectra over frequency bands along the last axis. Returns the
+    geometric band centres and the averaged spectra. Bands without any
+    frequency are NaN.
+    '''
+    band = np.searchsorted(edges, f, side='right') - 1
+    band[f == edges[-1]] = len(edges) - 2
+    P = np.asarray(P)
+    out = np.full(P.shape[:-1] + (len(edges) - 1,), np.nan)
+    for i in range(len(edges) - 1):
+        if (band == i).any():
+            out[..., i] = P[..., band == i].mean(axis=-1)
+    return np.sqrt(edges[:-1] * edges[1:]), out
+
+
+def select_frequencies(f, P, freqs):
+    '''
+    Returns the spectra at the given frequencies along the last axis,
+    linearly interpolated between the nearest frequencies.
+    '''
+    P = np.asarray(P)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+    i = np.clip(np.searchsorted(f, freqs) - 1, 0, len(f) - 2)
+    w = np.clip((freqs - f[i]) / (f[i+1] - f[i]), 0, 1)
+    return P[..., i] * (1 - w) + P[..., i+1] * w
+
+
+def frequency_axis(fs, nperseg, bands=None, freqs=None):
+    '''
+    Returns the shared frequency vector of spectra computed with the given
+    settings. bands is a number of log-spaced bands or an array of band
+    edges, freqs a list of frequencies to extract.
+    '''
+    f = np.fft.rfftfreq(nperseg, 1 / fs)
+    if freqs is not None:
+        return np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+    if bands is not None:
+        edges = log_bands(f, bands) if np.ndim(bands) == 0 else np.asarray(bands)
+        return np.sqrt(edges[:-1] * edges[1:])
+    return f
+
+
+def reduce_spectrum(f, P, bands=None, freqs=None):
+    # applies the band averaging or frequency selection of frequency_axis
+    if freqs is not None:
+        return select_frequencies(f, P, freqs)
+    if bands is not None:
+        edges = log_bands(f, bands) if np.ndim(bands) == 0 else np.asarray(bands)
+        return band_average(f, P, edges)[1]
+    return P
+
+
+def file_spectrum(filename, header, channels, fs=None, nperseg=8192, noverlap=None,
+                  window='hann', bands=None, freqs=None, dtype=np.float32):
+    '''
+    Computes the (channel x frequency) spectra of a single result file. fs
+    defaults to the sample rate in the .sel header. Runs in worker
+    processes, so any error is returned as a message rather than raised.
+    Returns (spectra or None, error message or None).
+    '''
+    try:
+        with Hawc2Result(filename, header) as res:
+            fs = fs or res.header.NSc / res.header.Time
+            x = ResultArray.from_result(res, channels, fs=fs).data
+        f, P = welch(x, fs, nperseg, noverlap, window)
+        return reduce_spectrum(f, P, bands, freqs).astype(dtype), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
@@ -0,0 +1,138 @@
+'''
+A persistent cache of per-channel statistics of HAWC2 result files.
+
+Each cached value is addressed by a hash of everything it depends on: the
+result path, the size and modification time of the .dat file, the channel
+number and its scale factor, and the statistic with its parameters. A
+changed result file therefore never returns a stale value. The cache is a
+SQLite database with a size limit; the least recently used entries are
+evicted first.
+'''
+import os
+import time
+import pickle
+import hashlib
+import sqlite3
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stats (
+    key    TEXT PRIMARY KEY,
+    value  BLOB,
+    size   INTEGER,
+    atime  REAL
+);
+CREATE INDEX IF NOT EXISTS stats_atime ON stats (atime);
+'''
+
+
+class StatsCache(object):
+    '''
+    Content-addressed statistics cache.
+
+    example:
+        cache = StatsCache('postproc/stats_cache.sqlite', max_bytes=2**30)
+        df.wetb.compute({'DEL': {'m': [3, 4]}, 'PSD': None}, cache=cache)
+    '''
+    def __init__(self, path='.hawcast_stats.sqlite', max_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._con = sqlite3.connect(path, timeout=30)
+        self._con.executescript(_SCHEMA)
+
+
+    def __repr__(self):
+        return 'StatsCache {} ({} entries, {} bytes)'.format(self.path, len(self), self.size)
+
+    def __len__(self):
+        return self._con.execute('SELECT COUNT(*) FROM stats').fetchone()[0]
+
+    @property
+    def size(self):
+        return self._con.execute('SELECT COALESCE(SUM(size), 0) FROM stats').fetchone()[0]
+
+
+    def close(self):
+        self._con.close()
+
+
+    @staticmethod
+    def file_id(filename):
+        '''
+        Identifies the content of a result file (given without extension)
+        by its path, and the size and modification time of its .dat file.
+        '''
+        st = os.stat(filename + '.dat')
+        return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+
+    @staticmethod
+    def key(file_id, channel, scale, stat, params):
+        '''
+        Returns the cache key of a statistic. stat identifies the statistic
+        (e.g. its function and label) and params is a hashable description
+        of its arguments. A derived channel is given by a string describing
+        it, with the scale factors of its source channels as scale.
+        '''
+        if isinstance(channel, str):
+            channel, scale = channel, tuple(float(x) for x in scale)
+        else:
+            channel, scale = int(channel), float(scale)
+        text = repr((file_id, channel, scale, stat, params))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+    def get_many(self, keys):
+        '''
+        Returns {key: value} of the keys found in the cache and marks them as
+        recently used.
+        '''
+        out = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            query = 'SELECT key, value FROM stats WHERE key IN ({})'.format(','.join('?'*len(chunk)))
+            for key, value in self._con.execute(query, chunk):
+                out[key] = pickle.loads(value)
+        if out:
+            now = time.time()
+            with self._con:
+                self._con.executemany('UPDATE stats SET atime=? WHERE key=?', [(now, k) for k in out])
+        return out
+
+
+    def put_many(self, items):
+        '''
+        Stores an iterable of (key, value) pairs, then evicts the least
+        recently used entries if the cache exceeds max_bytes.
+        '''
+        now = time.time()
+        rows = []
+        for key, value in items:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, blob, len(blob), now))
+        with self._con:
+            self._con.executemany('INSERT OR REPLACE INTO stats VALUES (?,?,?,?)', rows)
+        self.evict()
+
+
+    def evict(self):
+        excess = self.size - self.max_bytes
+        if excess <= 0:
+            return
+        drop, total = [], 0
+        for key, size in self._con.execute('SELECT key, size FROM stats ORDER BY atime'):
+            drop.append((key,))
+            total += size
+            if total >= excess:
+                break
+        with self._con:
+            self._con.executemany('DELETE FROM stats WHERE key=?', drop)
+
+
+    def clear(self):
+        with self._con:
+            self._con.execute('DELETE FROM stats')
@@ -0,0 +1,148 @@
+'''
+Online accumulators for statistics of time series which are read in blocks.
+
+Each accumulator is fed consecutive (time x channel) blocks through update()
+and only keeps a small state between blocks, so memory is bounded by the
+block size rather than the length of the simulation. Accumulators with an
+observe() method (rainflow counting) need the range of each channel first,
+and are fed all blocks through observe() before the first update(). Use
+them together with Hawc2Result.iter_blocks:
+
+    stats, welch = StreamingStats(), WelchAccumulator(fs=100, nperseg=8192)
+    with Hawc2Result(filename) as res:
+        for block in res.iter_blocks(channels, blocksize=60000):
+            stats.update(block)
+            welch.update(block)
+    f, Pxx = welch.result()
+'''
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .fatigue import StreamingRainflow
+
+
+class StreamingStats(object):
+    '''
+    Running count, mean, variance, min, max and final value of each channel.
+    Blocks are combined with Chan's parallel variance update. var and std
+    use one degree of freedom, as in pandas.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = self.min = self.max = self.final = None
+        self._m2 = None
+
+
+    def update(self, block):
+        n = len(block)
+        if n == 0:
+            return
+        block_mean = block.mean(axis=0, dtype=np.float64)
+        block_m2 = ((block - block_mean)**2).sum(axis=0)
+        if self.count == 0:
+            self.mean, self._m2 = block_mean, block_m2
+            self.min, self.max = block.min(axis=0), block.max(axis=0)
+        else:
+            total = self.count + n
+            delta = block_mean - self.mean
+            self.mean = self.mean + delta * n / total
+            self._m2 = self._m2 + block_m2 + delta**2 * self.count * n / total
+            self.min = np.minimum(self.min, block.min(axis=0))
+            self.max = np.maximum(self.max, block.max(axis=0))
+        self.count += n
+        self.final = block[-1].copy()
+
+
+    @property
+    def var(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else np.full_like(self._m2, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+
+class RainflowAccumulator(object):
+    '''
+    Rainflow counting of each channel, as fatigue.rainflow, by one
+    StreamingRainflow per channel. The discretisation depends on the range
+    of each channel, which is found by a first pass through observe().
+    Memory is bounded by the number of discretisation levels.
+    '''
+    def __init__(self):
+        self.min = self.max = None
+        self.channels = None
+
+
+    def observe(self, block):
+        if self.min is None:
+            self.min, self.max = block.min(axis=0), block.max(axis=0)
+        else:
+            self.min = np.minimum(self.min, block.min(axis=0))
+            self.max = np.maximum(self.max, block.max(axis=0))
+
+
+    def update(self, block):
+        if self.channels is None:
+            self.channels = [StreamingRainflow(lo, hi) for lo, hi in zip(self.min, self.max)]
+        for i, rf in enumerate(self.channels):
+            rf.update(block[:, i])
+
+
+    def histograms(self, no_bins=46):
+        '''
+        The CycleHistogram of each channel. Ends the counting.
+        '''
+        return [rf.histogram(no_bins) for rf in self.channels]
+
+
+
+class WelchAccumulator(object):
+    '''
+    Welch power spectral density estimate accumulated over blocks. Segments
+    straddling two blocks are handled by keeping the unused tail of the
+    previous block. The result equals scipy.signal.welch with the default
+    constant detrending and density scaling.
+    '''
+    def __init__(self, fs=1.0, nperseg=256, noverlap=None, window='hann'):
+        from scipy import signal
+        self.fs = fs
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None else noverlap
+        self.window = signal.get_window(window, nperseg)
+        self.nseg = 0
+        self._sum = None
+        self._buffer = None
+
+
+    def update(self, block):
+        data = block if self._buffer is None else np.concatenate([self._buffer, block])
+        step = self.nperseg - self.noverlap
+        nseg = (len(data) - self.nperseg) // step + 1 if len(data) >= self.nperseg else 0
+        if nseg > 0:
+            # (segment, channel, sample) view of the segments in this block
+            segs = sliding_window_view(data, self.nperseg, axis=0)[::step][:nseg]
+            segs = segs - segs.mean(axis=-1, keepdims=True)
+            spec = (np.abs(np.fft.rfft(segs * self.window, axis=-1))**2).sum(axis=0)
+            self._sum = spec if self._sum is None else self._sum + spec
+            self.nseg += nseg
+        self._buffer = data[nseg * step:]
+
+
+    def result(self):
+        '''
+        Returns the frequencies and the (channel x frequency) power spectral
+        densities.
+        '''
+        if self.nseg == 0:
+            # fewer samples than one segment, as scipy does
+            from scipy import signal
+            f, Pxx = signal.welch(self._buffer, fs=self.fs, nperseg=len(self._buffer), axis=0)
+            return f, Pxx.T
+        Pxx = self._sum / self.nseg / (self.fs * (self.window**2).sum())
+        if self.nperseg % 2:
+            Pxx[..., 1:] *= 2
+        else:
+            Pxx[..., 1:-1] *= 2
+        return np.fft.rfftfreq(self.nperseg, 1 / self.fs), Pxx
@@ -0,0 +1,110 @@
+'''
+Synthetic HAWC2 campaigns for tests and benchmarks.
+
+write_results writes valid .sel/.dat result pairs of any size, named after
+tags which can be linked with HAWC2DataFrame using RESULT_PATTERN.
+write_definition and write_master write a definition module and master htc
+file for Case and generate_htc_files.
+'''
+import os
+import numpy as np
+
+from .reader import write_hawc2_res
+
+
+RESULT_PATTERN = 'wsp{wsp}_s{seed}'
+WSPS = list(range(4, 26, 2))
+
+
+def result_name(i):
+    # the i'th result name, cycling through the wind speeds first
+    return RESULT_PATTERN.format(wsp=WSPS[i % len(WSPS)], seed=i // len(WSPS) + 1)
+
+
+def write_results(directory, n_files=10, n_channels=20, n_scans=6000, dt=0.01, seed=0):
+    '''
+    Writes n_files results of n_channels channels and n_scans samples to
+    directory. Channel 1 is time, the others are random walks with wind
+    speed dependent offsets and periodic components, so that statistics,
+    DELs and spectra are nontrivial. Returns the filenames, without
+    extension.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_scans) * dt
+    periodic = np.sin(2 * np.pi * 0.2 * t)[:, None] * np.arange(1, n_channels)
+    filenames = []
+    for i in range(n_files):
+        name = result_name(i)
+        wsp = WSPS[i % len(WSPS)]
+        data = np.empty((n_scans, n_channels))
+        data[:, 0] = t
+        data[:, 1:] = (wsp + rng.normal(scale=0.1, size=(n_scans, n_channels - 1)).cumsum(axis=0)
+                       + periodic)
+        filename = os.path.join(directory, name)
+        write_hawc2_res(filename, data, time=n_scans * dt)
+        filenames.append(filename)
+    return filenames
+
+
+def definition_text(n_variables=3, n_values=4, casename='synth', n_channels=20):
+    '''
+    Returns the text of a definition module with n_variables variables of
+    n_values values each, a case_id function and n_channels channels.
+    '''
+    names = ['wsp', 'seed'] + [f'var{i}' for i in range(n_variables - 2)]
+    lines = [f"Constants = {{'casename': '{casename}', 'tstop': 600}}",
+             'Variables = {']
+    for name in names[:n_variables]:
+        lines.append(f"    '{name}': {list(range(4, 4 + 2 * n_values, 2)) if name == 'wsp' else list(range(1, n_values + 1))},")
+    lines.append('}')
+    case_id = '_'.join(f'{name}{{{name}}}' for name in names[:n_variables])
+    lines.append(f"Functions = {{'case_id': lambda x: '{casename}_{case_id}'.format(**x)}}")
+    lines.append('channels = {' + ', '.join(f"'ch{i}': {i}" for i in range(1, n_channels + 1)) + '}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_definition(filename, **kwargs):
+    # writes definition_text(**kwargs) to filename and returns filename
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(definition_text(**kwargs))
+    return filename
+
+
+def master_text(n_output=50):
+    '''
+    Returns a master htc file using the tags of definition_text, with
+    n_output output channels.
+    '''
+    output = '\n'.join(f'    constraint bearing1 shaft_rot {i} ;' for i in range(n_output))
+    return f'''begin simulation;
+  time_stop {{tstop}} ;
+  logfile ./log/{{casename}}/{{case_id}}.log ;
+  begin newmark;
+    deltat 0.02 ;
+  end newmark;
+end simulation;
+begin wind ;
+  wsp {{wsp}} ;
+  begin mann ;
+    filename_u ./turb/{{case_id}}_u.bin ;
+  end mann ;
+end wind ;
+begin output ;
+  filename ./res/{{casename}}/{{case_id}} ;
+  data_format hawc_binary ;
+  buffer 1 ;
+  general time ;
+{output}
+end output ;
+exit ;
+'''
+
+
+def write_master(filename, **kwargs):
+    # writes master_text(**kwargs) to filename and returns filename
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(master_text(**kwargs))
+    return filename
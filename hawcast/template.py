@@ -0,0 +1,71 @@
+'''
+Compiled master file templates.
+
+A template is parsed once into alternating literal text and {tag}
+placeholders, so rendering a file is a single join instead of one
+str.replace per tag over the whole text. Given the tag names, only their
+placeholders are substituted, as str.replace did, and other braces in the
+text are kept.
+'''
+import re
+
+
+# the [tag] placeholders of the PBS templates
+PBS_PLACEHOLDER = r'\[(\w+)\]'
+
+
+class Template(object):
+    '''
+    A template text with {tag} placeholders.
+
+    example:
+        template = Template.from_file('htc/_master/dlc12.htc', fields=tags.columns)
+        text = template.render({'wsp': 12, 'seed': 1001, ...})
+    '''
+    placeholder = re.compile(r'\{(\w+)\}')
+
+    def __init__(self, text, placeholder=None, fields=None):
+        # placeholder is a regular expression with one group matching the
+        # tag name, e.g. r'\[(\w+)\]' for the [tag] placeholders of the
+        # PBS template. If fields is given, placeholders of other names are
+        # literal text.
+        if placeholder is not None:
+            self.placeholder = re.compile(placeholder)
+        matches = list(self.placeholder.finditer(text))
+        if fields is not None:
+            fields = set(fields)
+            matches = [m for m in matches if m.group(1) in fields]
+        starts = [0] + [m.end() for m in matches]
+        ends = [m.start() for m in matches] + [len(text)]
+        self._literals = [text[a:b] for a, b in zip(starts, ends)]
+        self._raw = [m.group(0) for m in matches]
+        self.fields = [m.group(1) for m in matches]
+
+
+    @classmethod
+    def from_file(cls, filename, placeholder=None, fields=None):
+        with open(filename) as f:
+            return cls(f.read(), placeholder, fields)
+
+
+    def __repr__(self):
+        return 'Template ({} placeholders: {})'.format(
+            len(self.fields), ', '.join(sorted(set(self.fields))))
+
+
+    def render(self, tags, strict=True):
+        '''
+        Returns the text with every placeholder replaced by str(tags[key]).
+        Raises a ValueError if a tag used in the template is missing or None.
+        If strict is False, placeholders of missing tags are left as they are.
+        '''
+        out = [self._literals[0]]
+        for field, raw, literal in zip(self.fields, self._raw, self._literals[1:]):
+            value = tags.get(field)
+            if value is None or value != value: # None or NaN
+                if strict:
+                    raise ValueError(f'Tag {field} has no value.')
+                value = raw
+            out.append(str(value))
+            out.append(literal)
+        return ''.join(out)
@@ -0,0 +1,304 @@
+'''
+Incremental postprocessing of a running campaign.
+
+A StatsTable is a stats table on disk which is brought up to date with the
+result files in a directory: results which completed since the last update
+(or were rewritten, e.g. by a rerun) are postprocessed and merged into the
+table, everything else is left untouched. Results are complete when the .dat
+file has the size given by the .sel header, so partially written files are
+skipped until a later update. Updates append the new rows to a journal,
+which is merged into the table now and then, so a poll does not rewrite the
+whole table. watch repeats the update whenever files in the directory are
+written (using inotify on Linux, polling elsewhere).
+
+example:
+    table = StatsTable('postproc/dlc12.pkl', 'res/dlc12', 'dlc12_wsp{wsp}_s{seed}',
+                       channels={'TbFA': 17}, stats={'mean': None, 'DEL': {'m': [3, 4]}})
+    table.watch(interval=60)
+'''
+import os
+import time
+import ctypes
+import ctypes.util
+import pickle
+import select
+import pandas as pd
+
+from .postproc import HAWC2DataFrame, wetbAccessor
+from .resultindex import ResultIndex, index_path
+from .runner import result_complete
+
+
+def file_id(base):
+    # identifies the content of a result file pair, see StatsTable.update
+    sel, dat = os.stat(base + '.sel'), os.stat(base + '.dat')
+    return [sel.st_size, dat.st_size, dat.st_mtime_ns]
+
+
+
+class StatsTable(object):
+    '''
+    A stats table on disk, kept up to date with a result directory. The
+    table is a pickle file as written by HAWC2DataFrame.wetb.to_pickle,
+    with the identity (size and modification time) of every postprocessed
+    file, so it can be read with wetbAccessor.read_pickle.
+
+    Updates only append the rows of the new results to a journal next to
+    the table (filename + '.journal'), which is merged into the table every
+    compact_every updates, when watch returns, or by compact(). read()
+    includes the journal; wetbAccessor.read_pickle only sees the table as
+    of the last compaction.
+    '''
+    def __init__(self, filename, directory, pattern, channels, stats, n_jobs=1, cache=None,
+                 min_age=0, compact_every=20):
+        self.filename = filename
+        self.directory = directory
+        self.pattern = pattern
+        self.channels = channels
+        self.stats = stats
+        self.n_jobs = n_jobs
+        self.cache = cache
+        # seconds since the last modification before a result is used
+        self.min_age = min_age
+        self.compact_every = compact_every
+        # the table as returned by _read, kept between updates, and the
+        # result index, which is kept open
+        self._table = None
+        self._index = None
+
+
+    @property
+    def journal(self):
+        return self.filename + '.journal'
+
+
+    def read(self):
+        '''
+        Returns the table as a HAWC2DataFrame and {filename: file id} of
+        the postprocessed files, or (None, {}) if there is no table yet.
+        '''
+        df, file_ids, _, _ = self._read()
+        return df, file_ids
+
+
+    def _read(self):
+        # the table with its journal, the number of journal records and the
+        # version of the table file. Journal records are written for a
+        # version, and once merged into the table, the version is increased.
+        try:
+            raw = pd.read_pickle(self.filename)
+            df = wetbAccessor._restore(HAWC2DataFrame(raw), raw.attrs['wetb'])
+            file_ids, version = raw.attrs.get('file_ids', {}), raw.attrs.get('version', 0)
+        except FileNotFoundError:
+            df, file_ids, version = None, {}, 0
+        n = 0
+        try:
+            with open(self.journal, 'rb') as f:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError):
+                        # the end, or a record which was not completely written
+                        break
+                    if record['version'] == version:
+                        n += 1
+                        new = wetbAccessor._restore(HAWC2DataFrame(record['rows']), record['state'])
+                        df, file_ids = merge(df, file_ids, new, record['file_ids'])
+        except FileNotFoundError:
+            pass
+        return df, file_ids, n, version
+
+
+    def _write(self, df, file_ids, version):
+        out = pd.DataFrame(df, copy=False)
+        out.attrs = {'wetb': df.wetb._state(), 'file_ids': file_ids, 'version': version}
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        out.to_pickle(self.filename + '.tmp')
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+    def compact(self):
+        '''
+        Merges the journal into the table file.
+        '''
+        if self._table is None:
+            self._table = self._read()
+        df, file_ids, n, version = self._table
+        if df is None or not os.path.exists(self.journal):
+            return
+        # records of the old version are ignored if the journal is left
+        self._write(df, file_ids, version + 1)
+        os.remove(self.journal)
+        self._table = df, file_ids, 0, version + 1
+
+
+    def pending(self, df, file_ids):
+        # index labels of the complete results of df which are new or changed
+        now = time.time()
+        out, ids = [], {}
+        for idx in df.index:
+            name = df.wetb._filenames[idx]
+            base = os.path.join(self.directory, name)
+            try:
+                this = file_id(base)
+            except OSError:
+                continue
+            if file_ids.get(name) == this or not result_complete(base):
+                continue
+            if now - this[2] / 1e9 < self.min_age:
+                continue
+            out.append(idx)
+            ids[name] = this
+        return out, ids
+
+
+    def _link(self):
+        # links the results through the result index, which stays open
+        # between updates
+        if self._index is None:
+            path = index_path(self.directory)
+            self._index = ResultIndex(self.directory, path, refresh=False) if path else False
+        if self._index is not False:
+            self._index.refresh()
+        return HAWC2DataFrame(dir=self.directory, pattern=self.pattern, channels=self.channels,
+                              index=self._index)
+
+
+    def update(self):
+        '''
+        Postprocesses the complete results which are not in the table yet,
+        or changed since, and appends them to the table. Returns the number
+        of postprocessed files.
+        '''
+        df = self._link()
+        if df.empty:
+            return 0
+        if self._table is None:
+            self._table = self._read()
+        table, file_ids, n, version = self._table
+        todo, ids = self.pending(df, file_ids)
+        if not todo:
+            return 0
+
+        new = df.wetb.subset(todo).wetb.compute(self.stats, n_jobs=self.n_jobs, cache=self.cache)
+        if table is None:
+            # the first rows start the table file
+            table, file_ids = merge(None, {}, new, ids)
+            self._write(table, file_ids, version)
+            self._table = table, file_ids, 0, version
+            return len(todo)
+
+        record = {'version': version, 'rows': pd.DataFrame(new, copy=False),
+                  'state': new.wetb._state(), 'file_ids': ids}
+        with open(self.journal, 'ab') as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        table, file_ids = merge(table, file_ids, new, ids)
+        self._table = table, file_ids, n + 1, version
+        if n + 1 >= self.compact_every:
+            self.compact()
+        return len(todo)
+
+
+    def watch(self, interval=60, timeout=None, callback=None):
+        '''
+        Updates the table, then again whenever files in the directory are
+        written, or at least every interval seconds, until timeout seconds
+        have passed (forever if None). callback(n) is called after each
+        update with the number of postprocessed files. The table is
+        compacted when watching stops.
+        '''
+        start = time.time()
+        waiter = DirectoryWaiter(self.directory)
+        try:
+            while True:
+                n = self.update()
+                if callback is not None:
+                    callback(n)
+                remaining = interval if timeout is None else min(interval, start + timeout - time.time())
+                if remaining <= 0:
+                    break
+                waiter.wait(remaining)
+        finally:
+            waiter.close()
+            self.compact()
+
+
+
+def merge(table, file_ids, new, ids):
+    '''
+    Merges the statistics of new results (a computed HAWC2DataFrame, linked
+    to the current results) into a table, given the file ids of both.
+    Rows of files linked before are moved to their index in the current
+    link, and replaced rows and removed files are dropped. Returns the
+    merged table and file ids.
+    '''
+    names = new.wetb._filenames
+    position = {name: idx for idx, name in enumerate(names)}
+    errors = dict(new.wetb.errors)
+    parts = [pd.DataFrame(new, copy=False)]
+    if table is not None:
+        old = pd.DataFrame(table, copy=False)
+        old_names = [table.wetb._filenames[idx] for idx in old.index]
+        keep = [name in position and name not in ids for name in old_names]
+        old = old[keep]
+        old.index = [position[name] for name, k in zip(old_names, keep) if k]
+        parts.insert(0, old)
+        for idx, error in table.wetb.errors.items():
+            name = table.wetb._filenames[idx]
+            if name in position and name not in ids:
+                errors[position[name]] = error
+        file_ids = {name: x for name, x in file_ids.items() if name in position}
+
+    merged = HAWC2DataFrame(pd.concat(parts).sort_index())
+    wetbAccessor._restore(merged, dict(new.wetb._state(), errors=sorted(errors.items())))
+    return merged, {**file_ids, **ids}
+
+
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+
+
+class DirectoryWaiter(object):
+    '''
+    Waits for files in a directory to be written. Uses inotify where
+    available, otherwise wait simply sleeps for the timeout.
+    '''
+    def __init__(self, directory):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            return
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+
+    def wait(self, timeout):
+        '''
+        Returns True if files were written within timeout seconds, False if
+        not, or None if inotify is not available and the full timeout passed.
+        '''
+        if self.fd is None:
+            time.sleep(timeout)
+            return None
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        # drain the pending events
+        while ready:
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+        return bool(ready)
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
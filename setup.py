@@ -10,6 +10,7 @@ setup(name                 = 'hawcast',
       license              = 'MIT',
       packages             = ['hawcast'],
       install_requires     = ['wetb', 'pandas', 'numpy', 'importlib', 'click'],
+      extras_require       = {'parquet': ['pyarrow'], 'test': ['pytest', 'pyarrow']},
       zip_safe             = False,
       include_package_date = True,
       entry_points         = {
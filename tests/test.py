@@ -1,5 +1,921 @@
+import os
+import numpy as np
+import pandas as pd
 from hawcast import backend
+from hawcast.reader import Hawc2Result, read_sel, write_hawc2_res
 
 
 def test_something():
     assert 4 == 4
+
+
+def test_memmap_reader(tmp_path):
+    fn = str(tmp_path / 'res' / 'sim')
+    data = np.random.default_rng(0).normal(size=(1000, 4)) * [1, 10, 100, 1000]
+    write_hawc2_res(fn, data)
+
+    header = read_sel(fn)
+    assert (header.NSc, header.NCh) == (1000, 4)
+
+    with Hawc2Result(fn) as res:
+        x = res.read({'b': 2, 'd': 4}, dtype=np.float32)
+        assert x.shape == (1000, 2) and x.dtype == np.float32
+        np.testing.assert_allclose(x, data[:, [1, 3]], rtol=0, atol=data[:, 3].max() / 30000)
+        np.testing.assert_allclose(res.channel(2), x[:, 0], rtol=1e-6)
+    assert res.closed
+
+    df = backend.readHawc2Res(fn, {'b': 2, 'd': 4})
+    assert list(df) == ['b', 'd']
+    np.testing.assert_allclose(df.values, x, rtol=1e-6)
+
+
+def write_campaign(directory, wsps=(4, 6, 8), seeds=(1, 2), NSc=2000):
+    # writes a small set of synthetic result files named wsp{wsp}_s{seed}
+    rng = np.random.default_rng(1)
+    for wsp in wsps:
+        for seed in seeds:
+            data = wsp + rng.normal(size=(NSc, 3)).cumsum(axis=0) * 0.1
+            write_hawc2_res(os.path.join(directory, f'wsp{wsp}_s{seed}'), data)
+
+
+def test_result_index(tmp_path):
+    from hawcast.resultindex import ResultIndex
+    from hawcast.postproc import HAWC2DataFrame
+    write_campaign(str(tmp_path))
+
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    assert len(df) == 6
+    assert os.path.isfile(tmp_path / ResultIndex.filename)
+    df = df.wetb.mean(['a'])
+    assert ('a', 'Mean') in df
+
+    index = ResultIndex(str(tmp_path))
+    assert index.refresh() == []
+    write_hawc2_res(str(tmp_path / 'wsp4_s1'), np.ones((10, 3)))
+    assert index.refresh() == ['wsp4_s1']
+    assert index.header('wsp4_s1').NSc == 10
+
+    # rows are in directory order as without an index, and results with an
+    # invalid header are linked with an error
+    with open(tmp_path / 'wsp8_s2.sel', 'w') as f:
+        f.write('garbage')
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1})
+    plain = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1}, index=False)
+    assert df.wetb._filenames == plain.wetb._filenames and len(df) == 6
+    assert list(df.wetb.errors) == [df.wetb._filenames.index('wsp8_s2')]
+
+    # the index can be kept elsewhere
+    os.remove(tmp_path / ResultIndex.filename)
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1},
+                        index=str(tmp_path / 'indexes'))
+    assert not os.path.exists(tmp_path / ResultIndex.filename)
+    assert len(os.listdir(tmp_path / 'indexes')) == 1 and len(df) == 6
+
+
+def test_compute_single_pass(tmp_path, monkeypatch):
+    from hawcast import postproc
+    write_campaign(str(tmp_path))
+    df = postproc.HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+
+    calls = []
+    load = postproc._load
+    monkeypatch.setattr(postproc, '_load', lambda *args: calls.append(args) or load(*args))
+
+    out = df.wetb.compute({'mean': None, 'std': None, 'DEL': {'m': [3, 4]}})
+    assert len(calls) == len(df)
+    assert {('a', 'Mean'), ('b', 'Std'), ('a', 'DEL_m3'), ('b', 'DEL_m4')} <= set(out)
+    raw = df.wetb.fetch_result(0)
+    assert np.isclose(out[('a', 'Mean')].iloc[0], raw['a'].mean())
+
+    # the per-statistic accessors expand list arguments as compute does
+    df = postproc.HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    dels = df.wetb.DEL(['a'], m=[3, 4])
+    assert np.allclose(dels[('a', 'DEL_m4')], out[('a', 'DEL_m4')])
+    assert ('a', 'DEL_m3') in dels and ('b', 'DEL_m3') not in dels
+
+
+def test_parallel_compute(tmp_path):
+    from hawcast.postproc import HAWC2DataFrame
+    write_campaign(str(tmp_path))
+    pattern, channels = 'wsp{wsp}_s{seed}', {'a': 1, 'b': 2}
+    serial = HAWC2DataFrame(dir=str(tmp_path), pattern=pattern, channels=channels)
+    serial = serial.wetb.compute(['mean', 'DEL'])
+
+    # truncate one .dat file so that it fails to load
+    with open(tmp_path / 'wsp6_s2.dat', 'r+b') as f:
+        f.truncate(100)
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern=pattern, channels=channels)
+    df = df.wetb.compute(['mean', 'DEL'], n_jobs=2, chunksize=2)
+
+    bad = df.index[(df[('wsp', '')] == 6) & (df[('seed', '')] == 2)][0]
+    assert list(df.wetb.errors) == [bad]
+    assert df.loc[bad, ('a', 'DEL')] != df.loc[bad, ('a', 'DEL')]
+    good = df.index != bad
+    np.testing.assert_allclose(df[good][('a', 'DEL')], serial[good][('a', 'DEL')])
+
+
+def test_batched_equivalent_loads():
+    from wetb.fatigue_tools.fatigue import eq_load
+    from hawcast.fatigue import equivalent_loads, equivalent_load_from_cycles
+    x = np.random.default_rng(2).normal(size=(5000, 3)).cumsum(axis=0)
+    x[:, 2] = 1.0
+
+    dels, hists = equivalent_loads(x, m=[3, 4, 10], neq=[1, 600], return_cycles=True)
+    assert dels.shape == (2, 3, 3)
+    for i in range(2):
+        np.testing.assert_allclose(dels[:, :, i], eq_load(x[:, i], m=[3, 4, 10], neq=[1, 600]))
+    assert np.isnan(dels[:, :, 2]).all()
+
+    # lifetime damage from stored histograms
+    both = equivalent_load_from_cycles(hists[:2], m=[4], neq=1, weights=[1, 1])
+    assert both[0, 0] > dels[0, 1, :2].max()
+
+
+def test_streaming_statistics(tmp_path):
+    from scipy import signal
+    from hawcast.postproc import HAWC2DataFrame
+    from hawcast.streaming import WelchAccumulator
+    write_campaign(str(tmp_path), NSc=20000)
+    pattern, channels = 'wsp{wsp}_s{seed}', {'a': 1, 'b': 2}
+    stats = {'mean': None, 'std': None, 'max': None, 'final': None, 'DEL': {'m': [3, 10]}}
+
+    full = HAWC2DataFrame(dir=str(tmp_path), pattern=pattern, channels=channels).wetb.compute(stats)
+    streamed = HAWC2DataFrame(dir=str(tmp_path), pattern=pattern, channels=channels)
+    streamed = streamed.wetb.compute(stats, blocksize=3001)
+    assert not streamed.wetb.errors
+    np.testing.assert_allclose(streamed.values.astype(float), full.values.astype(float))
+
+    x = np.random.default_rng(3).normal(size=(50000, 2))
+    welch = WelchAccumulator(fs=100, nperseg=1024)
+    for start in range(0, len(x), 7000):
+        welch.update(x[start:start + 7000])
+    f, Pxx = welch.result()
+    f_ref, Pxx_ref = signal.welch(x, fs=100, nperseg=1024, axis=0)
+    np.testing.assert_allclose(f, f_ref)
+    np.testing.assert_allclose(Pxx, Pxx_ref.T)
+
+
+DEFINITION = '''
+Constants = {'casename': 'dlc12'}
+Variables = {'wsp': [4, 6, 8], 'yaw': [-8, 0, 8], 'seed': [1, 2]}
+Functions = {'case_id': lambda x: 'dlc12_wsp{wsp}_yaw{yaw}_s{seed}'.format(**x)}
+channels  = {'a': 1, 'b': 2}
+'''
+
+def write_definition(directory, name='dlc12', text=DEFINITION):
+    fn = os.path.join(directory, name + '.py')
+    with open(fn, 'w') as f:
+        f.write(text)
+    return fn
+
+
+def test_tag_filtering(tmp_path):
+    case = backend.Case(write_definition(str(tmp_path)))
+    assert len(case(wsp=[4, 8])) == 12
+    assert len(case(wsp=6, yaw=slice(-8, 0), seed=[2])) == 2
+    assert len(case(yaw=lambda x: x.abs() > 0)) == 12
+    assert [s.tags.case_id for s in case(wsp=8, yaw=0)] == ['dlc12_wsp8_yaw0_s1', 'dlc12_wsp8_yaw0_s2']
+    assert len(case.tags(wsp=(4, 6), seed=1)) == 6
+    assert len(list(case.iter_tags(wsp=99))) == 0
+
+    # columns of unhashable values are filtered by comparison
+    from hawcast.filtering import TagIndex, mask
+    tags = pd.DataFrame({'gains': [[1, 2], [3], [1, 2]], 'wsp': [4, 6, 8]})
+    index = TagIndex(tags)
+    assert list(index.mask(gains=[[1, 2]], wsp=[4, 6])) == [True, False, False]
+    assert list(index.mask(gains=[[3]])) == list(mask(tags, gains=[[3]]))
+
+
+def test_lazy_seeds(tmp_path):
+    from hawcast import synthetic
+    case = backend.Case(write_definition(str(tmp_path)))
+    seed = case(wsp=8, yaw=0)[1]
+    assert not hasattr(seed, '__dict__')
+    assert seed.res == 'res/dlc12/dlc12_wsp8_yaw0_s2.sel'
+    assert seed.htc == 'htc/dlc12/dlc12_wsp8_yaw0_s2.htc'
+    assert seed.tags.wsp == 8 and seed.definition is case.Def
+    assert len(case) == len(list(case)) == len(case.seeds)
+    assert case[-1].res == list(case)[-1].res
+    assert list(case.paths('htc', wsp=8)) == [s.htc for s in case(wsp=8)]
+    assert list(case.paths()) == [s.res for s in case]
+
+    big = backend.Case(synthetic.write_definition(str(tmp_path / 'synth_lazy.py'), n_variables=4, n_values=20))
+    assert len(big) == 20 ** 4 and big[12345].case_id == big.tags.case_id.iloc[12345]
+    selection = big()
+    assert len(selection) == 20 ** 4 and selection[-1].res == big[-1].res
+    assert [s.case_id for s in selection[2:4]] == list(big.tags.case_id.iloc[2:4])
+
+    # the constructor of earlier versions, from a definition and a tag row
+    old = backend.Seed(case.Def, case.tags.iloc[3])
+    assert old.res == case[3].res and old.definition is case.Def and old.case is None
+
+
+def test_aggregate_rows(tmp_path):
+    from hawcast.postproc import HAWC2DataFrame
+    write_campaign(str(tmp_path))
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1})
+    df = df.wetb.compute({'mean': None, 'DEL': {'m': [4]}})
+
+    seeds = df.wetb.aggregate_rows('seed', {'DEL_m4': ['DEL', 'max']})
+    assert len(seeds) == 3 and ('seed', '') not in seeds
+    wsp4 = df[df[('wsp', '')] == 4]
+    row = seeds[seeds[('wsp', '')] == 4].iloc[0]
+    assert np.isclose(row[('a', 'Mean')], wsp4[('a', 'Mean')].mean())
+    assert np.isclose(row[('a', 'DEL_m4_DEL')], (wsp4[('a', 'DEL_m4')]**4).mean()**0.25)
+    assert np.isclose(row[('a', 'DEL_m4_max')], wsp4[('a', 'DEL_m4')].max())
+
+    # lifetime equivalent load with wind speed probabilities
+    df[('prob', '')] = df[('wsp', '')].map({4: 0.5, 6: 0.3, 8: 0.2})
+    df.wetb._obj = df
+    life = df.wetb.aggregate_rows(['wsp', 'seed'], {'DEL_m4': 'DEL'}, weights='prob')
+    assert len(life) == 1
+    expected = ((df[('prob', '')] * df[('a', 'DEL_m4')]**4).sum() / df[('prob', '')].sum())**0.25
+    assert np.isclose(life[('a', 'DEL_m4')].iloc[0], expected)
+
+
+def test_columnar_tags():
+    from itertools import product
+    Consts = {'casename': 'dlc12', 'tstop': 600}
+    Vars = {'wsp': [4, 6, 8], 'yaw': [-8, 0, 8], 'seed': [1, 2, 3, 4]}
+    Funcs = {'double': backend.vectorized(lambda x: x['wsp'] * 2),
+             'case_id': lambda x: 'wsp{wsp}_yaw{yaw}_s{seed}_{double}'.format(**x)}
+
+    tags = backend.tag_table(Consts, Vars, Funcs)
+    assert list(tags) == ['casename', 'tstop', 'wsp', 'yaw', 'seed', 'double', 'case_id']
+    expected = [f'wsp{w}_yaw{y}_s{s}_{2*w}' for w, y, s in product(*Vars.values())]
+    assert list(tags.case_id) == expected
+
+    chunks = list(backend.iter_tag_tables(Consts, Vars, Funcs, chunksize=7))
+    assert [len(x) for x in chunks] == [7, 7, 7, 7, 7, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks), tags)
+
+
+MASTER = '''begin simulation;
+  time_stop 600;
+  logfile ./log/{casename}/{case_id}.log;
+end simulation;
+begin wind;
+  wsp {wsp};
+  begin mann;
+    filename_u ./turb/{case_id}_u.bin;
+  end mann;
+end wind;
+begin output;
+  filename ./res/{casename}/{case_id};
+  general time;
+end output;
+exit;
+'''
+
+def write_master(directory, name='dlc12', text=MASTER):
+    os.makedirs(os.path.join(directory, 'htc', '_master'), exist_ok=True)
+    fn = os.path.join(directory, 'htc', '_master', name + '.htc')
+    with open(fn, 'w') as f:
+        f.write(text)
+    return fn
+
+
+def test_incremental_htc_generation(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from hawcast.hawcast import cli
+    monkeypatch.chdir(tmp_path)
+    master = write_master(str(tmp_path))
+    tags = backend.Case(write_definition(str(tmp_path))).tags
+
+    count = backend.generate_htc_files(tags, master, incremental=True)
+    assert count == {'written': 18, 'unchanged': 0, 'removed': 0}
+    with open('htc/dlc12/dlc12_wsp8_yaw0_s2.htc') as f:
+        assert 'wsp 8;' in f.read()
+
+    tags = tags[tags.wsp != 8].copy()
+    tags.loc[tags.wsp == 6, 'wsp'] = 7
+    count = backend.generate_htc_files(tags, master, incremental=True)
+    assert count == {'written': 6, 'unchanged': 6, 'removed': 6}
+    assert not os.path.exists('htc/dlc12/dlc12_wsp8_yaw0_s2.htc')
+
+    # braces which are not tags are kept, as by str.replace
+    backend.generate_htc_files(tags.drop(columns='wsp'), master)
+    with open('htc/dlc12/dlc12_wsp6_yaw0_s2.htc') as f:
+        assert 'wsp {wsp};' in f.read()
+
+    # htc files of a casename which is no longer defined are removed
+    renamed = tags.assign(casename='dlc12b')
+    count = backend.generate_htc_files(renamed, master, incremental=True)
+    assert count == {'written': 12, 'unchanged': 0, 'removed': 12}
+    assert not os.path.exists('htc/dlc12') and len(os.listdir('htc/dlc12b')) == 13
+    backend.generate_htc_files(tags, master, incremental=True)
+
+    result = CliRunner().invoke(cli, ['htc', 'dlc12.py', '--incremental'])
+    assert result.exit_code == 0, result.output
+    assert '12 written, 6 unchanged, 0 removed' in result.output
+
+
+def test_batch_pbs(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from hawcast.hawcast import cli
+    from hawcast.htcscan import scan_htc, htc_values
+    monkeypatch.chdir(tmp_path)
+    master = write_master(str(tmp_path))
+    tags = backend.Case(write_definition(str(tmp_path))).tags
+    backend.generate_htc_files(tags, master)
+
+    values, counts = scan_htc(MASTER)
+    assert values['wind.mann.filename_u'] == './turb/{case_id}_u.bin'
+    assert values['simulation.time_stop'] == '600' and counts['output'] == 2
+
+    # the scanner agrees with a full HTCFile parse
+    from wetb.hawc2.htc_file import HTCFile
+    htc_fn = 'htc/dlc12/dlc12_wsp4_yaw0_s1.htc'
+    htc = HTCFile(htc_fn)
+    assert htc_values(htc_fn, backend.PBS_KEYS) == {
+        'simulation.logfile': htc.simulation.logfile.str_values(),
+        'output.filename': htc.output.filename.str_values(),
+        'wind.mann.filename_u': htc.wind.mann.filename_u.str_values()}
+
+    result = CliRunner().invoke(cli, ['jess', 'htc/dlc12'])
+    assert '18 written, 0 up to date' in result.output, result.output
+    with open('pbs_in/dlc12/dlc12_wsp4_yaw0_s1.p') as f:
+        text = f.read()
+    assert '#PBS -N dlc12_wsp4_yaw0_s1' in text and 'mkdir -p res/dlc12/' in text
+    assert '[copyback_files]' in text
+
+    result = CliRunner().invoke(cli, ['jess', 'htc/dlc12'])
+    assert '0 written, 18 up to date' in result.output, result.output
+
+
+def test_model_zip(tmp_path, monkeypatch):
+    import zipfile
+    from click.testing import CliRunner
+    from hawcast.hawcast import cli
+    from hawcast import modelzip
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('control')
+    os.makedirs('data/airfoils')
+    with open('control/dtu_we_controller.dll', 'wb') as f:
+        f.write(np.random.default_rng(0).bytes(100000))
+    with open('data/st.dat', 'w') as f:
+        f.write('\n'.join(f'{x:.4f} 1.0 2.0' for x in range(5000)))
+    with open('data/airfoils/pc.dat', 'w') as f:
+        f.write('pc')
+
+    out = backend.generate_model_zip('model.zip', incremental=True, n_jobs=2, store=('.dll',))
+    assert len(out['written']) == 3
+    with zipfile.ZipFile('model.zip') as z:
+        assert z.testzip() is None
+        assert z.getinfo('control/dtu_we_controller.dll').compress_type == zipfile.ZIP_STORED
+        assert z.getinfo('data/st.dat').compress_type == zipfile.ZIP_DEFLATED
+        assert z.read('data/airfoils/pc.dat') == b'pc'
+    data = open('model.zip', 'rb').read()
+    assert backend.generate_model_zip('model.zip', incremental=True, store=('.dll',))['written'] == []
+    os.utime('data/st.dat')
+    assert backend.generate_model_zip('model.zip', incremental=True, store=('.dll',))['written'] == []
+    assert open('model.zip', 'rb').read() == data
+
+    with open('data/airfoils/pc.dat', 'w') as f:
+        f.write('pc2')
+    os.remove('data/st.dat')
+    out = backend.generate_model_zip('model.zip', incremental=True, store=('.dll',))
+    assert out['written'] == ['data/airfoils/pc.dat'] and out['removed'] == ['data/st.dat']
+    assert out['copied'] == ['control/dtu_we_controller.dll']
+    with zipfile.ZipFile('model.zip') as z:
+        assert z.testzip() is None and z.namelist() == ['control/dtu_we_controller.dll', 'data/airfoils/pc.dat']
+        assert z.read('data/airfoils/pc.dat') == b'pc2'
+
+    # the hashed zip only depends on the model content
+    name = modelzip.hashed_package()
+    assert name == modelzip.hashed_package() and os.path.basename(name).startswith('model-')
+    write_master(str(tmp_path))
+    backend.generate_htc_files(backend.Case(write_definition(str(tmp_path))).tags, 'htc/_master/dlc12.htc')
+    result = CliRunner().invoke(cli, ['jess', 'htc/dlc12', '--hashed-zip'])
+    assert '18 written' in result.output, result.output
+    with open('pbs_in/dlc12/dlc12_wsp4_yaw0_s1.p') as f:
+        assert os.path.basename(name) in f.read()
+    with open('data/airfoils/pc.dat', 'w') as f:
+        f.write('pc3')
+    result = CliRunner().invoke(cli, ['jess', 'htc/dlc12', '--hashed-zip'])
+    assert '18 written' in result.output, result.output
+    with open('pbs_in/dlc12/dlc12_wsp4_yaw0_s1.p') as f:
+        assert os.path.basename(name) not in f.read()
+
+
+def test_balanced_bat_files(tmp_path, monkeypatch):
+    from hawcast.scheduling import estimate_costs, lpt_schedule, output_channels
+    from hawcast.htcscan import scan_htc
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('htc/mixed')
+    for i, tstop in enumerate([600, 600, 600, 600, 60, 60, 60, 60, 60, 60, 60, 60]):
+        text = MASTER.replace('600', str(tstop)).replace('{case_id}', f'case{i}')
+        with open(f'htc/mixed/case{i}.htc', 'w') as f:
+            f.write(text.format(casename='mixed', wsp=10))
+
+    makespans, unit = backend.htc2bat('htc/mixed', 4)
+    assert unit == 'jobs' and makespans == [3, 3, 3, 3]
+    makespans, unit = backend.htc2bat('htc/mixed', 4, balance=True)
+    assert unit == 'relative'
+    assert max(makespans) / min(makespans) < 1.1
+    with open('bat/1.bat') as f:
+        assert f.readline() == 'cd ..\n'
+
+    # wall times from previous log files calibrate the estimate
+    os.makedirs('log/mixed')
+    with open('log/mixed/case0.log', 'w') as f:
+        f.write('Elapsed time :   120.0\n')
+    costs, unit = estimate_costs([f'htc/mixed/case{i}.htc' for i in (0, 1, 4)])
+    assert unit == 'seconds' and np.allclose(costs, [120, 120, 12])
+
+    text = 'begin output;\n filename ./res/x;\n buffer 1;\n general time;\n mbdy momentvec tower 1 1 tower;\nend output;'
+    assert output_channels(*scan_htc(text)) == 2
+    assert output_channels(*scan_htc('begin simulation;\n time_stop 600;\nend simulation;')) == 0
+
+    batches, loads = lpt_schedule([5, 4, 3, 3, 3], 2)
+    assert sorted(loads) == [8, 10] and sorted(sum(batches, [])) == [0, 1, 2, 3, 4]
+
+
+FAKE_HAWC2 = '''
+import os, re, sys
+# a stand-in for HAWC2 which writes an empty result with 100 scans of 2 channels
+htc_fn = sys.argv[-1]
+with open(htc_fn) as f:
+    res = re.search(r'filename (.*);', f.read()).group(1)
+print('running', htc_fn)
+if 'wsp6_yaw0_s1' in htc_fn and not os.path.exists('failed_once'):
+    open('failed_once', 'w').close()
+    sys.exit(1)
+os.makedirs(os.path.dirname(res), exist_ok=True)
+with open(res + '.sel', 'w') as f:
+    f.write('\\n' * 8 + '  100  2  1.0  BINARY\\n')
+with open(res + '.dat', 'wb') as f:
+    f.write(bytes(400))
+'''
+
+def test_local_runner(tmp_path, monkeypatch):
+    import sys
+    from click.testing import CliRunner
+    from hawcast.hawcast import cli
+    from hawcast.runner import result_complete
+    monkeypatch.chdir(tmp_path)
+    backend.generate_htc_files(backend.Case(write_definition(str(tmp_path))).tags,
+                               write_master(str(tmp_path)))
+    with open('fake_hawc2.py', 'w') as f:
+        f.write(FAKE_HAWC2)
+    exe = f'{sys.executable} fake_hawc2.py'
+
+    # an interrupted campaign: some results exist, one is incomplete
+    write_hawc2_res('res/dlc12/dlc12_wsp4_yaw0_s1', np.ones((100, 2)))
+    write_hawc2_res('res/dlc12/dlc12_wsp4_yaw0_s2', np.ones((100, 2)))
+    with open('res/dlc12/dlc12_wsp4_yaw0_s2.dat', 'r+b') as f:
+        f.truncate(10)
+
+    result = CliRunner().invoke(cli, ['run', 'htc/dlc12', '-j', '4', '--exe', exe])
+    assert result.exit_code == 0, result.output
+    assert '17 done, 1 already complete, 0 failed' in result.output
+    assert result_complete('res/dlc12/dlc12_wsp4_yaw0_s2')
+    with open('run_out/dlc12/dlc12_wsp6_yaw0_s1.out') as f:
+        assert f.read().count('# attempt') == 2
+
+    result = CliRunner().invoke(cli, ['run', 'htc/dlc12', '--exe', exe])
+    assert '0 done, 18 already complete' in result.output
+
+    # an executable which can not be started fails the jobs, after retrying
+    result = CliRunner().invoke(cli, ['run', 'htc/dlc12', '--force', '--exe', 'no_such_hawc2'])
+    assert '0 done, 0 already complete, 18 failed' in result.output
+    with open('run_out/dlc12/dlc12_wsp6_yaw0_s1.out') as f:
+        assert 'FileNotFoundError' in f.read()
+
+
+def test_statistics_cache(tmp_path, monkeypatch):
+    from hawcast import postproc
+    from hawcast.statscache import StatsCache
+    write_campaign(str(tmp_path))
+    loaded = []
+    reduce_file = postproc._reduce_file
+    def counting(filename, header, channels, *args):
+        loaded.append((os.path.basename(filename), tuple(channels)))
+        return reduce_file(filename, header, channels, *args)
+    monkeypatch.setattr(postproc, '_reduce_file', counting)
+
+    cache = StatsCache(str(tmp_path / 'cache' / 'stats.sqlite'))
+    stats = {'mean': None, 'DEL': {'m': [3, 4]}}
+    df = postproc.HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1})
+    first = df.wetb.compute(stats, cache=cache)
+    assert len(loaded) == 6 and len(cache) == 6 * 3
+
+    # a new channel and an unchanged file: only the new channel is read
+    loaded.clear()
+    write_hawc2_res(str(tmp_path / 'wsp4_s1'), np.ones((100, 3)))
+    df = postproc.HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    second = df.wetb.compute(stats, cache=cache)
+    assert sorted(loaded)[0] == ('wsp4_s1', ('a', 'b'))
+    assert all(channels == ('b',) for name, channels in sorted(loaded)[1:])
+    changed = second[('wsp', '')].eq(4) & second[('seed', '')].eq(1)
+    np.testing.assert_allclose(second[~changed][('a', 'DEL_m4')], first[~changed][('a', 'DEL_m4')])
+    assert second[changed][('a', 'Mean')].iloc[0] == 1
+
+    loaded.clear()
+    df = postproc.HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    df.wetb.compute({'DEL': {'m': [4]}}, cache=cache)
+    assert loaded == []
+
+    # least recently used entries are evicted first
+    small = StatsCache(str(tmp_path / 'small.sqlite'), max_bytes=2000)
+    small.put_many((str(i), np.arange(10.)) for i in range(5))
+    small.get_many(['0'])
+    small.put_many((str(i), np.arange(10.)) for i in range(5, 10))
+    assert small.size <= 2000 and '0' in small.get_many(['0'])
+    assert '1' not in small.get_many(['1'])
+
+
+def test_columnar_store(tmp_path):
+    from hawcast.postproc import HAWC2DataFrame
+    from hawcast.columnar import ColumnarStore, convert_results
+    write_campaign(str(tmp_path))
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'c': 3})
+
+    store = df.wetb.to_store(str(tmp_path / 'store'), wsp=[4, 6])
+    assert len(store) == 4 and store.channels == [1, 3]
+    store = df.wetb.to_store(str(tmp_path / 'store'))
+    assert len(store) == 6 and os.path.getsize(tmp_path / 'store' / 'ch3.bin') == 6 * 2000 * 2
+
+    for name, x in zip(store.names, store.split(3)):
+        with Hawc2Result(str(tmp_path / name)) as res:
+            np.testing.assert_array_equal(x, res.channel(3))
+            np.testing.assert_array_equal(store.read(name, {'c': 3, 'a': 1}), res.read([3, 1]))
+
+    scaled = convert_results([str(tmp_path / 'wsp8_s1')], str(tmp_path / 'f4'), [2], dtype=np.float32)
+    assert ColumnarStore(str(tmp_path / 'f4')).channel(2, dtype=np.float32).dtype == np.float32
+    assert scaled.read('wsp8_s1').shape == (2000, 1)
+
+
+def test_parquet_roundtrip(tmp_path):
+    import pytest
+    pytest.importorskip('pyarrow')
+    from hawcast.postproc import HAWC2DataFrame, wetbAccessor
+    write_campaign(str(tmp_path))
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1})
+    df = df.wetb.compute(['mean'])
+    df.wetb.to_parquet(str(tmp_path / 'stats.parquet'))
+
+    out = wetbAccessor.read_parquet(str(tmp_path / 'stats.parquet'))
+    pd.testing.assert_frame_equal(pd.DataFrame(out), pd.DataFrame(df))
+    out = out.wetb.std()
+    assert ('a', 'Std') in out
+
+    # a dataframe which is not linked to result files
+    df.to_csv(str(tmp_path / 'stats.csv'), index=False)
+    unlinked = wetbAccessor.read_csv(str(tmp_path / 'stats.csv'))
+    wetbAccessor(unlinked).to_parquet(str(tmp_path / 'unlinked.parquet'))
+    out = wetbAccessor.read_parquet(str(tmp_path / 'unlinked.parquet'))
+    assert len(out) == len(df) and not hasattr(out.wetb, '_directory')
+    out.wetb.to_pickle(str(tmp_path / 'unlinked.pkl'))
+
+
+def test_dense_spectra(tmp_path):
+    from scipy import signal
+    from hawcast.postproc import HAWC2DataFrame
+    from hawcast.spectra import band_average, log_bands
+    write_campaign(str(tmp_path), NSc=4000)
+    with open(tmp_path / 'wsp8_s2.dat', 'r+b') as f:
+        f.truncate(100)
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    with Hawc2Result(str(tmp_path / 'wsp4_s1')) as res:
+        x, fs = res.read([1, 2]), res.header.NSc / res.header.Time
+    row = lambda sp: [df.wetb._filenames[idx] for idx in sp.index].index('wsp4_s1')
+
+    sp = df.wetb.spectra(nperseg=512, noverlap=128, n_jobs=2)
+    assert sp.psd.shape == (6, 2, 257) and sp.psd.dtype == np.float32
+    bad = list(df.wetb.errors)
+    assert len(bad) == 1 and np.isnan(sp.psd[list(sp.index).index(bad[0])]).all()
+    f, P = signal.welch(x, fs=fs, nperseg=512, noverlap=128, axis=0)
+    np.testing.assert_allclose(sp.f, f)
+    np.testing.assert_allclose(sp.psd[row(sp)], P.T, rtol=1e-5)
+
+    banded = df.wetb.spectra(nperseg=512, bands=8, wsp=4)
+    assert banded.psd.shape == (2, 2, 8) and len(banded.f) == 8
+    f, P = signal.welch(x, fs=fs, nperseg=512, axis=0)
+    np.testing.assert_allclose(banded.psd[row(banded)], band_average(f, P.T, log_bands(f, 8))[1], rtol=1e-5)
+
+    picked = df.wetb.spectra(['a'], nperseg=512, freqs=[f[3], f[10]], seed=1)
+    assert picked.psd.shape == (3, 1, 2)
+    np.testing.assert_allclose(picked.psd[row(picked), 0], P[[3, 10], 0], rtol=1e-5)
+
+
+def test_prefetch(tmp_path, monkeypatch):
+    import threading
+    import pytest
+    from hawcast.prefetch import prefetch
+    from hawcast.postproc import HAWC2DataFrame
+
+    loaded = [threading.Event() for _ in range(8)]
+    def load(x):
+        loaded[x].set()
+        if x == 3:
+            raise ValueError('bad item')
+        return x * 2
+    out = []
+    for x, y, error in prefetch(load, range(8), depth=4):
+        # the next item loads while this one is processed, and no more
+        # than depth items ahead are started
+        if x + 1 < 8:
+            assert loaded[x + 1].wait(5)
+        if x + 5 < 8:
+            assert not loaded[x + 5].is_set()
+        out.append(y if error is None else str(error))
+    assert out == [0, 2, 4, 'bad item', 8, 10, 12, 14]
+
+    write_campaign(str(tmp_path))
+    with open(tmp_path / 'wsp6_s2.dat', 'r+b') as f:
+        f.truncate(100)
+    df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1})
+    sims = list(df.wetb.iter_sim(prefetch=2))
+    assert len(sims) == 6 and sum(raw is None for _, raw in sims) == 1
+    assert [df.wetb._filenames[idx] for idx in df.wetb.errors] == ['wsp6_s2']
+    assert list(sims[0][0].index.get_level_values(0)) == ['wsp', 'seed']
+    with pytest.raises(ValueError):
+        list(df.wetb.iter_sim(prefetch=2, errors='raise'))
+
+    case = backend.Case(write_definition(str(tmp_path)))
+    monkeypatch.chdir(tmp_path)
+    for sim in case(wsp=4):
+        write_hawc2_res(sim.res[:-4], np.ones((50, 2)))
+    results = list(case.iter_results(prefetch=3, wsp=[4, 6]))
+    assert [res is None for _, res in results] == [False] * 6 + [True] * 6
+    with pytest.raises(OSError):
+        case(wsp=6)[0].loadData()
+
+
+def test_synthetic_benchmarks(tmp_path):
+    import importlib.util
+    from hawcast import synthetic
+    fns = synthetic.write_results(str(tmp_path / 'res'), n_files=13, n_channels=5, n_scans=300)
+    assert os.path.basename(fns[12]) == 'wsp6_s2'
+    assert read_sel(fns[0])[:2] == (300, 5)
+    case = backend.Case(synthetic.write_definition(str(tmp_path / 'synth.py'), n_variables=3, n_values=2))
+    assert len(case.tags) == 8 and len(case.Def.channels) == 20
+
+    spec = importlib.util.spec_from_file_location(
+        'bench', os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'bench.py'))
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    results = bench.run_benchmarks({'files': 3, 'channels': 4, 'scans': 500},
+                                   ['readHawc2Res', 'stat_mean'], repeat=1)
+    assert sorted(results) == ['readHawc2Res', 'stat_mean']
+    assert results['readHawc2Res']['mb_per_s'] > 0
+    slower = {name: dict(r, seconds=r['seconds'] * 2) for name, r in results.items()}
+    assert len(bench.compare(slower, results)) == 2
+    assert bench.compare(results, slower) == []
+
+
+def test_profiling(tmp_path, monkeypatch):
+    import json
+    from click.testing import CliRunner
+    from hawcast import profiling
+    from hawcast.hawcast import cli
+    from hawcast.postproc import HAWC2DataFrame
+    write_campaign(str(tmp_path))
+
+    assert profiling.stage('read_dat') is profiling.stage('other')
+    with profiling.Profiler(trace_fn=str(tmp_path / 'trace.json')) as prof:
+        df = HAWC2DataFrame(dir=str(tmp_path), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+        df.wetb.compute({'mean': None, 'DEL': {'m': [3, 4]}})
+    summary = prof.summary()
+    assert summary['counters']['dat_bytes'] == 6 * 2000 * 2 * 2
+    assert summary['stages']['reduce.DEL_m3+DEL_m4']['calls'] == 6
+    assert {'discover', 'parse_header', 'read_dat', 'reduce.Mean'} <= set(summary['stages'])
+    with open(tmp_path / 'trace.json') as f:
+        assert len(json.load(f)['traceEvents']) == sum(s['calls'] for s in summary['stages'].values())
+    assert profiling._active is None
+
+    monkeypatch.chdir(tmp_path)
+    write_definition(str(tmp_path))
+    write_master(str(tmp_path))
+    result = CliRunner().invoke(cli, ['--profile', 'htc', 'dlc12.py'])
+    assert result.exit_code == 0, result.output
+    with open('hawcast_profile.json') as f:
+        summary = json.load(f)
+    assert summary['stages']['htc.write']['calls'] == 18
+    assert 'htc.render' in result.output
+
+
+IMPORT_CHECK = '''
+import sys, json
+from hawcast.hawcast import cli
+for args in (['--help'], ['bat', 'htc/dlc12', '-n', '2'], ['jess', 'htc/dlc12', '-j', '1']):
+    try:
+        cli(args, standalone_mode=False)
+    except SystemExit:
+        pass
+heavy = [m for m in ('numpy', 'pandas', 'scipy', 'wetb') if m in sys.modules]
+print(json.dumps({'heavy': heavy}))
+'''
+
+def test_import_time(tmp_path, monkeypatch):
+    # hawcast --help, bat and jess must not load the scientific stack
+    import sys, json, subprocess
+    monkeypatch.chdir(tmp_path)
+    backend.generate_htc_files(backend.Case(write_definition(str(tmp_path))).tags,
+                               write_master(str(tmp_path)))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    out = subprocess.run([sys.executable, '-c', IMPORT_CHECK], capture_output=True, text=True,
+                         env=env, check=True).stdout
+    result = json.loads(out.splitlines()[-1])
+    assert result['heavy'] == []
+    assert os.path.isfile('bat/2.bat') and os.path.isfile('pbs_in/dlc12/dlc12_wsp4_yaw0_s1.p')
+
+
+def test_sharded_postproc(tmp_path, monkeypatch):
+    import sys, subprocess
+    from click.testing import CliRunner
+    from hawcast.hawcast import cli
+    from hawcast.postproc import HAWC2DataFrame, wetbAccessor
+    from hawcast.sharding import assign_shards, parse_stat
+    assert parse_stat('DEL:m=3,4:neq=600') == ('DEL', {'m': [3, 4], 'neq': 600})
+    assert assign_shards(['a', 'b', 'c'], 2, costs=[3, 2, 2]) == [0, 1, 1]
+    assert assign_shards(['a', 'b'], 4) == assign_shards(['a', 'b'], 4)
+
+    write_campaign(str(tmp_path / 'res'), wsps=(4, 6, 8, 10, 12))
+    with open(tmp_path / 'res' / 'wsp8_s2.dat', 'r+b') as f:
+        f.truncate(100)
+    monkeypatch.chdir(tmp_path)
+    args = ['postproc', 'res', 'wsp{wsp}_s{seed}', '-c', 'a=1', '-c', 'b=2', '-s', 'mean', '-s', 'DEL:m=3,4']
+
+    # the shards run as separate processes, as on a cluster
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    procs = [subprocess.Popen([sys.executable, '-m', 'hawcast.hawcast', *args, '--shard', f'{i}/3'],
+                              env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+             for i in range(3)]
+    for proc in procs:
+        assert proc.wait() == 0, proc.stdout.read()
+    result = CliRunner().invoke(cli, ['merge', 'postproc', '--csv', 'stats.csv'])
+    assert result.exit_code == 0, result.output
+    assert 'Merged 3 shards, 10 result files, 1 failed' in result.output
+
+    merged = wetbAccessor.read_pickle('postproc/stats.pkl')
+    df = HAWC2DataFrame(dir='res', pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    full = df.wetb.compute({'mean': None, 'DEL': {'m': [3, 4]}})
+    assert list(merged.index) == list(full.index)
+    pd.testing.assert_frame_equal(pd.DataFrame(merged), pd.DataFrame(full), check_dtype=False)
+    assert [merged.wetb._filenames[idx] for idx in merged.wetb.errors] == ['wsp8_s2']
+    assert len(merged.wetb.std(['a'])) == 10
+
+    # invalid shards are rejected, and parts of another run make merge fail
+    result = CliRunner().invoke(cli, args + ['--shard', '3/3'])
+    assert result.exit_code == 2 and 'Shard 3 is not in 0..2' in result.output
+    os.rename('postproc/part-0001-of-0003.pkl', 'postproc/part-0001-of-0002.pkl')
+    result = CliRunner().invoke(cli, ['merge', 'postproc'])
+    assert result.exit_code == 1 and 'different numbers of shards' in result.output
+    os.remove('postproc/part-0001-of-0002.pkl')
+    result = CliRunner().invoke(cli, ['merge', 'postproc'])
+    assert result.exit_code == 1 and '1 of 3 shards are missing' in result.output
+
+    result = CliRunner().invoke(cli, args + ['--pbs', '4', '-j', '2'])
+    assert result.exit_code == 0, result.output
+    with open('pbs_in/postproc.p') as f:
+        pbs = f.read()
+    assert '#PBS -t 0-3' in pbs and 'ppn=2' in pbs
+    assert "hawcast postproc res 'wsp{wsp}_s{seed}'" in pbs and '--shard $SHARD/4' in pbs
+    assert '-sDEL:m=3,4' in pbs
+
+
+def test_watch_mode(tmp_path, monkeypatch):
+    import threading
+    from click.testing import CliRunner
+    from hawcast.hawcast import cli
+    from hawcast.postproc import HAWC2DataFrame, wetbAccessor
+    from hawcast.watch import StatsTable
+    res = tmp_path / 'res'
+    write_campaign(str(res), wsps=(4, 6))
+    # a result still being written
+    with open(res / 'wsp6_s2.dat', 'r+b') as f:
+        f.truncate(1000)
+    table = StatsTable(str(tmp_path / 'stats.pkl'), str(res), 'wsp{wsp}_s{seed}', {'a': 1, 'b': 2},
+                       {'mean': None, 'DEL': {'m': [3, 4]}})
+    assert table.update() == 3
+    assert table.update() == 0
+
+    # the running result completes, another one is added, one is rerun
+    write_campaign(str(res), wsps=(4, 6, 8), seeds=(2,))
+    assert table.update() == 3
+    df, file_ids = table.read()
+    assert len(df) == 5 and len(file_ids) == 5
+    full = HAWC2DataFrame(dir=str(res), pattern='wsp{wsp}_s{seed}', channels={'a': 1, 'b': 2})
+    full = full.wetb.compute({'mean': None, 'DEL': {'m': [3, 4]}})
+    pd.testing.assert_frame_equal(pd.DataFrame(df), pd.DataFrame(full), check_dtype=False)
+    # the new rows went to the journal, which compact merges into the table
+    assert len(wetbAccessor.read_pickle(str(tmp_path / 'stats.pkl'))) == 3
+    assert os.path.exists(table.journal)
+    table.compact()
+    assert not os.path.exists(table.journal)
+    assert list(wetbAccessor.read_pickle(str(tmp_path / 'stats.pkl')).wetb._filenames) == full.wetb._filenames
+
+    # watching wakes up when a result is written
+    calls = []
+    writer = threading.Timer(0.3, lambda: write_hawc2_res(str(res / 'wsp10_s1'), np.ones((100, 3))))
+    writer.start()
+    table.watch(interval=30, timeout=1.5, callback=calls.append)
+    writer.join()
+    assert sum(calls) == 1 and len(table.read()[0]) == 6
+
+    monkeypatch.chdir(tmp_path)
+    result = CliRunner().invoke(cli, ['watch', 'res', 'wsp{wsp}_s{seed}', '-c', 'a=1', '-s', 'max',
+                                      '--table', 'max.pkl', '--once'])
+    assert result.exit_code == 0, result.output
+    assert '6 results added to max.pkl' in result.output
+
+
+def double(x):
+    return 2 * x
+
+def triple(x):
+    return 3 * x
+
+
+def test_derived_channels(tmp_path, monkeypatch):
+    import pytest
+    from scipy import signal
+    from hawcast import derived
+    from hawcast.derived import ResultArray, hypot, mbc, lowpass, scale, expr, resolve
+    from hawcast.postproc import HAWC2DataFrame
+    from hawcast.statscache import StatsCache
+    rng = np.random.default_rng(4)
+    t = np.arange(6000) * 0.01
+    azi = (t * 72) % 360
+    psi = np.radians(azi)[:, None] + 2 * np.pi * np.arange(3) / 3
+    blades = 5 + 2 * np.cos(psi) + rng.normal(scale=0.1, size=psi.shape)
+    data = np.column_stack([azi, blades, rng.normal(size=(6000, 2)).cumsum(axis=0)])
+    for name in ['wsp4_s1', 'wsp6_s1']:
+        write_hawc2_res(str(tmp_path / 'res' / name), data)
+    fn = str(tmp_path / 'res' / 'wsp4_s1')
+
+    channels = {'azi': 1, 'My1': 2, 'My2': 3, 'My3': 4, 'Mx1': 5, 'Mx2': 6}
+    defs = {'Mres1': hypot('Mx1', 'My1'), 'Mres2': hypot('Mx2', 'My2'),
+            'Mtilt': mbc('My1', 'My2', 'My3', azimuth='azi'),
+            'Mcol': mbc('My1', 'My2', 'My3', azimuth='azi', component='collective'),
+            'Mres1_lp': lowpass('Mres1', cutoff=1.0), 'My1_kNm': scale(2, 1e-3)}
+    raw = ResultArray.load(fn, channels)
+    calls = []
+    evaluate = derived.Hypot.evaluate
+    monkeypatch.setattr(derived.Hypot, 'evaluate',
+                        staticmethod(lambda inputs, fs: calls.append(inputs[0].shape) or evaluate(inputs, fs)))
+    res = ResultArray.load(fn, {**channels, **defs})
+    # both resultants are evaluated in one operation
+    assert calls == [(6000, 2)] and res.shape == (6000, 12)
+    np.testing.assert_allclose(res['Mres1'], np.hypot(raw['Mx1'], raw['My1']))
+    np.testing.assert_allclose(res['My1_kNm'], raw['My1'] * 1e-3)
+    assert np.abs(res['Mtilt'] - 2).max() < 0.5 and np.isclose(res['Mcol'].mean(), 5, rtol=1e-3)
+    sos = signal.butter(4, 1.0, fs=100, output='sos')
+    np.testing.assert_allclose(res['Mres1_lp'], signal.sosfiltfilt(sos, res['Mres1']))
+
+    # only the sources are read, and definitions are checked
+    resolved = resolve({**channels, **defs})
+    assert derived.plan({'x': resolved['Mres1_lp']})[0] == [5, 2]
+    with pytest.raises(ValueError):
+        resolve({'a': hypot('b', 'a'), 'b': 1})
+    with pytest.raises(KeyError):
+        resolve({'a': hypot('b', 'c'), 'b': 1})
+
+    # distinct functions are distinct channels, also in the cache
+    x = ResultArray.load(fn, {'a': 5, 'x2': expr(double, 'a'), 'x3': expr(triple, 'a')})
+    np.testing.assert_allclose(x['x2'], 2 * x['a'])
+    np.testing.assert_allclose(x['x3'], 3 * x['a'])
+    with pytest.raises(ValueError):
+        expr(lambda a: a * 2, 'a')
+
+    def frame():
+        return HAWC2DataFrame(dir=str(tmp_path / 'res'), pattern='wsp{wsp}_s{seed}', channels={**channels, **defs})
+    stats, names = {'mean': None, 'std': None, 'DEL': {'m': [4, 10]}}, ['Mres1', 'Mtilt', 'Mres1_lp']
+    cache = StatsCache(str(tmp_path / 'cache.db'))
+    out = frame().wetb.compute(stats, channels=names, cache=cache)
+    assert np.isclose(out[('Mres1', 'Mean')].iloc[0], res['Mres1'].mean())
+    assert np.isclose(out[('Mres1_lp', 'Std')].iloc[0], res['Mres1_lp'].std(ddof=1))
+    pd.testing.assert_frame_equal(frame().wetb.compute(stats, channels=names, cache=cache), out)
+    pd.testing.assert_frame_equal(frame().wetb.compute(stats, channels=names, n_jobs=2), out)
+    exprs = HAWC2DataFrame(dir=str(tmp_path / 'res'), pattern='wsp{wsp}_s{seed}',
+                           channels={'a': 5, 'x2': expr(double, 'a'), 'x3': expr(triple, 'a')})
+    exprs = exprs.wetb.compute(['max'], cache=cache)
+    np.testing.assert_allclose(exprs[('x3', 'Max')], 1.5 * exprs[('x2', 'Max')])
+
+    # derived channels are kept in saved tables, also in parquet (JSON) form
+    from hawcast.postproc import wetbAccessor
+    out.wetb.to_parquet(str(tmp_path / 'derived.parquet'))
+    saved = wetbAccessor.read_parquet(str(tmp_path / 'derived.parquet'))
+    assert saved.wetb.channels == out.wetb.channels
+    np.testing.assert_allclose(saved.wetb.max(['Mres1'])[('Mres1', 'Max')], res['Mres1'].max())
+    exprs.wetb.to_parquet(str(tmp_path / 'exprs.parquet'))
+    assert wetbAccessor.read_parquet(str(tmp_path / 'exprs.parquet')).wetb.channels['x3'].params['func'] is triple
+    streamed = frame().wetb.compute({'mean': None}, channels=['Mres1', 'Mtilt'], blocksize=1000)
+    np.testing.assert_allclose(streamed[('Mtilt', 'Mean')], out[('Mtilt', 'Mean')])
+    df = frame()
+    df.wetb.compute({'mean': None}, channels=['Mres1_lp'], blocksize=1000)
+    assert len(df.wetb.errors) == 2
+
+    # derived channels of a definition module
+    monkeypatch.chdir(tmp_path)
+    text = ("from hawcast.derived import hypot\n" + DEFINITION.replace("'a': 1, 'b': 2", str(channels)[1:-1])
+            + "derived = {'Mres1': hypot('Mx1', 'My1')}\n")
+    case = backend.Case(write_definition(str(tmp_path), name='dlc12_derived', text=text))
+    assert case.channels['Mres1'].sources == (5, 2)
+    write_hawc2_res('res/dlc12/dlc12_wsp4_yaw0_s1', data)
+    seed = case(wsp=4, yaw=0, seed=1)[0]
+    np.testing.assert_allclose(seed.loadData()['Mres1'], res['Mres1'])
+    tags, values = next(case.iter_results({'max': None}, wsp=4, yaw=0, seed=1))
+    assert np.isclose(values['Max'][-1], res['Mres1'].max())